@@ -30,6 +30,9 @@ class HydroshareGis(TethysAppBase):
                     url_map(name='add_to_project',
                             url='hydroshare-gis/add-to-project',
                             controller='hydroshare_gis.controllers.home'),
+                    url_map(name='ajax_get_cached_layers',
+                            url='hydroshare-gis/get-cached-layers',
+                            controller='hydroshare_gis.controllers_ajax.ajax_get_cached_layers'),
                     url_map(name='ajax_add_local_file',
                             url='hydroshare-gis/add-local-file',
                             controller='hydroshare_gis.controllers_ajax.ajax_add_local_file'),
@@ -60,6 +63,12 @@ class HydroshareGis(TethysAppBase):
                     url_map(name='run_tests',
                             url='hydroshare-gis/run-tests',
                             controller='hydroshare_gis.tests.hs_gis_tests.Test_All_Resources'),
+                    url_map(name='run_staging_benchmark',
+                            url='hydroshare-gis/run-staging-benchmark',
+                            controller='hydroshare_gis.tests.hs_gis_benchmarks.Benchmark_Staging'),
+                    url_map(name='run_wms_render_benchmark',
+                            url='hydroshare-gis/run-wms-render-benchmark',
+                            controller='hydroshare_gis.tests.hs_gis_benchmarks.Benchmark_WMS_Render'),
                     url_map(name='get_generic_res_files_list',
                             url='hydroshare-gis/get-generic-res-files-list',
                             controller='hydroshare_gis.controllers_ajax.ajax_get_generic_res_files_list'),
@@ -69,6 +78,18 @@ class HydroshareGis(TethysAppBase):
                     url_map(name='proxy_get_file',
                             url='hydroshare-gis/proxy-get-file',
                             controller='hydroshare_gis.controllers_ajax.ajax_proxy_get_file'),
+                    url_map(name='export_attribute_table',
+                            url='hydroshare-gis/export-attribute-table',
+                            controller='hydroshare_gis.controllers_ajax.ajax_export_attribute_table'),
+                    url_map(name='get_attribute_summary',
+                            url='hydroshare-gis/get-attribute-summary',
+                            controller='hydroshare_gis.controllers_ajax.ajax_get_attribute_summary'),
+                    url_map(name='identify_features',
+                            url='hydroshare-gis/identify-features',
+                            controller='hydroshare_gis.controllers_ajax.ajax_identify_features'),
+                    url_map(name='get_job_status',
+                            url='hydroshare-gis/get-job-status',
+                            controller='hydroshare_gis.controllers_ajax.ajax_get_job_status'),
                     )
         return url_maps
 
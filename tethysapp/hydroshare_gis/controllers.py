@@ -1,7 +1,7 @@
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 
-from tethys_services.backends.hs_restclient_helper import get_oauth_hs
+from utilities import get_hs_auth_obj, get_resources_to_add, get_user_projects
 
 @login_required()
 def home(request):
@@ -26,43 +26,13 @@ def home(request):
     }
 
     if 'add-to-project' in request.path_info:
-        existing_projects = []
-        resources_to_add = []
-
-        if request.GET.get('res_ids'):
+        r = get_hs_auth_obj(request)
+        if r['success'] and request.GET.get('res_ids'):
             res_ids = request.GET['res_ids'].split(',')
-            hs = get_oauth_hs(request)
-
-            for res_id in res_ids:
-                try:
-                    md = hs.getSystemMetadata(res_id)
-                    resources_to_add.append({
-                        'title': md['resource_title'],
-                        'id': md['resource_id'],
-                        'type': md['resource_type']
-                    })
-                except Exception as e:
-                    print str(e)
-                    continue
-
-            userInfo = hs.getUserInfo()
-            username = userInfo['username']
-            for res in hs.getResourceList(creator=username, types=['GenericResource']):
-                res_id = res['resource_id']
-                try:
-                    for res_file in hs.getResourceFileList(res_id):
-                        if res_file['content_type'] == 'application/json':
-                            existing_projects.append({
-                                'title': res['resource_title'],
-                                'id': res_id
-                            })
-
-                except Exception as e:
-                    print str(e)
-                    continue
+            hs = r['hs_obj']
 
-            context['existing_projects'] = existing_projects
-            context['resources_to_add'] = resources_to_add
+            context['resources_to_add'] = get_resources_to_add(hs, res_ids)
+            context['existing_projects'] = get_user_projects(hs, request.user.username)
 
 
     return render(request, 'hydroshare_gis/home.html', context)
@@ -1,9 +1,12 @@
-from django.http import JsonResponse, Http404, HttpResponse
+from django.http import JsonResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 
-from utilities import process_nongeneric_res, get_hs_res_list, get_geoserver_url, \
-    process_local_file, save_new_project, save_project, generate_attribute_table, delete_tempfiles, \
-    get_features_on_click, get_res_files_list, get_res_layers_from_db, process_generic_res_file, \
-    get_file_mime_type, validate_res_request, get_generic_file_layer_from_db, get_hs_auth_obj
+from json import loads
+
+from utilities import get_hs_res_list, get_geoserver_url, process_local_file, save_new_project, save_project, \
+    generate_attribute_table, delete_tempfiles, get_features_on_click, get_res_files_list, get_file_mime_type, \
+    get_hs_auth_obj, add_hs_res, add_generic_res_file, enqueue_job, get_job_status, get_layers_for_res_ids_from_db, \
+    stream_hs_res_list, export_attribute_table, get_attribute_summary, identify_features, \
+    identify_features_in_bbox
 
 
 message_need_to_login = ('You must be signed in with your HydroShare account. '
@@ -38,16 +41,16 @@ def ajax_add_hs_res(request):
                 return return_obj
             else:
                 hs = r['hs_obj']
-                r = validate_res_request(hs, res_id)
-                if not r['can_access']:
-                    return_obj['message'] = r['message']
+                if request.GET.get('background') == 'true':
+                    params = {
+                        'res_id': res_id,
+                        'res_type': res_type,
+                        'res_title': res_title
+                    }
+                    return_obj['job_id'] = enqueue_job('add_hs_res', hs, request.user.username, params)
+                    return_obj['success'] = True
                 else:
-                    res_layers_obj_list = get_res_layers_from_db(hs, res_id, res_type, res_title, request.user.username)
-                    if res_layers_obj_list:
-                        return_obj['results'] = res_layers_obj_list
-                        return_obj['success'] = True
-                    else:
-                        return_obj = process_nongeneric_res(hs, res_id, res_type, res_title, request.user.username)
+                    return_obj = add_hs_res(hs, res_id, res_type, res_title, request.user.username)
 
     else:
         return_obj['message'] = message_template_wrong_req_method.format(method="GET")
@@ -55,6 +58,36 @@ def ajax_add_hs_res(request):
     return JsonResponse(return_obj)
 
 
+def ajax_get_cached_layers(request):
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {}
+    }
+    if request.is_ajax() and request.method == 'GET':
+        if not request.GET.get('res_ids') and not request.GET.get('res_files'):
+            return_obj['message'] = message_template_param_unfilled.format(param='res_ids')
+        else:
+            res_ids = [res_id for res_id in request.GET.get('res_ids', '').split(',') if res_id]
+            try:
+                res_files = [(res_file['res_id'], res_file['res_fname'])
+                             for res_file in loads(request.GET.get('res_files') or '[]')]
+            except (ValueError, KeyError, TypeError):
+                return_obj['message'] = 'The "res_files" parameter is malformed.'
+                return JsonResponse(return_obj)
+
+            r = get_hs_auth_obj(request)
+            if not r['success']:
+                return_obj['message'] = r['message']
+            else:
+                hs = r['hs_obj']
+                return_obj = get_layers_for_res_ids_from_db(hs, res_ids, res_files)
+    else:
+        return_obj['message'] = message_template_wrong_req_method.format(method="GET")
+
+    return JsonResponse(return_obj)
+
+
 def ajax_add_local_file(request):
     return_obj = {
         'success': False,
@@ -101,12 +134,40 @@ def ajax_get_hs_res_list(request):
             return return_obj
         else:
             hs = r['hs_obj']
-            response = get_hs_res_list(hs)
+            params = request.GET
+            res_type = params.get('res_type') or None
+            query = params.get('q') or None
+
+            if params.get('format') == 'ndjson':
+                return StreamingHttpResponse(stream_hs_res_list(hs, request.user.username, res_type, query),
+                                             content_type='application/x-ndjson')
+
+            try:
+                page = max(1, int(params['page'])) if params.get('page') else None
+                page_size = max(1, int(params['page_size'])) if params.get('page_size') else None
+            except ValueError:
+                return_obj['message'] = 'The "page" and "page_size" parameters must be integers.'
+                return JsonResponse(return_obj)
+
+            response = get_hs_res_list(hs, request.user.username, page, page_size, res_type, query)
             if not response['success']:
                 return_obj['message'] = response['message']
             else:
+                etag = '"%s"' % response['etag']
+                if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                    not_modified_response = HttpResponseNotModified()
+                    not_modified_response['ETag'] = etag
+                    return not_modified_response
+
                 return_obj['res_list'] = response['res_list']
+                return_obj['num_results'] = response['num_results']
+                return_obj['page'] = response['page']
+                return_obj['num_pages'] = response['num_pages']
                 return_obj['success'] = True
+
+                json_response = JsonResponse(return_obj)
+                json_response['ETag'] = etag
+                return json_response
     else:
         return_obj['error'] = message_template_wrong_req_method.format(method="GET")
 
@@ -115,13 +176,59 @@ def ajax_get_hs_res_list(request):
 
 def ajax_generate_attribute_table(request):
     if request.is_ajax() and request.method == 'GET':
-        layer_id = request.GET['layerId']
-        layer_attributes = request.GET['layerAttributes']
-
-        return_obj = generate_attribute_table(layer_id, layer_attributes)
+        params = request.GET
+        layer_id = params['layerId']
+        layer_attributes = params['layerAttributes']
+
+        try:
+            start_index = int(params['startIndex']) if params.get('startIndex') else None
+            count = int(params['count']) if params.get('count') else None
+            filters = loads(params['filters']) if params.get('filters') else None
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'The "startIndex", "count" or "filters" parameter is malformed.'
+            })
+        property_names = params['propertyName'].split(',') if params.get('propertyName') else None
+
+        return_obj = generate_attribute_table(layer_id, layer_attributes, start_index=start_index, count=count,
+                                              sort_by=params.get('sortBy') or None,
+                                              sort_order=params.get('sortOrder', 'asc'),
+                                              filters=filters, search=params.get('search') or None,
+                                              property_names=property_names)
         return JsonResponse(return_obj)
 
 
+def ajax_get_attribute_summary(request):
+    if request.is_ajax() and request.method == 'GET':
+        return JsonResponse(get_attribute_summary(request.GET['layerId']))
+
+
+def ajax_export_attribute_table(request):
+    """
+    Streams a layer's attributes as a CSV or NDJSON download. Takes the same filter parameters as
+    ajax_generate_attribute_table, plus "format" and "fileName".
+    """
+    if request.method != 'GET':
+        return JsonResponse({'success': False, 'message': message_template_wrong_req_method.format(method="GET")})
+
+    params = request.GET
+    export_format = 'ndjson' if params.get('format') == 'ndjson' else 'csv'
+    try:
+        filters = loads(params['filters']) if params.get('filters') else None
+        property_names = params['propertyName'].split(',') if params.get('propertyName') else None
+        rows = export_attribute_table(params['layerId'], params['layerAttributes'], export_format, filters=filters,
+                                      search=params.get('search') or None, property_names=property_names)
+    except (KeyError, ValueError) as e:
+        return JsonResponse({'success': False, 'message': str(e)})
+
+    response = StreamingHttpResponse(rows, content_type='text/csv' if export_format == 'csv' else 'application/x-ndjson')
+    file_name = params.get('fileName') or params['layerId'].split(':')[-1]
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (file_name.replace('"', ''), export_format)
+
+    return response
+
+
 def ajax_save_new_project(request):
     return_obj = {
         'success': False,
@@ -163,7 +270,7 @@ def ajax_save_project(request):
             return return_obj
         else:
             hs = r['hs_obj']
-            return_obj = save_project(hs, res_id, project_info)
+            return_obj = save_project(hs, res_id, project_info, request.user.username)
 
         return JsonResponse(return_obj)
 
@@ -187,6 +294,42 @@ def ajax_get_features_on_click(request):
         return JsonResponse(return_obj)
 
 
+def ajax_identify_features(request):
+    """
+    Returns the features under a map click for several layers at once. Takes "layerIds" (comma-separated), "x" and
+    "y" (EPSG:3857) and "resolution" (map units per pixel), or "bbox" (minx,miny,maxx,maxy in EPSG:3857) instead of
+    a point.
+    """
+    if request.is_ajax() and request.method == 'GET':
+        params = request.GET
+        if params.get('bbox'):
+            try:
+                layer_ids = [layer_id for layer_id in params['layerIds'].split(',') if layer_id]
+                bbox = [float(coord) for coord in params['bbox'].split(',')]
+                if len(bbox) != 4:
+                    raise ValueError
+            except (KeyError, ValueError):
+                return JsonResponse({
+                    'success': False,
+                    'message': 'The "layerIds" and "bbox" parameters are required.'
+                })
+
+            return JsonResponse(identify_features_in_bbox(layer_ids, bbox))
+
+        try:
+            layer_ids = [layer_id for layer_id in params['layerIds'].split(',') if layer_id]
+            x = float(params['x'])
+            y = float(params['y'])
+            resolution = float(params['resolution'])
+        except (KeyError, ValueError):
+            return JsonResponse({
+                'success': False,
+                'message': 'The "layerIds", "x", "y" and "resolution" parameters are required.'
+            })
+
+        return JsonResponse(identify_features(layer_ids, x, y, resolution))
+
+
 def ajax_get_generic_res_files_list(request):
     return_obj = {
         'success': False,
@@ -234,18 +377,32 @@ def ajax_add_generic_res_file(request):
                     return return_obj
                 else:
                     hs = r['hs_obj']
-                    r = validate_res_request(hs, res_id)
-                    if not r['can_access']:
-                        return_obj['message'] = r['message']
+                    if request.GET.get('background') == 'true':
+                        params = {
+                            'res_id': res_id,
+                            'res_fname': res_fname,
+                            'file_index': file_index
+                        }
+                        return_obj['job_id'] = enqueue_job('add_generic_res_file', hs, request.user.username, params)
+                        return_obj['success'] = True
                     else:
-                        generic_file_layer_obj = get_generic_file_layer_from_db(hs, res_id, res_fname, file_index,
-                                                                                request.user.username)
-                        if generic_file_layer_obj:
-                            return_obj['results'] = generic_file_layer_obj
-                            return_obj['success'] = True
-                        else:
-                            return_obj = process_generic_res_file(hs, res_id, res_fname, request.user.username,
-                                                                  file_index)
+                        return_obj = add_generic_res_file(hs, res_id, res_fname, file_index, request.user.username)
+    else:
+        return_obj['message'] = message_template_wrong_req_method.format(method="GET")
+
+    return JsonResponse(return_obj)
+
+
+def ajax_get_job_status(request):
+    return_obj = {
+        'success': False,
+        'message': None
+    }
+    if request.is_ajax() and request.method == 'GET':
+        if not request.GET.get('job_id'):
+            return_obj['message'] = message_template_param_unfilled.format(param='job_id')
+        else:
+            return_obj = get_job_status(request.GET['job_id'], request.user.username)
     else:
         return_obj['message'] = message_template_wrong_req_method.format(method="GET")
 
@@ -1,12 +1,43 @@
 from .model import engine, Base
 from tethys_sdk.services import get_spatial_dataset_engine
-from utilities import get_workspace
+from utilities import get_workspace, build_crs_index, get_crs_index_path
+import os
+from sqlalchemy import inspect
 
 def init_hydroshare_gis_layers_db(first_time):
+    drop_outdated_tables()
     Base.metadata.create_all(engine)
+    create_missing_indexes()
+    if first_time or not os.path.exists(get_crs_index_path()):
+        build_crs_index()
 
     if first_time:
         spatial_dataset_engine = get_spatial_dataset_engine(name='default')
         spatial_dataset_engine.delete_workspace(workspace_id=get_workspace(),
                                                 purge=True,
-                                                recurse=True)
\ No newline at end of file
+                                                recurse=True)
+
+
+def drop_outdated_tables():
+    """
+    The tables of this store only cache information that can be rebuilt from HydroShare, so a table whose columns no
+    longer match its model is dropped and recreated rather than migrated.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name in existing_tables:
+            db_columns = dict((column['name'], column['type']) for column in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in db_columns or not isinstance(db_columns[column.name], column.type.__class__):
+                    table.drop(engine)
+                    break
+
+
+def create_missing_indexes():
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
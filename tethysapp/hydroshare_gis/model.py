@@ -1,6 +1,8 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Date, String, Text
+from sqlalchemy import Column, Integer, BigInteger, Date, DateTime, String, Text, Index, func, or_, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
 
 from .app import HydroshareGis
 
@@ -15,12 +17,15 @@ class Layer(Base):
     """
     # From the database, a library of event details are packaged together
     __tablename__ = 'gis_layers'
+    __table_args__ = (
+        Index('ix_gis_layers_res_id_file_name', 'associated_res_id', 'associated_file_name'),
+    )
 
     # Columns
     id = Column(Integer, primary_key=True)
     layer_id = Column(String(100))
-    associated_res_id = Column(String(50))
-    res_mod_date = Column(String(50), nullable=True)
+    associated_res_id = Column(String(50), index=True)
+    res_mod_date = Column(DateTime, nullable=True)
     name = Column(String(300), nullable=True)
     associated_file_name = Column(String(300), nullable=True)
     associated_res_type = Column(String(50), nullable=True)
@@ -29,9 +34,10 @@ class Layer(Base):
     geom_type = Column(String(50), nullable=True)
     band_info = Column(String(300), nullable=True)
     site_info = Column(String(1000), nullable=True)
+    raster_conversion = Column(String(50), nullable=True)
 
     def __init__(self, layer_id, res_id, res_mod_date, layer_name, file_name, res_type, extents, attributes, geom_type,
-                 band_info, site_info):
+                 band_info, site_info, raster_conversion=None):
         """
         Constructor for an event
         """
@@ -46,6 +52,7 @@ class Layer(Base):
         self.geom_type = geom_type
         self.band_info = band_info
         self.site_info = site_info
+        self.raster_conversion = raster_conversion
 
 
     @staticmethod
@@ -56,6 +63,14 @@ class Layer(Base):
 
         return res_layers
 
+    @staticmethod
+    def get_layers_for_res_ids(res_ids):
+        session = SessionMaker()
+        res_layers = session.query(Layer).filter(Layer.associated_res_id.in_(res_ids)).all()
+        session.close()
+
+        return res_layers
+
     @staticmethod
     def get_generic_file_layer_by_res_id_and_res_fname(res_id, res_fname):
         session = SessionMaker()
@@ -68,11 +83,11 @@ class Layer(Base):
 
     @staticmethod
     def add_layer_to_database(res_id, res_type, layer_name, layer_id, layer_extents, layer_attributes, geom_type,
-                              band_info, site_info, public_fname, res_mod_date):
+                              band_info, site_info, public_fname, res_mod_date, raster_conversion=None):
 
         session = SessionMaker()
         session.add(Layer(layer_id, res_id, res_mod_date, layer_name, public_fname, res_type, layer_extents, layer_attributes, geom_type,
-                          band_info, site_info))
+                          band_info, site_info, raster_conversion))
         session.commit()
 
     @staticmethod
@@ -90,6 +105,509 @@ class Layer(Base):
             .delete()
 
 
+class ResourceFreshness(Base):
+    """
+    Last known modification date of a HydroShare resource and when it was last checked
+    """
+    __tablename__ = 'gis_res_freshness'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    res_id = Column(String(50), unique=True, index=True)
+    res_mod_date = Column(DateTime, nullable=True)
+    checked = Column(DateTime)
+
+    def __init__(self, res_id, res_mod_date):
+        """
+        Constructor for a freshness record
+        """
+        self.res_id = res_id
+        self.res_mod_date = res_mod_date
+        self.checked = datetime.utcnow()
+
+    @staticmethod
+    def get_freshness_by_res_id(res_id):
+        session = SessionMaker()
+        freshness = session.query(ResourceFreshness).filter(ResourceFreshness.res_id == res_id).first()
+        session.close()
+
+        return freshness
+
+    @staticmethod
+    def set_res_mod_date(res_id, res_mod_date):
+        session = SessionMaker()
+        freshness = session.query(ResourceFreshness).filter(ResourceFreshness.res_id == res_id).first()
+        if freshness:
+            freshness.res_mod_date = res_mod_date
+            freshness.checked = datetime.utcnow()
+        else:
+            session.add(ResourceFreshness(res_id, res_mod_date))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another worker process recorded the same resource at the same time
+            session.rollback()
+        session.close()
+
+
+class ProjectIndex(Base):
+    """
+    The map projects (resources containing a mapProject.json) that a user has created on HydroShare
+    """
+    __tablename__ = 'gis_project_index'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    username = Column(String(150), unique=True, index=True)
+    projects = Column(Text)
+    updated = Column(DateTime)
+
+    def __init__(self, username, projects):
+        """
+        Constructor for a project index
+        """
+        self.username = username
+        self.projects = projects
+        self.updated = datetime.utcnow()
+
+    @staticmethod
+    def get_projects_by_username(username, ttl):
+        session = SessionMaker()
+        project_index = session.query(ProjectIndex)\
+            .filter(ProjectIndex.username == username)\
+            .filter(ProjectIndex.updated > datetime.utcnow() - ttl).first()
+        session.close()
+
+        return project_index.projects if project_index else None
+
+    @staticmethod
+    def set_projects(username, projects):
+        session = SessionMaker()
+        project_index = session.query(ProjectIndex).filter(ProjectIndex.username == username).first()
+        if project_index:
+            project_index.projects = projects
+            project_index.updated = datetime.utcnow()
+        else:
+            session.add(ProjectIndex(username, projects))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another worker process indexed the same user at the same time
+            session.rollback()
+        session.close()
+
+    @staticmethod
+    def remove_projects_by_username(username):
+        session = SessionMaker()
+        session.query(ProjectIndex).filter(ProjectIndex.username == username).delete()
+        session.commit()
+        session.close()
+
+
+class ResourceListCache(Base):
+    """
+    A cached part of the HydroShare resource list: either the public resources ('public'), or the other resources
+    a user can see ('user:<username>')
+    """
+    __tablename__ = 'gis_res_list_cache'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    partition = Column(String(200), unique=True, index=True)
+    res_list = Column(Text)
+    updated = Column(DateTime)
+
+    def __init__(self, partition, res_list):
+        """
+        Constructor for a resource list partition
+        """
+        self.partition = partition
+        self.res_list = res_list
+        self.updated = datetime.utcnow()
+
+    @staticmethod
+    def get_partition(partition, ttl):
+        session = SessionMaker()
+        res_list_cache = session.query(ResourceListCache)\
+            .filter(ResourceListCache.partition == partition)\
+            .filter(ResourceListCache.updated > datetime.utcnow() - ttl).first()
+        session.close()
+
+        return res_list_cache
+
+    @staticmethod
+    def set_partition(partition, res_list):
+        session = SessionMaker()
+        res_list_cache = session.query(ResourceListCache).filter(ResourceListCache.partition == partition).first()
+        if res_list_cache:
+            res_list_cache.res_list = res_list
+            res_list_cache.updated = datetime.utcnow()
+        else:
+            session.add(ResourceListCache(partition, res_list))
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another worker process listed the same partition at the same time
+            session.rollback()
+        session.close()
+
+
+class CrsCacheEntry(Base):
+    """
+    Cached result of a CRS check, keyed by a hash of the normalized WKT
+    """
+    __tablename__ = 'gis_crs_cache'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    crs_hash = Column(String(40), unique=True, index=True)
+    result = Column(Text)
+    hits = Column(Integer, default=0)
+    created = Column(DateTime)
+    last_used = Column(DateTime)
+
+    def __init__(self, crs_hash, result):
+        """
+        Constructor for a cache entry
+        """
+        self.crs_hash = crs_hash
+        self.result = result
+        self.hits = 0
+        self.created = datetime.utcnow()
+        self.last_used = self.created
+
+    @staticmethod
+    def get_result_by_hash(crs_hash, ttl):
+        session = SessionMaker()
+        result = None
+        entry = session.query(CrsCacheEntry).filter(CrsCacheEntry.crs_hash == crs_hash).first()
+        if entry:
+            now = datetime.utcnow()
+            if now - entry.created > ttl:
+                session.delete(entry)
+            else:
+                entry.hits += 1
+                entry.last_used = now
+                result = entry.result
+            session.commit()
+        session.close()
+
+        return result
+
+    @staticmethod
+    def add_result(crs_hash, result):
+        session = SessionMaker()
+        try:
+            session.add(CrsCacheEntry(crs_hash, result))
+            session.commit()
+        except IntegrityError:
+            # Another worker process cached the same CRS first
+            session.rollback()
+        session.close()
+
+    @staticmethod
+    def get_stats():
+        """
+        Returns the number of cached CRS checks and the number of times they were reused, across all worker processes
+        """
+        session = SessionMaker()
+        num_entries, num_hits = session.query(func.count(CrsCacheEntry.id), func.sum(CrsCacheEntry.hits)).one()
+        session.close()
+
+        return num_entries, num_hits or 0
+
+    @staticmethod
+    def prune(max_entries, ttl):
+        session = SessionMaker()
+        now = datetime.utcnow()
+        session.query(CrsCacheEntry).filter(CrsCacheEntry.created < now - ttl).delete()
+        num_entries = session.query(CrsCacheEntry).count()
+        if num_entries > max_entries:
+            lru_entries = session.query(CrsCacheEntry.id)\
+                .order_by(CrsCacheEntry.last_used)\
+                .limit(num_entries - max_entries)\
+                .all()
+            session.query(CrsCacheEntry)\
+                .filter(CrsCacheEntry.id.in_([entry.id for entry in lru_entries]))\
+                .delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+
+class Job(Base):
+    """
+    Background job that turns a HydroShare resource (or one of its files) into map layers
+    """
+    __tablename__ = 'gis_jobs'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(36), unique=True, index=True)
+    job_type = Column(String(50))
+    username = Column(String(150), nullable=True)
+    params = Column(Text, nullable=True)
+    status = Column(String(20))
+    stage = Column(String(100), nullable=True)
+    result = Column(Text, nullable=True)
+    created = Column(DateTime)
+    updated = Column(DateTime)
+
+    def __init__(self, job_id, job_type, username, params):
+        """
+        Constructor for a job
+        """
+        self.job_id = job_id
+        self.job_type = job_type
+        self.username = username
+        self.params = params
+        self.status = 'queued'
+        self.stage = 'Waiting for a worker'
+        self.created = datetime.utcnow()
+        self.updated = self.created
+
+    @staticmethod
+    def add_job_to_database(job_id, job_type, username, params):
+        session = SessionMaker()
+        session.add(Job(job_id, job_type, username, params))
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def get_job_by_job_id(job_id):
+        session = SessionMaker()
+        job = session.query(Job).filter(Job.job_id == job_id).first()
+        session.close()
+
+        return job
+
+    @staticmethod
+    def update_job(job_id, status=None, stage=None, result=None):
+        session = SessionMaker()
+        job = session.query(Job).filter(Job.job_id == job_id).first()
+        if job:
+            if status is not None:
+                job.status = status
+            if stage is not None:
+                job.stage = stage
+            if result is not None:
+                job.result = result
+            job.updated = datetime.utcnow()
+            session.commit()
+        session.close()
+
+    @staticmethod
+    def touch_jobs(job_ids):
+        session = SessionMaker()
+        session.query(Job).filter(Job.job_id.in_(job_ids)).update({Job.updated: datetime.utcnow()},
+                                                                  synchronize_session=False)
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def remove_jobs_older_than(max_age):
+        session = SessionMaker()
+        session.query(Job).filter(Job.updated < datetime.utcnow() - max_age).delete()
+        session.commit()
+        session.close()
+
+
+class IngestFlight(Base):
+    """
+    Marks a resource (or resource file) that is currently being loaded into GeoServer, so that concurrent requests for
+    it wait for the one that got there first instead of loading it again
+    """
+    __tablename__ = 'gis_ingest_flights'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    flight_key = Column(String(300), unique=True, index=True)
+    status = Column(String(20))
+    result = Column(Text, nullable=True)
+    started = Column(DateTime)
+    heartbeat = Column(DateTime)
+    finished = Column(DateTime, nullable=True)
+
+    def __init__(self, flight_key):
+        """
+        Constructor for a flight
+        """
+        self.flight_key = flight_key
+        self.status = 'running'
+        self.started = datetime.utcnow()
+        self.heartbeat = self.started
+
+    @staticmethod
+    def try_to_lead(flight_key, stale_after, result_ttl):
+        """
+        Registers the caller as the one processing flight_key, unless someone else already is.
+        :param stale_after: time after which a running flight whose heartbeat was not refreshed is given up on
+        :return: True if the caller should do the work, False if it should wait for the result of the current leader
+        """
+        session = SessionMaker()
+        now = datetime.utcnow()
+        flight = session.query(IngestFlight).filter(IngestFlight.flight_key == flight_key).first()
+        if flight:
+            is_stale = flight.status == 'running' and now - flight.heartbeat > stale_after
+            is_expired = flight.status == 'done' and now - flight.finished > result_ttl
+            if is_stale or is_expired:
+                session.delete(flight)
+                session.commit()
+
+        is_leader = True
+        try:
+            session.add(IngestFlight(flight_key))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            is_leader = False
+        session.close()
+
+        return is_leader
+
+    @staticmethod
+    def get_flight_by_key(flight_key):
+        session = SessionMaker()
+        flight = session.query(IngestFlight).filter(IngestFlight.flight_key == flight_key).first()
+        session.close()
+
+        return flight
+
+    @staticmethod
+    def touch_flights(flight_keys):
+        session = SessionMaker()
+        session.query(IngestFlight)\
+            .filter(IngestFlight.flight_key.in_(flight_keys), IngestFlight.status == 'running')\
+            .update({IngestFlight.heartbeat: datetime.utcnow()}, synchronize_session=False)
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def finish_flight(flight_key, result):
+        session = SessionMaker()
+        flight = session.query(IngestFlight).filter(IngestFlight.flight_key == flight_key).first()
+        if flight:
+            flight.status = 'done'
+            flight.result = result
+            flight.finished = datetime.utcnow()
+            session.commit()
+        session.close()
+
+    @staticmethod
+    def remove_flight(flight_key):
+        session = SessionMaker()
+        session.query(IngestFlight).filter(IngestFlight.flight_key == flight_key).delete()
+        session.commit()
+        session.close()
+
+
+class StagingReservation(Base):
+    """
+    Bytes that a request is downloading into, or keeping in, the temp directory
+    """
+    __tablename__ = 'gis_staging_reservations'
+
+    # Columns
+    id = Column(Integer, primary_key=True)
+    reservation_id = Column(String(36), unique=True, index=True)
+    staging_path = Column(String(500))
+    num_bytes = Column(BigInteger)
+    status = Column(String(20))
+    created = Column(DateTime)
+
+    def __init__(self, reservation_id, staging_path, num_bytes):
+        """
+        Constructor for a reservation
+        """
+        self.reservation_id = reservation_id
+        self.staging_path = staging_path
+        self.num_bytes = num_bytes
+        self.status = 'queued'
+        self.created = datetime.utcnow()
+
+    @staticmethod
+    def add_reservation(reservation_id, staging_path, num_bytes):
+        session = SessionMaker()
+        session.add(StagingReservation(reservation_id, staging_path, num_bytes))
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def try_to_admit(reservation_id, max_staged_bytes, ttl):
+        """
+        Admits a queued reservation if the bytes already admitted leave room for it and no older reservation is still
+        waiting in the queue. The check and the admission are a single UPDATE statement, which SQLite runs under its
+        database write lock; PostgreSQL additionally needs the table locked so that concurrent admissions do not both
+        see the same admitted total.
+        :return: True if the reservation is (now) admitted
+        """
+        session = SessionMaker()
+        if engine.dialect.name == 'postgresql':
+            session.execute('LOCK TABLE gis_staging_reservations IN EXCLUSIVE MODE')
+
+        # Reservations of requests that died without releasing them
+        session.query(StagingReservation)\
+            .filter(StagingReservation.created < datetime.utcnow() - ttl)\
+            .delete(synchronize_session=False)
+
+        result = session.execute(text(
+            "UPDATE gis_staging_reservations SET status = 'admitted' "
+            "WHERE reservation_id = :reservation_id AND status = 'queued' "
+            "AND NOT EXISTS (SELECT 1 FROM gis_staging_reservations older "
+            "                WHERE older.status = 'queued' AND older.created < gis_staging_reservations.created) "
+            "AND (SELECT COALESCE(SUM(admitted.num_bytes), 0) FROM gis_staging_reservations admitted "
+            "     WHERE admitted.status = 'admitted') + num_bytes <= :max_staged_bytes"),
+            {'reservation_id': reservation_id, 'max_staged_bytes': max_staged_bytes})
+        is_admitted = result.rowcount == 1
+        if not is_admitted:
+            is_admitted = session.query(StagingReservation)\
+                .filter(StagingReservation.reservation_id == reservation_id)\
+                .filter(StagingReservation.status == 'admitted').count() == 1
+        session.commit()
+        session.close()
+
+        return is_admitted
+
+    @staticmethod
+    def remove_reservation(reservation_id):
+        session = SessionMaker()
+        session.query(StagingReservation)\
+            .filter(StagingReservation.reservation_id == reservation_id)\
+            .delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def remove_reservations_under_path(path):
+        session = SessionMaker()
+        session.query(StagingReservation)\
+            .filter(or_(StagingReservation.staging_path == path,
+                        StagingReservation.staging_path.startswith(path.rstrip('/') + '/')))\
+            .delete(synchronize_session=False)
+        session.commit()
+        session.close()
+
+    @staticmethod
+    def get_totals():
+        session = SessionMaker()
+        totals = {
+            'admitted': 0,
+            'admitted_bytes': 0,
+            'queued': 0,
+            'queued_bytes': 0
+        }
+        rows = session.query(StagingReservation.status,
+                             func.count(StagingReservation.id),
+                             func.sum(StagingReservation.num_bytes))\
+            .group_by(StagingReservation.status).all()
+        for status, count, num_bytes in rows:
+            if status in ['admitted', 'queued']:
+                totals[status] = count
+                totals['%s_bytes' % status] = int(num_bytes or 0)
+        session.close()
+
+        return totals
+
+
 class ResourceLayersCount:
     def __init__(self):
         self.file_count = 0
@@ -22,8 +22,8 @@
  browser, this, devel
  */
 /*global
- document, $, console, FormData, ol, window, setTimeout, reproject, proj4,
- pageX, pageY, clearInterval, SLD_TEMPLATES, alert, tinycolor, jsPDF, MutationObserver
+ document, $, console, FormData, ol, window, setTimeout, clearTimeout, reproject, proj4,
+ pageX, pageY, clearInterval, SLD_TEMPLATES, alert, tinycolor, jsPDF, MutationObserver, XMLHttpRequest
  */
 /*property
  BingMaps, Circle, DataTable, Feature, Fill, FullScreen, GRAY_INDEX,
@@ -31,47 +31,49 @@
  MousePosition, Overlay, OverviewMap, Point, RasterResource,
  RefTimeSeriesResource, SLD_BODY, Style, TILED, Tile, TileArcGISRest,
  TileWMS, TimeSeriesResource, Vector, View, ZoomSlider, a0, a1, a2, a3, a4,
- a5, add, addClass, addControl, addImage, addLayer, addOverlay, adjust,
- ajax, ajaxSetup, allowEmpty, append, async, attr, attributes, bandInfo,
+ a5, abort, add, addClass, addControl, addImage, addLayer, addOverlay, adjust,
+ ajax, ajaxSetup, allowEmpty, append, async, attr, attributes, background, bandInfo,
  band_info, baseMap, bbox, beforeSend, cancelText, canvas, ceil, center,
  change, children, chooseText, className, clearInterval, collapsed,
- collapsible, color, columnDefs, columns, concat, content, contentType,
+ collapsible, color, column, columnDefs, columns, concat, content, contentType,
  context, contextMenu, control, cookie, coordinate, coordinateFormat,
- createStringXY, crossDomain, crossOrigin, crs, css, cssStyles,
- currentTarget, data, dataType, decrease, defs, deleteRule,
- disableSelection, displayAround, displayName, draw, drawImage, each,
- element, empty, endsWith, error, extent, extents, feature_properties,
- features, file_index, filename, files, fill, filter, find, fit, fixedHeader, floor,
+ createStringXY, crossDomain, crossOrigin, crs, css, cssStyles, cursor,
+ currentTarget, data, dataType, decrease, defs, deleteRule, denied, dir,
+ disableSelection, displayAround, displayName, dragging, draw, drawImage, each,
+ element, empty, endsWith, error, extend, extent, extents, feature_properties,
+ features, file_index, file_results, filename, files, fill, filter, find, fit, fixedHeader, floor,
  footer, forEach, format, fromLonLat, fun, generic_res_files_list, geom, geomType, geom_type,
  geoserverUrl, geoserver_url, get, getAlpha, getCenter, getContext,
- getCoordinates, getElementById, getExtent, getFeatures, getGeometry,
- getLayers, getSize, getSldString, getSource, getView, getZoom, hasClass,
+ getCoordinates, getElementById, getExtent, getFeatures, getGeometry, getResponseHeader,
+ getLayers, getResolution, getSize, getSldString, getSource, getTargetElement, getView, getZoom, hasClass,
  hasOwnProperty, header, height, hide255, host, hsResId, html, id, image,
- imagerySet, increase, index, indexOf, info_format, innerHeight, insertRule,
- is, item, key, keys, labels, last, lat, layer, layerAttributes, layerId,
+ imagerySet, increase, index, indexOf, innerHeight, insertRule,
+ is, item, job_id, join, key, keys, labels, last, lastIndexOf, lat, layer, layerAttributes, layerId, layerIds,
  layer_attributes, layer_extents, layer_id, layer_name, layers, left,
  length, lineTo, listOrder, location, lon, lyrExtents, lyrId, map, max,
  maxZoom, maxx, maxy, message, method, min, minZoom, minx, miny, modal,
- mouseClick, moveTo, name, naturalHeight, nd, newResource, next, not,
- observe, off, on, onClose, onOpen, onbeforeunload, once, one, opacity,
- open, order, orderable, owner, params, parent, parse, pathname,
+ mouseClick, moveTo, name, naturalHeight, nd, newResource, next, not, num_features,
+ num_features_total,
+ observe, off, on, onClose, onOpen, onbeforeunload, onerror, onload, onprogress, once, one, opacity,
+ open, order, orderable, owner, params, param, parent, parse, pathname,
  placeholder, placement, popover, position, positioning, prepend,
  processData, proj, projectInfo, project_info, projection, prop, properties,
- protocol, publicFname, public_fname, push, query_layers, radius, random,
+ protocol, publicFname, public_fname, push, radius, random, recordsFiltered,
+ recordsTotal,
  remove, removeAt, removeAttr, removeClass, removeControl, render,
- renderSync, replace, request, resAbstract, resId, resKeywords, resTitle,
- resType, res_dict_string, res_fname, res_id, res_layers_obj_list, res_list, res_title, res_type, results,
- rules, save, scrollCollapse, scrollLeft, scrollY, search, select,
- serverType, service, set, setAlpha, setCenter, setError, setInterval,
+ renderSync, replace, request, resAbstract, result, resId, resKeywords, resTitle,
+ resType, res_dict_string, resolution, res_files, res_fname, res_id, res_ids, res_layers_obj_list, res_list, res_title, res_type, responseText,
+ results, rows, rules, save, send, scrollCollapse, scrollLeft, scrollY, search, searchDelay, select, serverSide,
+ serverType, set, setAlpha, setCenter, setError, setInterval,
  setLineDash, setPending, setPosition, setRequestHeader, setSuccess,
  setTimeout, setVisible, setZIndex, setZoom, shift, showAlpha, showInput,
- showInset, showPalette, siteInfo, site_info, slice, sort, sortable, source,
- spectrum, splice, split, srs, stop, stopEvent, stopPropagation, stringify,
+ showInset, showPalette, siteInfo, site_info, slice, some, sort, sortable, source,
+ spectrum, splice, split, stage, start, status, stop, stopEvent, stopPropagation, stringify,
  stroke, style, styleSheets, substr, substring, success, target, targets,
- test, text, title, toDataURL, toHexString, toISOString, toLonLat, toLowerCase,
+ test, text, title, toDataURL, toHexString, toISOString, toLowerCase,
  toRgbString, toString, toggleClass, top, trigger, triggerOn, trim, type,
  undefinedHTML, units, unshift, updateParams, updateSize, url, val, value,
- variable, version, view, visible, which, width, x, y, zoom, zoomLevel
+ variable, view, visible, which, width, x, y, zoom, zoomLevel
  */
 
 (function packageHydroShareGIS() {
@@ -84,7 +86,10 @@
     var basemapLayers;
     var contextMenuDict;
     var dataTableLoadRes;
+    var hoverIdentifyTimeout;
+    var hoverIdentifyXhr;
     var insetMap;
+    var isGettingPixelVal = false;
     var layersContextMenuBase;
     var layersContextMenuGeospatialBase;
     var layersContextMenuViewFile;
@@ -98,6 +103,8 @@
     var showLog;
 
     //  *********FUNCTIONS***********
+    var addAdditionalResources;
+    var addCachedLayersToUI;
     var addContextMenuToListItem;
     var addGenericResToUI;
     var addLayerToMap;
@@ -105,7 +112,9 @@
     var addListenersToListItem;
     var addLogEntry;
     var addDefaultBehaviorToAjax;
+    var ajaxWithJobPolling;
     var addListenersToHsResTable;
+    var addRowsToHSResTable;
     var addInitialEventListeners;
     var buildHSResTable;
     var changeBaseMap;
@@ -122,12 +131,18 @@
     var generateAttributeTable;
     var generateResourceList;
     var getCookie;
+    var getCachedLayers;
     var getCssStyles;
+    var getFeaturePropertiesHtml;
     var getGeomType;
     var getGeoserverUrl;
+    var getHSResTableRowsHtml;
     var getRandomColor;
+    var getVisibleVectorLayers;
     var hideMainLoadAnim;
     var handleProjNotSavedInfo;
+    var identifyFeaturesOnClick;
+    var identifyFeaturesOnHover;
     var initializeJqueryVariables;
     var initializeLayersContextMenus;
     var initializeMap;
@@ -191,6 +206,62 @@
      **************FUNCTION DECLARATIONS*******************
      ******************************************************/
 
+    addAdditionalResources = function (additionalResources) {
+        var resIds = additionalResources.map(function (resource) {
+            return resource.id;
+        });
+
+        // Resources that already have layers are added from a single lookup; only the others are loaded one by one
+        getCachedLayers(resIds, [], function (response) {
+            var cachedLayers = [];
+            var resourcesToLoad = additionalResources;
+            var numResourcesToLoad;
+
+            if (response) {
+                resourcesToLoad = [];
+                additionalResources.forEach(function (resource) {
+                    if (response.results.hasOwnProperty(resource.id)) {
+                        cachedLayers = cachedLayers.concat(response.results[resource.id]);
+                    } else if (response.denied.hasOwnProperty(resource.id)) {
+                        addLogEntry('danger', response.denied[resource.id]);
+                    } else {
+                        resourcesToLoad.push(resource);
+                    }
+                });
+            }
+
+            numResourcesToLoad = resourcesToLoad.length;
+            addCachedLayersToUI(cachedLayers, numResourcesToLoad === 0);
+            resourcesToLoad.forEach(function (resource, j) {
+                addNonGenericRes(resource.id, resource.type, resource.title, (j === numResourcesToLoad - 1), null);
+            });
+        });
+    };
+
+    addCachedLayersToUI = function (layers, isLastResource) {
+        var numLayers = layers.length;
+
+        if (numLayers === 0 && isLastResource) {
+            setStateAfterLastResource();
+        }
+        layers.forEach(function (layer, i) {
+            var isLastLayer = isLastResource && i === numLayers - 1;
+
+            if (layer.res_type === 'GenericResource') {
+                if (layer.public_fname !== null) {
+                    addGenericResToUI(layer, isLastLayer);
+                } else if (isLastLayer) {
+                    setStateAfterLastResource();
+                }
+            } else {
+                addLayerToUI(layer, isLastLayer);
+            }
+        });
+        if (numLayers > 0) {
+            $btnSaveProject.prop('disabled', false);
+        }
+    };
+
     addContextMenuToListItem = function ($listItem, resType) {
         var contextMenuId;
 
@@ -597,8 +668,45 @@
         });
     };
 
-    addListenersToHsResTable = function () {
-        $modalAddRes.find('tbody tr').on('click', function () {
+    ajaxWithJobPolling = function (settings) {
+        // Requests made with background=true return a job id right away. The job is polled until it is done and
+        // its result is then handed to the original success callback, as if the request had waited for it.
+        var onSuccess = settings.success;
+        var onError = settings.error;
+        var pollJob = function (jobId) {
+            $.ajax({
+                type: 'GET',
+                url: '/apps/hydroshare-gis/get-job-status',
+                dataType: 'json',
+                data: {'job_id': jobId},
+                error: onError,
+                success: function (response) {
+                    if (!response.success || response.status === 'failed') {
+                        onSuccess(response.result || {'success': false, 'message': response.message});
+                    } else if (response.status === 'complete') {
+                        onSuccess(response.result);
+                    } else {
+                        window.setTimeout(function () {
+                            pollJob(jobId);
+                        }, 1000);
+                    }
+                }
+            });
+        };
+
+        settings.data.background = true;
+        settings.success = function (response) {
+            if (response.hasOwnProperty('job_id')) {
+                pollJob(response.job_id);
+            } else {
+                onSuccess(response);
+            }
+        };
+        $.ajax(settings);
+    };
+
+    addListenersToHsResTable = function ($rows) {
+        ($rows || $modalAddRes.find('tbody tr')).on('click', function () {
             $btnAddRes.prop('disabled', false);
             $(this)
                 .css({
@@ -640,6 +748,9 @@
             $btnSaveProject.prop('disabled', false);
         });
 
+        map.on('singleclick', identifyFeaturesOnClick);
+        map.on('pointermove', identifyFeaturesOnHover);
+
         $('#close-modalViewFile').on('click', function () {
             $modalViewFile.modal('hide');
         });
@@ -1103,21 +1214,19 @@
         });
     };
 
+    addRowsToHSResTable = function (resList) {
+        var $rows = $(getHSResTableRowsHtml(resList));
+
+        dataTableLoadRes.rows.add($rows).draw(false);
+        addListenersToHsResTable($rows);
+    };
+
     buildHSResTable = function (resList) {
         var resTableHtml;
 
         resList = typeof resList === 'string' ? JSON.parse(resList) : resList;
         resTableHtml = '<table id="tbl-resources"><thead><th></th><th>Title</th><!--<th>Size</th>--><th>Type</th><th>Owner</th></thead><tbody>';
-
-        resList.forEach(function (resource) {
-            resTableHtml += '<tr>' +
-                '<td><input type="radio" name="resource" class="rdo-res" value="' + resource.id + '"></td>' +
-                '<td class="res_title">' + resource.title + '</td>' +
-                // '<td class="res_size">' + resource.size + '</td>' +
-                '<td class="res_type">' + resource.type + '</td>' +
-                '<td class="res_owner">' + resource.owner + '</td>' +
-                '</tr>';
-        });
+        resTableHtml += getHSResTableRowsHtml(resList);
         resTableHtml += '</tbody></table>';
         $modalAddRes.find('.modal-body').html(resTableHtml);
         addListenersToHsResTable();
@@ -1136,6 +1245,22 @@
         });
     };
 
+    getHSResTableRowsHtml = function (resList) {
+        var rowsHtml = '';
+
+        resList.forEach(function (resource) {
+            rowsHtml += '<tr>' +
+                '<td><input type="radio" name="resource" class="rdo-res" value="' + resource.id + '"></td>' +
+                '<td class="res_title">' + resource.title + '</td>' +
+                // '<td class="res_size">' + resource.size + '</td>' +
+                '<td class="res_type">' + resource.type + '</td>' +
+                '<td class="res_owner">' + resource.owner + '</td>' +
+                '</tr>';
+        });
+
+        return rowsHtml;
+    };
+
     changeBaseMap = function () {
         var selectedBaseMap = $(this).attr('value');
 
@@ -1455,91 +1580,162 @@
     };
 
     generateAttributeTable = function (layerId, layerAttributes, layerName) {
-        $.ajax({
-            type: 'GET',
-            url: 'generate-attribute-table',
-            data: {
-                'layerId': layerId,
-                'layerAttributes': layerAttributes
-            },
-            error: function () {
-                console.error('There was an error when performing the ajax request to \'generate_attribute_table\'');
-            },
-            success: function (response) {
-                var attributeTableHTML;
-                var featureProperties;
-                var layerAttributesList = [];
-                var dataTable;
-                var tableHeadingHTML = '';
-                var attributeText;
-
-                if (response.hasOwnProperty('success')) {
-                    featureProperties = JSON.parse(response.feature_properties);
-                    layerAttributesList = layerAttributes.split(',');
+        // Features are paged, sorted and searched by GeoServer, so only the rows on screen are ever loaded
+        var layerAttributesList = layerAttributes.split(',');
+        var tableHeadingHTML = '';
+        var dataTable;
+        var exportParams = {
+            'layerId': layerId,
+            'layerAttributes': layerAttributes,
+            'fileName': layerName
+        };
 
-                    layerAttributesList.forEach(function (attribute) {
-                        tableHeadingHTML += '<th>' + attribute + '</th>';
-                    });
+        layerAttributesList.forEach(function (attribute) {
+            tableHeadingHTML += '<th>' + attribute + '</th>';
+        });
+        $('#btn-export-attr-tbl-csv').attr('href', 'export-attribute-table?' + $.param($.extend({'format': 'csv'}, exportParams)));
+        $('#btn-export-attr-tbl-ndjson').attr('href', 'export-attribute-table?' + $.param($.extend({'format': 'ndjson'}, exportParams)));
 
-                    attributeTableHTML = '<table id="tbl-attributes"><thead>' + tableHeadingHTML + '</thead><tbody>';
+        $modalAttrTbl.find('.modal-body').html('<table id="tbl-attributes"><thead>' + tableHeadingHTML + '</thead><tbody></tbody></table>');
+        dataTable = $('#tbl-attributes').DataTable({
+            'order': [[0, 'asc']],
+            'serverSide': true,
+            'searchDelay': 500,
+            'columnDefs': [{
+                'className': 'attribute',
+                'targets': '_all'
+            }],
+            'ajax': function (data, callback) {
+                $.ajax({
+                    type: 'GET',
+                    url: 'generate-attribute-table',
+                    data: {
+                        'layerId': layerId,
+                        'layerAttributes': layerAttributes,
+                        'startIndex': data.start,
+                        'count': data.length,
+                        'sortBy': layerAttributesList[data.order[0].column],
+                        'sortOrder': data.order[0].dir,
+                        'search': data.search.value
+                    },
+                    error: function () {
+                        console.error('There was an error when performing the ajax request to \'generate_attribute_table\'');
+                    },
+                    success: function (response) {
+                        var rows = [];
 
-                    featureProperties.forEach(function (property) {
-                        attributeTableHTML += '<tr>';
-                        layerAttributesList.forEach(function (attribute) {
-                            attributeText = property[attribute].toString();
-                            if (attributeText.indexOf('<') !== -1) {
-                                attributeText = 'None';
-                            }
-                            attributeTableHTML += '<td class="attribute" data-attribute="' + attribute + '">' + attributeText + '</td>';
-                        });
-                        attributeTableHTML += '</tr>';
-                    });
+                        if (response.success) {
+                            response.feature_properties.forEach(function (property) {
+                                rows.push(layerAttributesList.map(function (attribute) {
+                                    var attributeText = property[attribute] === null ? 'None' : property[attribute].toString();
 
-                    $modalAttrTbl.find('.modal-body').html(attributeTableHTML);
-                    dataTable = $('#tbl-attributes').DataTable({
-                        'order': [[0, 'asc']],
-                        "scrollY": "100%",
-                        "scrollCollapse": true,
-                        fixedHeader: {
-                            header: true,
-                            footer: true
+                                    return attributeText.indexOf('<') !== -1 ? 'None' : attributeText;
+                                }));
+                            });
                         }
-                    });
-                    hideMainLoadAnim();
-                    $modalAttrTbl.find('.modal-title').text('Attributes for layer: ' + layerName);
-                    modifyDataTableDisplay(dataTable, $modalAttrTbl);
-                    $modalAttrTbl.modal('show');
-                }
+                        callback({
+                            'draw': data.draw,
+                            'recordsTotal': response.success ? response.num_features_total : 0,
+                            'recordsFiltered': response.success ? response.num_features : 0,
+                            'data': rows
+                        });
+                    }
+                });
+            },
+            "scrollY": "100%",
+            "scrollCollapse": true,
+            fixedHeader: {
+                header: true,
+                footer: true
             }
         });
+        hideMainLoadAnim();
+        $modalAttrTbl.find('.modal-title').text('Attributes for layer: ' + layerName);
+        modifyDataTableDisplay(dataTable, $modalAttrTbl);
+        $modalAttrTbl.modal('show');
     };
 
     generateResourceList = function (numRequests) {
-        $.ajax({
-            type: 'GET',
-            url: '/apps/hydroshare-gis/get-hs-res-list',
-            dataType: 'json',
-            error: function () {
-                if (numRequests < 5) {
-                    numRequests += 1;
-                    setTimeout(generateResourceList, 3000, numRequests);
-                } else {
-                    $modalAddRes.find('.modal-body').html('<div class="error">An unexpected error was encountered while attempting to load resources.</div>');
-                }
-            },
-            success: function (response) {
-                if (response.hasOwnProperty('success')) {
-                    if (!response.success) {
-                        $modalAddRes.find('.modal-body').html('<div class="error">' + response.message + '</div>');
+        // The list is streamed as newline-delimited JSON so that the table is shown as soon as the first resources arrive
+        var xhr = new XMLHttpRequest();
+        var numCharsParsed = 0;
+        var tableIsBuilt = false;
+        var errorMessage = null;
+        var isJsonResponse = function () {
+            // Errors raised before the stream starts (e.g. a failed login) come back as a single JSON object
+            return (xhr.getResponseHeader('Content-Type') || '').indexOf('application/json') !== -1;
+        };
+        var parseNewResources = function () {
+            var lastNewline = xhr.responseText.lastIndexOf('\n');
+            var resList = [];
+
+            if (isJsonResponse() || lastNewline < numCharsParsed) {
+                return;
+            }
+            xhr.responseText.substring(numCharsParsed, lastNewline).split('\n').forEach(function (line) {
+                var resource;
+
+                if (line) {
+                    resource = JSON.parse(line);
+                    if (resource.hasOwnProperty('error')) {
+                        errorMessage = resource.error;
+                    } else if (resource.success === false) {
+                        errorMessage = resource.message || 'An unexpected error was encountered while attempting to load resources.';
                     } else {
-                        if (response.hasOwnProperty('res_list')) {
-                            buildHSResTable(response.res_list);
-                        }
-                        $btnAddRes.add('#div-chkbx-res-auto-close').removeClass('hidden');
+                        resList.push(resource);
                     }
                 }
+            });
+            numCharsParsed = lastNewline + 1;
+
+            if (resList.length > 0) {
+                if (tableIsBuilt) {
+                    addRowsToHSResTable(resList);
+                } else {
+                    tableIsBuilt = true;
+                    buildHSResTable(resList);
+                    $btnAddRes.add('#div-chkbx-res-auto-close').removeClass('hidden');
+                }
             }
-        });
+        };
+        var retry = function () {
+            if (numRequests < 5) {
+                numRequests += 1;
+                setTimeout(generateResourceList, 3000, numRequests);
+            } else {
+                $modalAddRes.find('.modal-body').html('<div class="error">An unexpected error was encountered while attempting to load resources.</div>');
+            }
+        };
+
+        xhr.open('GET', '/apps/hydroshare-gis/get-hs-res-list?format=ndjson');
+        xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+        xhr.onprogress = parseNewResources;
+        xhr.onerror = retry;
+        xhr.onload = function () {
+            var response;
+
+            if (xhr.status !== 200) {
+                retry();
+                return;
+            }
+            if (isJsonResponse()) {
+                try {
+                    response = JSON.parse(xhr.responseText);
+                    errorMessage = response.message || 'An unexpected error was encountered while attempting to load resources.';
+                } catch (ignore) {
+                    errorMessage = 'An unexpected error was encountered while attempting to load resources.';
+                }
+            } else {
+                parseNewResources();
+            }
+            if (errorMessage && !tableIsBuilt) {
+                $modalAddRes.find('.modal-body').html('<div class="error">' + errorMessage + '</div>');
+            } else if (!tableIsBuilt) {
+                buildHSResTable([]);
+                $btnAddRes.add('#div-chkbx-res-auto-close').removeClass('hidden');
+            }
+        };
+        xhr.send();
     };
 
     getCookie = function (name) {
@@ -1562,6 +1758,24 @@
         return cookieValue;
     };
 
+    getCachedLayers = function (resIds, resFiles, callback) {
+        $.ajax({
+            type: 'GET',
+            url: '/apps/hydroshare-gis/get-cached-layers',
+            dataType: 'json',
+            data: {
+                'res_ids': resIds.join(','),
+                'res_files': JSON.stringify(resFiles)
+            },
+            error: function () {
+                callback(null);
+            },
+            success: function (response) {
+                callback(response.success ? response : null);
+            }
+        });
+    };
+
     getCssStyles = function (geomType) {
         var color;
         var cssStyles = {};
@@ -1639,6 +1853,19 @@
         return cssStyles;
     };
 
+    getFeaturePropertiesHtml = function (layerName, properties) {
+        var propertiesHtml = '<p><strong>' + layerName + '</strong></p><table class="table table-condensed">';
+
+        Object.keys(properties).forEach(function (attribute) {
+            var attributeText = properties[attribute] === null ? 'None' : properties[attribute].toString();
+
+            propertiesHtml += '<tr><td>' + attribute + '</td><td>' +
+                    (attributeText.indexOf('<') !== -1 ? 'None' : attributeText) + '</td></tr>';
+        });
+
+        return propertiesHtml + '</table>';
+    };
+
     getGeomType = function (rawGeomType) {
         var geomType;
 
@@ -1681,6 +1908,21 @@
         return color;
     };
 
+    getVisibleVectorLayers = function () {
+        // Maps the id of each visible vector layer to its display name
+        var vectorLayers = {};
+
+        Object.keys(projectInfo.map.layers).forEach(function (displayName) {
+            var layer = projectInfo.map.layers[displayName];
+
+            if (layer.resType === 'GeographicFeatureResource' && layer.visible) {
+                vectorLayers[layer.id] = displayName;
+            }
+        });
+
+        return vectorLayers;
+    };
+
     hideMainLoadAnim = function () {
         $('#div-loading').addClass('hidden');
     };
@@ -1700,6 +1942,97 @@
         $projNotSavedInfo.prop('hidden', hideProjNotSavedInfo);
     };
 
+    identifyFeaturesOnClick = function (evt) {
+        var vectorLayers = getVisibleVectorLayers();
+        var layerIds = Object.keys(vectorLayers);
+        var origCoords = evt.coordinate;
+
+        if (isGettingPixelVal || layerIds.length === 0) {
+            return;
+        }
+
+        $.ajax({
+            type: 'GET',
+            url: '/apps/hydroshare-gis/identify-features',
+            data: {
+                layerIds: layerIds.join(','),
+                x: origCoords[0],
+                y: origCoords[1],
+                resolution: map.getView().getResolution()
+            },
+            success: function (response) {
+                var contentHtml = '';
+
+                if (!response.success) {
+                    return;
+                }
+                layerIds.forEach(function (layerId) {
+                    var features = response.results[layerId];
+
+                    if (features && features.length > 0) {
+                        contentHtml += getFeaturePropertiesHtml(vectorLayers[layerId], features[0].properties);
+                    }
+                });
+
+                $mapPopup.popover('destroy');
+                if (contentHtml) {
+                    $mapPopup.popover({
+                        'placement': 'top',
+                        'html': true,
+                        'content': '<div id="close-map-popup">X</div>' + contentHtml
+                    });
+                    mapPopup.setPosition(origCoords);
+                    $mapPopup.popover('show');
+
+                    $('#close-map-popup').one('click', function () {
+                        $mapPopup.popover('destroy');
+                    });
+                }
+            }
+        });
+    };
+
+    identifyFeaturesOnHover = function (evt) {
+        var layerIds;
+        var coords = evt.coordinate;
+
+        clearTimeout(hoverIdentifyTimeout);
+        if (evt.dragging || isGettingPixelVal) {
+            return;
+        }
+
+        layerIds = Object.keys(getVisibleVectorLayers());
+        if (layerIds.length === 0) {
+            map.getTargetElement().style.cursor = '';
+            return;
+        }
+
+        // Only ask once the pointer rests, so that moving across the map does not send a request per pixel
+        hoverIdentifyTimeout = setTimeout(function () {
+            // The same pixel tolerance as a click
+            var tolerance = 2.5 * map.getView().getResolution();
+
+            if (hoverIdentifyXhr) {
+                hoverIdentifyXhr.abort();
+            }
+            hoverIdentifyXhr = $.ajax({
+                type: 'GET',
+                url: '/apps/hydroshare-gis/identify-features',
+                data: {
+                    layerIds: layerIds.join(','),
+                    bbox: [coords[0] - tolerance, coords[1] - tolerance, coords[0] + tolerance, coords[1] + tolerance].join(',')
+                },
+                success: function (response) {
+                    var isOverFeature = response.success && layerIds.some(function (layerId) {
+                        return response.results[layerId] && response.results[layerId].length > 0;
+                    });
+
+                    map.getTargetElement().style.cursor = isOverFeature ? 'pointer' : '';
+                }
+            });
+        }, 250);
+    };
+
     initializeJqueryVariables = function () {
         $btnAddRes = $('#btn-upload-res');
         $btnAddFile = $('#btn-upload-file');
@@ -1965,7 +2298,7 @@
             data.res_title = resTitle;
         }
 
-        $.ajax({
+        ajaxWithJobPolling({
             type: 'GET',
             url: '/apps/hydroshare-gis/add-hs-res',
             dataType: 'json',
@@ -2008,18 +2341,16 @@
         });
     };
 
-    addGenericResFilesInLoop = function (resId, resFilesList, fileIndex, isLastFile){
+    addGenericResFilesInLoop = function (resId, resFilesList, fileIndexes, position) {
+        var fileIndex = fileIndexes[position];
         var resFileName = resFilesList[fileIndex];
-        var numFiles = resFilesList.length;
-        if (isLastFile === undefined) {
-            isLastFile = (fileIndex === numFiles - 1);
-        }
+        var isLastFile = (position === fileIndexes.length - 1);
         var data = {
             'res_id': resId,
             'res_fname': resFileName,
             'file_index': fileIndex
         };
-        $.ajax({
+        ajaxWithJobPolling({
             url: '/apps/hydroshare-gis/add-generic-res-file',
             type: 'GET',
             data: data,
@@ -2028,10 +2359,8 @@
             success: function (response) {
                 var message;
 
-                if (isLastFile) {
-                    isLastFile = true;
-                } else {
-                    addGenericResFilesInLoop(resId, resFilesList, fileIndex + 1);
+                if (!isLastFile) {
+                    addGenericResFilesInLoop(resId, resFilesList, fileIndexes, position + 1);
                 }
 
                 if (response.hasOwnProperty('success')) {
@@ -2076,7 +2405,7 @@
                 if (isLastFile) {
                     setStateAfterLastResource();
                 } else {
-                    addGenericResFilesInLoop(resId, resFilesList, fileIndex + 1);
+                    addGenericResFilesInLoop(resId, resFilesList, fileIndexes, position + 1);
                 }
             }
         });
@@ -2092,6 +2421,10 @@
             dataType: 'json',
             contentType: 'json',
             success: function (response) {
+                var resFilesList;
+                var fileIndexes = [];
+                var i;
+
                 if (response.hasOwnProperty('success')) {
                     if (!response.success) {
                         showLoadingCompleteStatus(false, response.message);
@@ -2099,20 +2432,49 @@
                     } else {
                         if (response.hasOwnProperty('results')) {
                             if (response.results.hasOwnProperty('generic_res_files_list')) {
-                                var resFilesList = response.results.generic_res_files_list;
-                                var index = 0;
+                                resFilesList = response.results.generic_res_files_list;
 
                                 if (typeof resFilesList === 'string') {
                                     resFilesList = resFilesList.split(',');
                                 }
 
-                                var isOnlyFile = (resFilesList.length === 1);
-
                                 if (resFileName) {
-                                    index = resFilesList.indexOf(resFileName);
-                                    isOnlyFile = true;
+                                    fileIndexes.push(resFilesList.indexOf(resFileName));
+                                } else {
+                                    for (i = 0; i < resFilesList.length; i += 1) {
+                                        fileIndexes.push(i);
+                                    }
                                 }
-                                addGenericResFilesInLoop(resId, resFilesList, index, isOnlyFile);
+
+                                // Files that already have layers are added in one go; only the others are loaded
+                                getCachedLayers([], fileIndexes.map(function (fileIndex) {
+                                    return {'res_id': resId, 'res_fname': resFilesList[fileIndex]};
+                                }), function (cachedResponse) {
+                                    var fileResults;
+                                    var cachedLayers = [];
+                                    var missingIndexes = fileIndexes;
+
+                                    if (cachedResponse) {
+                                        if (cachedResponse.denied.hasOwnProperty(resId)) {
+                                            showLoadingCompleteStatus(false, cachedResponse.denied[resId]);
+                                            hideMainLoadAnim();
+                                            return;
+                                        }
+                                        fileResults = cachedResponse.file_results[resId] || {};
+                                        missingIndexes = fileIndexes.filter(function (fileIndex) {
+                                            if (fileResults.hasOwnProperty(resFilesList[fileIndex])) {
+                                                cachedLayers.push(fileResults[resFilesList[fileIndex]]);
+                                                return false;
+                                            }
+                                            return true;
+                                        });
+                                    }
+
+                                    addCachedLayersToUI(cachedLayers, missingIndexes.length === 0);
+                                    if (missingIndexes.length > 0) {
+                                        addGenericResFilesInLoop(resId, resFilesList, missingIndexes, 0);
+                                    }
+                                });
                             }
                         }
                     }
@@ -2238,46 +2600,36 @@
         var clickedElement = e.trigger.context;
         var $lyrListItem = $(clickedElement).parent().parent();
         var lyrId = $lyrListItem.data('layer-id');
-        map.once('click', function (evt) {
+
+        // Keeps this click from also identifying the vector layers under it
+        isGettingPixelVal = true;
+        map.once('singleclick', function (evt) {
             var origCoords = evt.coordinate;
-            var minCoords = ol.proj.toLonLat(origCoords, 'EPSG:3857');
-            var maxCoords = ol.proj.toLonLat([origCoords[0] + 5, origCoords[1] + 5], 'EPSG:3857');
-            var params = {
-                'request': 'GetFeatureInfo',
-                'service': 'WMS',
-                'version': '1.1.1',
-                'layers': lyrId,
-                'srs': 'EPSG:4326',
-                'bbox': minCoords[0] + ',' + minCoords[1] + ',' + maxCoords[0] + ',' + maxCoords[1],
-                'width': 10,
-                'height': 10,
-                'query_layers': lyrId,
-                'info_format': 'application/json',
-                'x': 0,
-                'y': 0
-            };
 
+            isGettingPixelVal = false;
             $.ajax({
                 type: 'GET',
-                url: '/apps/hydroshare-gis/get-features-on-click',
+                url: '/apps/hydroshare-gis/identify-features',
                 data: {
-                    params: JSON.stringify(params)
+                    layerIds: lyrId,
+                    x: origCoords[0],
+                    y: origCoords[1],
+                    resolution: map.getView().getResolution()
                 },
                 success: function (response) {
-                    if (response.hasOwnProperty('features')) {
-                        if (response.features.length > 0) {
-                            $mapPopup.popover({
-                                'placement': 'top',
-                                'html': true,
-                                'content': '<div id="close-map-popup">X</div><p>' + response.features[0].properties.GRAY_INDEX + '</p>'
-                            });
-                            mapPopup.setPosition(origCoords);
-                            $mapPopup.popover('show');
+                    var features = response.success ? response.results[lyrId] : null;
+                    if (features && features.length > 0) {
+                        $mapPopup.popover({
+                            'placement': 'top',
+                            'html': true,
+                            'content': '<div id="close-map-popup">X</div><p>' + features[0].properties.GRAY_INDEX + '</p>'
+                        });
+                        mapPopup.setPosition(origCoords);
+                        $mapPopup.popover('show');
 
-                            $('#close-map-popup').one('click', function () {
-                                $mapPopup.popover('destroy');
-                            });
-                        }
+                        $('#close-map-popup').one('click', function () {
+                            $mapPopup.popover('destroy');
+                        });
                     }
                 }
             });
@@ -2488,18 +2840,11 @@
         var numResults = results.length;
         var result;
         var i;
-        var numAdditionalResources;
-        var resource;
-        var j;
-        for (i = 0; i < numResults; i += 1) {
-            if (additionalResources) {
-                numAdditionalResources = additionalResources.length;
-                for (j = 0; j < numAdditionalResources; j += 1) {
-                    resource = additionalResources[j];
-                    addNonGenericRes(resource.id, resource.type, resource.title, (j === numAdditionalResources - 1), null);
-                }
-            }
 
+        if (additionalResources && additionalResources.length > 0) {
+            addAdditionalResources(additionalResources);
+        }
+        for (i = 0; i < numResults; i += 1) {
             result = results[i];
 
             if (result.res_type === 'GenericResource') {
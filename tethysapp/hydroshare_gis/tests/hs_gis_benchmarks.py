@@ -0,0 +1,159 @@
+from django.shortcuts import render
+from tethysapp.hydroshare_gis.utilities import *
+from tempfile import mkdtemp
+from time import clock
+
+
+def Benchmark_Staging(request):
+    """
+    Compares the CPU spent preparing a GeoTIFF for GeoServer with the old DEFLATE zip and with the current staging mode
+    """
+    import numpy
+    from gdal import GetDriverByName
+    from gdalconst import GDT_Float32
+
+    benchmark_dir = mkdtemp()
+    try:
+        size = int(request.GET.get('size', 4096))
+        num_runs = int(request.GET.get('runs', 5))
+
+        tif_path = os.path.join(benchmark_dir, 'benchmark.tif')
+        dataset = GetDriverByName('GTiff').Create(tif_path, size, size, 1, GDT_Float32, ['COMPRESS=DEFLATE'])
+        x, y = numpy.meshgrid(numpy.arange(size), numpy.arange(size))
+        dataset.GetRasterBand(1).WriteArray(numpy.sin(x / 50.0) * numpy.cos(y / 50.0) * 1000)
+        dataset.FlushCache()
+        dataset = None
+
+        timings = {}
+        zip_sizes = {}
+        for label, compression in [('ZIP_DEFLATED', zipfile.ZIP_DEFLATED), ('ZIP_STORED', zipfile.ZIP_STORED)]:
+            zip_path = os.path.join(benchmark_dir, 'benchmark.zip')
+            cpu_seconds = []
+            for _ in range(num_runs):
+                start = clock()
+                zip_files(tif_path, zip_path, compression)
+                check_if_image_pyramid(zip_path)
+                cpu_seconds.append(clock() - start)
+                zip_sizes[label] = os.path.getsize(zip_path)
+                os.remove(zip_path)
+            timings[label] = sum(cpu_seconds) / len(cpu_seconds)
+
+        results = '''
+        STAGING BENCHMARK
+
+            GEOTIFF: {0} x {0} float32, {1}
+            RUNS: {2}
+            DEFLATE ZIP: {3:.3f} CPU seconds per upload, {4}
+            STORED ZIP: {5:.3f} CPU seconds per upload, {6}
+            CPU SAVED PER UPLOAD: {7:.3f} seconds
+        '''.format(
+            size,
+            sizeof_fmt(os.path.getsize(tif_path)),
+            num_runs,
+            timings['ZIP_DEFLATED'],
+            sizeof_fmt(zip_sizes['ZIP_DEFLATED']),
+            timings['ZIP_STORED'],
+            sizeof_fmt(zip_sizes['ZIP_STORED']),
+            timings['ZIP_DEFLATED'] - timings['ZIP_STORED']
+        )
+
+        print results
+        context = {'results': '<br>'.join(results.split('\n'))}
+        return render(request, 'hydroshare_gis/test-results.html', context)
+    finally:
+        shutil.rmtree(benchmark_dir)
+
+
+def Benchmark_WMS_Render(request):
+    """
+    Times zoomed-out WMS GetMap requests against the same raster uploaded to GeoServer as a striped, uncompressed
+    GeoTIFF and after normalize_raster
+    """
+    import numpy
+    from gdal import GetDriverByName
+    from gdalconst import GDT_Float32
+
+    benchmark_dir = mkdtemp()
+    engine = return_spatial_dataset_engine()
+    store_ids = []
+    staged_names = []
+    try:
+        size = int(request.GET.get('size', 8192))
+        num_runs = int(request.GET.get('runs', 10))
+
+        striped_path = os.path.join(benchmark_dir, 'striped.tif')
+        dataset = GetDriverByName('GTiff').Create(striped_path, size, size, 1, GDT_Float32)
+        dataset.SetGeoTransform([-11000000, 100, 0, 5000000, 0, -100])
+        dataset.SetProjection(get_canonical_wkt('3857'))
+        for y_off in range(0, size, 1024):
+            x, y = numpy.meshgrid(numpy.arange(size), numpy.arange(y_off, min(y_off + 1024, size)))
+            dataset.GetRasterBand(1).WriteArray(numpy.sin(x / 50.0) * numpy.cos(y / 50.0) * 1000, 0, y_off)
+        dataset.FlushCache()
+        dataset = None
+
+        cog_dir = os.path.join(benchmark_dir, 'cog')
+        os.mkdir(cog_dir)
+        cog_path = os.path.join(cog_dir, 'cog.tif')
+        shutil.copyfile(striped_path, cog_path)
+        raster_profile, raster_conversion = normalize_raster(RasterProfile(cog_path))
+
+        timings = {}
+        for label, fpath in [('STRIPED', striped_path), ('COG', cog_path)]:
+            res_id = 'benchmark_%s' % label.lower()
+            staged_path = stage_raster_for_geoserver(fpath)
+            staged_names.append(os.path.basename(staged_path))
+            r = upload_file_to_geoserver(res_id, 'RasterResource', staged_path, is_image_pyramid=False)
+            store_ids.append('%s:%s' % (get_workspace(), r['results']['store_id']))
+            params = {
+                'service': 'WMS',
+                'version': '1.1.1',
+                'request': 'GetMap',
+                'layers': r['results']['layer_id'],
+                'styles': '',
+                'srs': 'EPSG:3857',
+                'bbox': '-11000000,%s,%s,5000000' % (5000000 - size * 100, -11000000 + size * 100),
+                'width': 512,
+                'height': 512,
+                'format': 'image/png'
+            }
+            seconds = []
+            for _ in range(num_runs):
+                start = time()
+                make_geoserver_request('wms', params)
+                seconds.append(time() - start)
+            timings[label] = sum(seconds) / len(seconds)
+        connection_stats = get_geoserver_connection_stats()
+
+        results = '''
+        WMS RENDER BENCHMARK
+
+            RASTER: {0} x {0} float32, {1} uncompressed
+            CONVERSION: {2}, {3}
+            RUNS: {4} zoomed-out 512 x 512 GetMap requests
+            STRIPED GEOTIFF: {5:.3f} seconds per request
+            NORMALIZED: {6:.3f} seconds per request
+            SPEEDUP: {7:.1f}x
+            GEOSERVER CONNECTIONS: {8} requests, {9} connections opened, {10} reused
+        '''.format(
+            size,
+            sizeof_fmt(os.path.getsize(striped_path)),
+            raster_conversion,
+            sizeof_fmt(os.path.getsize(cog_path)),
+            num_runs,
+            timings['STRIPED'],
+            timings['COG'],
+            timings['STRIPED'] / timings['COG'],
+            connection_stats['requests'],
+            connection_stats['connections_opened'],
+            connection_stats['connections_reused']
+        )
+
+        print results
+        context = {'results': '<br>'.join(results.split('\n'))}
+        return render(request, 'hydroshare_gis/test-results.html', context)
+    finally:
+        for store_id in store_ids:
+            engine.delete_store(store_id, purge=True, recurse=True, debug=get_debug_val())
+        for staged_name in staged_names:
+            remove_staged_raster(staged_name)
+        shutil.rmtree(benchmark_dir)
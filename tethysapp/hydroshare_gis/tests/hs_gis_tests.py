@@ -40,9 +40,9 @@ def Test_All_Resources(request):
                         if response['success']:
                             res_files_list = response['results']['generic_res_files_list']
                             num_files_failed = 0
-                            for i, res_file in enumerate(res_files_list):
-                                response = process_generic_res_file(hs, res_id, res_file,
-                                                                    request.user.username, i)
+                            responses = process_generic_res_files(hs, res_id, res_files_list,
+                                                                  request.user.username)
+                            for res_file, response in zip(res_files_list, responses):
                                 if response['success']:
                                     pass
                                 else:
@@ -1,37 +1,219 @@
 from django.http import JsonResponse
 from django.core.files.uploadedfile import UploadedFile
+from django.core.serializers.json import DjangoJSONEncoder
 from tethys_sdk.services import get_spatial_dataset_engine
 from tethys_services.backends.hs_restclient_helper import get_oauth_hs
-from model import Layer
+from model import Layer, CrsCacheEntry, Job, IngestFlight, ResourceFreshness, StagingReservation, ProjectIndex, \
+    ResourceListCache
 
 import hs_restclient as hs_r
 import requests
+import csv
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import atexit
 import zipfile
 import os
+import re
+import shutil
 import sqlite3
 import xmltodict
-from datetime import datetime
+from datetime import datetime, timedelta
+from hashlib import sha1
 from tempfile import TemporaryFile
 from json import dumps, loads
 from inspect import getfile, currentframe
 from sys import exc_info
 from traceback import format_exception
 from socket import gethostname
-from subprocess import check_output
 from mimetypes import guess_type
+from uuid import uuid4
+from urllib import unquote
+from urlparse import urlparse
+from time import sleep, time
 from logging import getLogger
+from math import floor, log
+from random import random
+from threading import BoundedSemaphore, Lock, Thread, local
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+
+class BoundedTtlCache(object):
+    """
+    Thread-safe in-memory cache whose entries expire after a TTL, or at the time given when they are added. Once it
+    holds max_entries, adding a new key drops the expired entries, then the oldest tenth if it is still full.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl.total_seconds()
+        self._entries = {}
+        self._lock = Lock()
+
+    def get(self, key, allow_expired=False):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or (not allow_expired and entry[1] <= time()):
+            return None
+
+        return entry[0]
+
+    def set(self, key, value, expires=None):
+        now = time()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                for expired_key in [k for k, entry in self._entries.items() if entry[1] <= now]:
+                    del self._entries[expired_key]
+                if len(self._entries) >= self.max_entries:
+                    oldest_keys = sorted(self._entries, key=lambda k: self._entries[k][1])
+                    for oldest_key in oldest_keys[:len(oldest_keys) // 10 + 1]:
+                        del self._entries[oldest_key]
+            self._entries[key] = (value, now + self.ttl_seconds if expires is None else expires)
 
 
 logger = getLogger('django')
 workspace_id = None
 spatial_dataset_engine = None
 currently_testing = False
+crs_index = None
+crs_resolution_memo = {}
+crs_cache_stats = {
+    'hits': 0,
+    'misses': 0
+}
+crs_cache_stats_lock = Lock()
+CRS_CACHE_MAX_ENTRIES = 5000
+CRS_CACHE_TTL = timedelta(days=30)
+# Share of cache misses that also prune expired and least recently used entries
+CRS_CACHE_PRUNE_PROBABILITY = 0.01
+
+# Concurrency limits of the ingestion pipeline, per worker process
+INGEST_POOL_SIZE = 6
+HS_DOWNLOAD_CONCURRENCY = 4
+GEOSERVER_UPLOAD_CONCURRENCY = 2
+GDAL_CONCURRENCY = cpu_count()
+hs_download_slots = BoundedSemaphore(HS_DOWNLOAD_CONCURRENCY)
+geoserver_upload_slots = BoundedSemaphore(GEOSERVER_UPLOAD_CONCURRENCY)
+gdal_slots = BoundedSemaphore(GDAL_CONCURRENCY)
+
+# Background jobs run on threads of the web worker process that received the request, because they use that
+# process's HydroShare client. That process refreshes its jobs every HEARTBEAT_INTERVAL (see send_heartbeats), so a
+# job that has not been refreshed for JOB_STALE_AFTER was lost along with its process.
+# Operational limits of running jobs in the web workers:
+# - Recycling a uWSGI/gunicorn worker (max-requests, reloads, deploys) ends the jobs it had queued or running. Those
+#   still tracked at a clean exit are marked failed right away (see stop_jobs); a killed worker's jobs are only
+#   reported once they go stale.
+# - Downloading, GDAL and zip work compete with the worker's request threads for its CPU and memory. Size
+#   JOB_WORKERS and GDAL_CONCURRENCY, and the number of web workers, with that in mind.
+JOB_WORKERS = 2
+JOB_STALE_AFTER = timedelta(minutes=3)
+JOB_MAX_AGE = timedelta(days=1)
+JOB_CLEANUP_INTERVAL = timedelta(hours=1)
+HEARTBEAT_INTERVAL = 30
+job_pool = None
+job_pool_lock = Lock()
+jobs_are_stopping = False
+active_job_ids = set()
+job_context = local()  # job_id and report_stage of the job running on the current thread, if any
+heartbeat_thread = None
+heartbeat_lock = Lock()
+
+# Concurrent requests to load the same resource wait for the first one (see run_single_flight). The leader's process
+# refreshes the flight's heartbeat every HEARTBEAT_INTERVAL, so a flight that has not been refreshed for
+# INGEST_FLIGHT_STALE_AFTER lost its leader.
+INGEST_FLIGHT_STALE_AFTER = timedelta(minutes=3)
+INGEST_FLIGHT_RESULT_TTL = timedelta(seconds=30)
+INGEST_FLIGHT_POLL_INTERVAL = 1
+INGEST_FLIGHT_MAX_POLL_INTERVAL = 5
+active_flight_keys = set()
+
+# Parsed science metadata of resources, shared by the requests of a worker process (see get_res_metadata)
+RES_METADATA_TTL = timedelta(seconds=60)
+RES_METADATA_CACHE_MAX_ENTRIES = 500
+res_metadata_cache = BoundedTtlCache(RES_METADATA_CACHE_MAX_ENTRIES, RES_METADATA_TTL)
+res_file_sizes_cache = BoundedTtlCache(RES_METADATA_CACHE_MAX_ENTRIES, RES_METADATA_TTL)
+
+# A resource's modification date is checked against HydroShare at most once per window (see get_res_mod_date)
+RES_FRESHNESS_WINDOW = timedelta(seconds=60)
+
+# Byte budgets for files downloaded into /tmp/hs_gis_files (see reserve_staging_bytes)
+MAX_REQUEST_BYTES = 1024 ** 3
+MAX_STAGED_BYTES = 8 * 1024 ** 3
+STAGING_QUEUE_TIMEOUT = 300
+STAGING_QUEUE_POLL_INTERVAL = 2
+STAGING_RESERVATION_TTL = timedelta(hours=2)
+
+# Rasters are already compressed, so they are handed to GeoServer in zips without compression. If GeoServer can read
+# GEOSERVER_SHARED_DATA_DIR under the same path, rasters are put there and registered by path instead of uploaded.
+GEOSERVER_STAGING_COMPRESSION = zipfile.ZIP_STORED
+GEOSERVER_SHARED_DATA_DIR = None
+
+# Resources made of several rasters are served either as an 'imagepyramid' of tiles or as a single 'cog'
+# (Cloud-Optimized GeoTIFF with internal overviews)
+MULTI_FILE_RASTER_FORMAT = 'imagepyramid'
+PYRAMID_TILE_SIZE = 2048
+PYRAMID_MAX_LEVELS = 9
+
+# Rasters that are not tiled with overviews are rewritten as Cloud-Optimized GeoTIFFs before GeoServer gets them
+NORMALIZE_RASTERS_TO_COG = True
+
+# Requests this app makes to GeoServer directly (not through the spatial dataset engine) share one keep-alive
+# session per process (see get_geoserver_session)
+GEOSERVER_POOL_SIZE = 10
+GEOSERVER_TIMEOUT = (5, 120)  # (connect, read) seconds
+GEOSERVER_RETRIES = 3
+GEOSERVER_RETRY_BACKOFF = 0.5
+geoserver_session = None
+geoserver_session_pid = None
+geoserver_session_lock = Lock()
+
+# HydroShare clients, reused across the requests of a user for as long as their OAuth token stays the same
+# (see get_hs_auth_obj)
+HS_CLIENT_TTL = timedelta(minutes=30)
+HS_CLIENT_CACHE_MAX_ENTRIES = 200
+hs_client_cache = BoundedTtlCache(HS_CLIENT_CACHE_MAX_ENTRIES, HS_CLIENT_TTL)
+
+# Each user's list of map projects, for the add-to-project page (see get_user_projects)
+PROJECT_INDEX_TTL = timedelta(minutes=10)
+PROJECT_SCAN_CONCURRENCY = 8
+
+# The resource list is cached in a public partition shared by all users and a partition per user (see iter_hs_res_list)
+RES_LIST_TTL = timedelta(minutes=5)
+RES_LIST_PAGE_SIZE = 100
+RES_LIST_MAX_PAGE_SIZE = 1000
+VALID_RES_LIST_TYPES = [
+    'GenericResource', 'GeographicFeatureResource', 'RasterResource', 'RefTimeSeriesResource', 'TimeSeriesResource',
+    'ScriptResource', 'CompositeResource'
+]
+
+# Map clicks are identified against GeoServer in parallel over a thread pool shared by all requests, and the features
+# found are cached per layer, zoom level and map pixel (see identify_features)
+FEATURE_INFO_TTL = timedelta(seconds=60)
+FEATURE_INFO_CACHE_MAX_ENTRIES = 5000
+FEATURE_INFO_CONCURRENCY = 4
+FEATURE_INFO_PIXEL_TOLERANCE = 2
+FEATURE_INFO_MAX_FEATURES = 10
+WEB_MERCATOR_ZOOM_0_RESOLUTION = 156543.03392804097
+feature_info_cache = BoundedTtlCache(FEATURE_INFO_CACHE_MAX_ENTRIES, FEATURE_INFO_TTL)
+feature_info_pool = None
+feature_info_pool_lock = Lock()
+
+# Attribute tables are read from GeoServer a page at a time (see generate_attribute_table)
+ATTRIBUTE_TABLE_MAX_COUNT = 1000
+CQL_OPERATORS = ['=', '<>', '<', '<=', '>', '>=', 'LIKE', 'ILIKE']
+ATTRIBUTE_EXPORT_PAGE_SIZE = 5000
+
+# Attributes and geometries of vector layers are copied into a SQLite file per layer at ingest
+# (see build_attribute_cache)
+ATTRIBUTE_CACHE_BATCH_SIZE = 10000
+# Cache files are named after the layer id, so only ids of the form "workspace:layer" are accepted
+LAYER_ID_PATTERN = re.compile(r'[\w-]+:[\w-]+\Z')
 
 def get_json_response(response_type, message):
     return JsonResponse({response_type: message})
 
 
-def upload_file_to_geoserver(res_id, res_type, res_file, file_index=None):
+def upload_file_to_geoserver(res_id, res_type, res_file, file_index=None, is_image_pyramid=None):
     return_obj = {
         'success': False,
         'message': None,
@@ -50,33 +232,21 @@ def upload_file_to_geoserver(res_id, res_type, res_file, file_index=None):
 
     try:
         if res_type == 'RasterResource':
-            is_image_pyramid = check_if_image_pyramid(res_file)
+            if is_image_pyramid is None:
+                is_image_pyramid = check_if_image_pyramid(res_file) if is_zip else os.path.isdir(res_file)
             coverage_type = 'imagepyramid' if is_image_pyramid else 'geotiff'
             coverage_name = store_id if is_zip else None
 
-            # Creates a resource from a file stored directly on the GeoServer
-            # from requests import auth
-            # url = '{0}/rest/workspaces/{1}/coveragestores/{2}/external.{3}'.format(get_geoserver_url(), get_workspace(), res_id,
-            #                                                               coverage_type)
-            # data = 'file:///var/lib/geoserver/data/data/{workspace}/test/utah_ned301.tif'.format(workspace=get_workspace())
-            #
-            # headers = {
-            #     "Content-type": 'text/plain'
-            # }
-            #
-            # r = requests.put(url=url,
-            #         files=None,
-            #         data=data,
-            #         headers=headers,
-            #         auth=auth.HTTPBasicAuth(username=get_geoserver_credentials()[0],
-            #                            password=get_geoserver_credentials()[1]))
-
-            response = engine.create_coverage_resource(store_id=full_store_id,
-                                                       coverage_file=res_file,
-                                                       coverage_type=coverage_type,
-                                                       coverage_name=coverage_name,
-                                                       overwrite=True,
-                                                       debug=get_debug_val())
+            if GEOSERVER_SHARED_DATA_DIR and not is_zip:
+                # The file was staged in the data directory GeoServer shares with this app
+                response = register_external_coverage(store_id, coverage_type, res_file)
+            else:
+                response = engine.create_coverage_resource(store_id=full_store_id,
+                                                           coverage_file=res_file,
+                                                           coverage_type=coverage_type,
+                                                           coverage_name=coverage_name,
+                                                           overwrite=True,
+                                                           debug=get_debug_val())
 
         elif res_type == 'GeographicFeatureResource':
             if is_zip:
@@ -104,7 +274,8 @@ def upload_file_to_geoserver(res_id, res_type, res_file, file_index=None):
                     if not result['success']:
                         raise Exception
                     else:
-                        return_obj = upload_file_to_geoserver(res_id, res_type, res_file, file_index)
+                        return_obj = upload_file_to_geoserver(res_id, res_type, res_file, file_index,
+                                                              is_image_pyramid)
                 except Exception as e:
                     e.message = response['error']
                     raise
@@ -126,12 +297,81 @@ def upload_file_to_geoserver(res_id, res_type, res_file, file_index=None):
         engine.create_workspace(workspace_id=get_workspace(),
                                 uri='tethys_app-%s' % get_workspace(),
                                 debug=get_debug_val())
-        return_obj = upload_file_to_geoserver(res_id, res_type, res_file, file_index)
+        return_obj = upload_file_to_geoserver(res_id, res_type, res_file, file_index, is_image_pyramid)
 
     return return_obj
 
 
-def zip_files(res_files, zip_path):
+def register_external_coverage(store_id, coverage_type, fpath):
+    """
+    Creates a coverage store from a GeoTIFF or image pyramid that GeoServer can read from its own file system.
+    :return: a response in the form returned by the spatial dataset engine
+    """
+    engine = return_spatial_dataset_engine()
+    url = '{0}/workspaces/{1}/coveragestores/{2}/external.{3}'.format(engine.endpoint.rstrip('/'), get_workspace(),
+                                                                       store_id, coverage_type)
+    r = geoserver_request('put', url,
+                          params={'configure': 'first', 'coverageName': store_id},
+                          data='file://%s' % fpath,
+                          headers={'Content-type': 'text/plain'})
+
+    if r.status_code in [200, 201]:
+        return {'success': True, 'result': {'name': store_id}}
+    else:
+        return {'success': False, 'error': r.text}
+
+
+def stage_raster_for_geoserver(fpath):
+    """
+    Prepares a GeoTIFF, or a directory made by gdal_retile, for upload_file_to_geoserver.
+    :return: the path to pass to upload_file_to_geoserver
+    """
+    is_dir = os.path.isdir(fpath)
+    if GEOSERVER_SHARED_DATA_DIR:
+        staged_path = os.path.join(GEOSERVER_SHARED_DATA_DIR, get_workspace(), os.path.basename(fpath.rstrip('/')))
+        if not os.path.exists(os.path.dirname(staged_path)):
+            os.makedirs(os.path.dirname(staged_path))
+        if os.path.isdir(staged_path):
+            shutil.rmtree(staged_path)
+        elif os.path.exists(staged_path):
+            os.remove(staged_path)
+
+        if is_dir:
+            shutil.move(fpath, staged_path)
+        else:
+            # The temp copy is still read for band statistics
+            try:
+                os.link(fpath, staged_path)
+            except OSError:
+                shutil.copyfile(fpath, staged_path)
+    else:
+        staged_path = '%s.zip' % os.path.splitext(fpath.rstrip('/'))[0]
+        if is_dir:
+            zip_folder(fpath, staged_path, GEOSERVER_STAGING_COMPRESSION)
+        else:
+            zip_files(fpath, staged_path, GEOSERVER_STAGING_COMPRESSION)
+
+    return staged_path
+
+
+def remove_staged_raster(staged_name):
+    """
+    Removes a raster that stage_raster_for_geoserver put in GEOSERVER_SHARED_DATA_DIR, once GeoServer no longer serves
+    it. Rasters are staged under the name of their store, as a GeoTIFF or as the directory of an image pyramid.
+    :param staged_name: the file or directory name the raster was staged under, with or without ".tif"
+    """
+    if not GEOSERVER_SHARED_DATA_DIR:
+        return
+
+    staged_path = os.path.join(GEOSERVER_SHARED_DATA_DIR, get_workspace(), staged_name)
+    for path in set([staged_path, '%s.tif' % os.path.splitext(staged_path)[0]]):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def zip_files(res_files, zip_path, compression=zipfile.ZIP_DEFLATED):
     return_obj = {
         'success': False
     }
@@ -140,12 +380,16 @@ def zip_files(res_files, zip_path):
         if not os.path.exists(os.path.dirname(zip_path)):
             os.mkdir(os.path.dirname(zip_path))
 
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, False) as zip_object:
+    with gdal_slots, zipfile.ZipFile(zip_path, 'w', compression, False) as zip_object:
         if type(res_files) is list:
             for f in res_files:
                 zip_object.write(f, os.path.basename(f))
         elif isinstance(res_files, UploadedFile):
-            zip_object.writestr(os.path.basename(res_files), res_files.read())
+            if hasattr(res_files, 'temporary_file_path'):
+                zip_object.write(res_files.temporary_file_path(), os.path.basename(res_files.name))
+            else:
+                # In-memory uploads are no larger than FILE_UPLOAD_MAX_MEMORY_SIZE
+                zip_object.writestr(os.path.basename(res_files.name), ''.join(res_files.chunks()))
         else:
             zip_object.write(res_files, os.path.basename(res_files))
         zip_object.close()
@@ -155,6 +399,37 @@ def zip_files(res_files, zip_path):
     return return_obj
 
 
+def save_uploaded_file(uploaded_file, dst_path):
+    """
+    Writes a Django UploadedFile to dst_path without reading it into memory. Uploads that Django already spooled to
+    disk are hard-linked into place when possible; all others are copied chunk by chunk.
+    :return: return_obj with the number of bytes, and the sha1 of the file if it was copied (None if it was linked,
+    since hashing would mean reading the whole file again)
+    """
+    return_obj = {
+        'num_bytes': 0,
+        'sha1': None
+    }
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        try:
+            os.link(uploaded_file.temporary_file_path(), dst_path)
+            return_obj['num_bytes'] = os.path.getsize(dst_path)
+            return return_obj
+        except OSError:
+            pass
+
+    checksum = sha1()
+    with open(dst_path, 'wb') as f_local:
+        for chunk in uploaded_file.chunks():
+            f_local.write(chunk)
+            checksum.update(chunk)
+            return_obj['num_bytes'] += len(chunk)
+    return_obj['sha1'] = checksum.hexdigest()
+
+    return return_obj
+
+
 def return_spatial_dataset_engine():
     global spatial_dataset_engine
     if spatial_dataset_engine is None:
@@ -186,7 +461,7 @@ def get_layer_md_from_geoserver(store_id, layer_name, res_type):
                                                                                      store_id,
                                                                                      layer_name)
 
-    r = requests.get(url, auth=get_geoserver_credentials())
+    r = geoserver_request('get', url)
     if r.status_code != 200:
         response_obj['message'] = 'The Geoserver appears to be down.'
     else:
@@ -264,26 +539,7 @@ def extract_site_info_from_time_series(sqlite_fpath):
 def extract_site_info_from_hs_metadata(hs, res_id):
     site_info = None
     try:
-        md_dict = xmltodict.parse(hs.getScienceMetadataRDF(res_id))
-        if len(md_dict['rdf:RDF']['rdf:Description'][0]['dc:coverage']) == 1:
-            site_info_list = md_dict['rdf:RDF']['rdf:Description'][0]['dc:coverage']['dcterms:point']['rdf:value'].split(';')
-        else:
-            site_info_list = md_dict['rdf:RDF']['rdf:Description'][0]['dc:coverage'][0]['dcterms:point']['rdf:value'].split(';')
-        lon = None
-        lat = None
-        projection = None
-        for item in site_info_list:
-            if 'north' in item:
-                lat = float(item.split('=')[1])
-            elif 'east' in item:
-                lon = float(item.split('=')[1])
-            elif 'projection' in item:
-                projection = item.split('=')[1]
-        site_info = {
-            'lon': lon,
-            'lat': lat,
-            'projection': projection
-        }
+        site_info = get_res_metadata(hs, res_id).site_info
     except KeyError:
         pass
     except hs_r.HydroShareNotFound:
@@ -305,37 +561,71 @@ def sizeof_fmt(num, suffix='B'):
 def make_geoserver_request(web_service, params):
     geoserver_url = get_geoserver_url() + '/%s' % web_service
 
-    r = requests.get(geoserver_url, params=params, auth=get_geoserver_credentials())
+    r = geoserver_request('get', geoserver_url, params=params)
 
     return r
 
 
-def get_band_info(hs, res_id, res_type, raster_fpath=None):
+def get_geoserver_session():
+    """
+    Returns this process's requests.Session for GeoServer: authenticated once with the engine's credentials, keeping
+    up to GEOSERVER_POOL_SIZE connections alive, and retrying failed connections and gateway errors with backoff.
+    """
+    global geoserver_session, geoserver_session_pid
+    with geoserver_session_lock:
+        if geoserver_session is None or geoserver_session_pid != os.getpid():
+            session = requests.Session()
+            session.auth = get_geoserver_credentials()
+            retry = Retry(total=GEOSERVER_RETRIES,
+                          backoff_factor=GEOSERVER_RETRY_BACKOFF,
+                          status_forcelist=[502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEOSERVER_POOL_SIZE, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            geoserver_session = session
+            geoserver_session_pid = os.getpid()
+
+    return geoserver_session
+
+
+def geoserver_request(method, url, **kwargs):
+    kwargs.setdefault('timeout', GEOSERVER_TIMEOUT)
+
+    return get_geoserver_session().request(method, url, **kwargs)
+
+
+def get_geoserver_connection_stats():
+    """
+    Counts requests and opened connections across the connection pools of the GeoServer session
+    """
+    stats = {
+        'requests': 0,
+        'connections_opened': 0,
+        'connections_reused': 0
+    }
+    session = get_geoserver_session()
+    adapter = session.get_adapter(get_geoserver_url())
+    for key in adapter.poolmanager.pools.keys():
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is not None:
+            stats['requests'] += pool.num_requests
+            stats['connections_opened'] += pool.num_connections
+    stats['connections_reused'] = max(0, stats['requests'] - stats['connections_opened'])
+
+    return stats
+
+
+def get_band_info(hs, res_id, res_type, raster_profile=None):
     band_info = None
     if res_type == 'RasterResource':
         try:
-            md_dict = xmltodict.parse(hs.getScienceMetadataRDF(res_id))
-            band_info_raw = md_dict['rdf:RDF']['rdf:Description'][0]['hsterms:BandInformation']['rdf:Description']
-            band_info = {}
-            if 'hsterms:minimumValue' in band_info_raw:
-                band_info['min'] = float(band_info_raw['hsterms:minimumValue'])
-            if 'hsterms:maximumValue' in band_info_raw:
-                band_info['max'] = float(band_info_raw['hsterms:maximumValue'])
-            if 'hsterms:noDataValue' in band_info_raw:
-                band_info['nd'] = float(band_info_raw['hsterms:noDataValue'])
-            if 'hsterms:variableName' in band_info_raw:
-                band_info['variable'] = str(band_info_raw['hsterms:variableName'])
-            if 'hsterms:variableUnit' in band_info_raw:
-                band_info['units'] = str(band_info_raw['hsterms:variableUnit'])
-
-        except KeyError:
-            pass
+            band_info = get_res_metadata(hs, res_id).band_info
         except Exception as e:
             logger.error('Unexpected, though not fatal, error occurred in get_band_info while processing res: %s' % res_id)
             logger.error(str(e))
 
-        if band_info is None and raster_fpath and os.path.exists(raster_fpath):
-            band_info = extract_band_info_from_file(raster_fpath)
+        if band_info is None and raster_profile is not None:
+            band_info = raster_profile.get_band_info()
 
     return band_info
 
@@ -363,8 +653,9 @@ def process_local_file(file_list, proj_id, hs, res_type, username, flag_create_r
         f_name = f.name
         f_path = os.path.join(hs_tempdir, f_name)
 
-        with open(f_path, 'wb') as f_local:
-            f_local.write(f.read())
+        r = save_uploaded_file(f, f_path)
+        logger.info('Saved upload %s (%s%s)' % (f_name, sizeof_fmt(r['num_bytes']),
+                                                ', sha1 %s' % r['sha1'] if r['sha1'] else ', linked'))
 
         if not flag_create_resources:
             add_file_to_res(hs, proj_id, f_path)
@@ -419,7 +710,7 @@ def process_nongeneric_res(hs, res_id, res_type=None, res_title=None, username=N
     }
 
     results = return_obj['results']
-    hs_tempdir = get_hs_tempdir(username)
+    hs_tempdir = make_staging_dir()
 
     try:
         if res_type is None or res_title is None:
@@ -430,6 +721,7 @@ def process_nongeneric_res(hs, res_id, res_type=None, res_title=None, username=N
         response = process_res_by_type(hs, res_id, res_type, hs_tempdir)
         return_obj['message'] = response['message']
         if response['success']:
+            res_mod_date = get_res_mod_date(hs, res_id)
             for r in response['results']:
                 result = {
                     'res_id': res_id,
@@ -443,7 +735,8 @@ def process_nongeneric_res(hs, res_id, res_type=None, res_title=None, username=N
                     'site_info': r['site_info'] if 'site_info' in r else None,
                     'project_info': r['project_info'] if 'project_info' in r else None,
                     'public_fname': r['public_fname'] if 'public_fname' in r else None,
-                    'res_mod_date': get_res_mod_date(hs, res_id)
+                    'res_mod_date': res_mod_date,
+                    'raster_conversion': r['raster_conversion'] if 'raster_conversion' in r else None
                 }
                 results.append(result)
 
@@ -472,39 +765,187 @@ def process_nongeneric_res(hs, res_id, res_type=None, res_title=None, username=N
                     host=gethostname(), id=res_id, type=res_type, name=user_info['username'], email=user_info['email'])
                 email_admin('Error Report', traceback=exc_info(), custom_msg=msg)
     finally:
-        os.system('rm -rf %s' % hs_tempdir)
+        remove_hs_tempdir(hs_tempdir)
 
     return return_obj
 
 
-def download_res_from_hs(hs, res_id, tempdir):
+def download_res_from_hs(hs, res_id, tempdir, res_type=None):
+    """
+    Downloads the content files of a resource that are needed to display it, one request per file and several files
+    at a time, instead of downloading and unzipping the whole bag. Files are streamed straight to their final names:
+    the files of a shapefile and the single .tif of a raster are named after the resource's GeoServer store.
+    :param hs: hs_restclient.HydroShare object
+    :param res_id: the resource id
+    :param tempdir: directory to download into
+    :param res_type: the resource type, which decides which files are needed. All files are downloaded if None.
+    :return: return_obj with the directory the files were written to
+    """
     return_obj = {
         'success': False,
         'message': None,
-        'res_contents_path': None
+        'res_contents_path': None,
+        'bytes_downloaded': 0,
+        'bytes_per_sec': None
     }
-    TOO_BIG_PREFIXES = ['G', 'T', 'P', 'E', 'Z']
-    is_too_big = False
-    res_size = 0
+
+    res_files = []
     for res_file in hs.getResourceFileList(res_id):
-        res_size += res_file['size']
+        fname = get_res_file_path(res_file)
+        ext = os.path.splitext(fname)[1].lower()
+        if res_type == 'GeographicFeatureResource' and ext not in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
+            continue
+        elif res_type == 'RasterResource' and ext not in ['.tif', '.vrt']:
+            continue
+        res_files.append((fname, ext, res_file['size']))
+
+    res_size = sum(size for _, _, size in res_files)
+    r = reserve_staging_bytes(res_size, os.path.join(tempdir, res_id))
+
+    if r['success']:
+        res_contents_path = os.path.join(tempdir, res_id, 'contents')
+        if not os.path.exists(res_contents_path):
+            os.makedirs(res_contents_path)
+
+        num_tifs = len([ext for _, ext, _ in res_files if ext == '.tif'])
+        downloads = []
+        for fname, ext, _ in res_files:
+            dst_fname = os.path.basename(fname)
+            if res_type == 'GeographicFeatureResource' or (res_type == 'RasterResource' and ext == '.tif' and
+                                                           num_tifs == 1):
+                dst_fname = '{name}{ext}'.format(name=get_geoserver_store_id(res_id), ext=ext)
+            downloads.append((fname, os.path.join(res_contents_path, dst_fname)))
+
+        start = time()
+        if downloads:
+            pool = ThreadPool(min(HS_DOWNLOAD_CONCURRENCY, len(downloads)))
+            try:
+                bytes_downloaded = sum(pool.map(lambda args: stream_res_file(hs, res_id, *args), downloads))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            bytes_downloaded = 0
+        elapsed = time() - start
 
-    for prefix in TOO_BIG_PREFIXES:
-        if prefix in sizeof_fmt(res_size):
-            is_too_big = True
-            break
+        return_obj['bytes_downloaded'] = bytes_downloaded
+        return_obj['bytes_per_sec'] = bytes_downloaded / elapsed if elapsed else None
+        logger.info('Downloaded %s in %d files of resource %s at %s/s' % (
+            sizeof_fmt(bytes_downloaded), len(downloads), res_id,
+            sizeof_fmt(return_obj['bytes_per_sec']) if return_obj['bytes_per_sec'] else 'N/A'))
 
-    if not is_too_big:
-        hs.getResource(res_id, destination=tempdir, unzip=True)
-        res_contents_path = os.path.join(tempdir, res_id, res_id, 'data', 'contents')
         return_obj['res_contents_path'] = res_contents_path
         return_obj['success'] = True
     else:
+        return_obj['message'] = r['message']
+
+    return return_obj
+
+
+def reserve_staging_bytes(num_bytes, staging_path):
+    """
+    Admission control for downloads into the temp directory. A request may stage at most MAX_REQUEST_BYTES, and all
+    worker processes together at most MAX_STAGED_BYTES. A background job that does not fit within the global budget
+    waits in a first-come, first-served queue for up to STAGING_QUEUE_TIMEOUT seconds; a web request is turned away
+    right away rather than holding its thread. The reservation is released when staging_path (or a directory
+    containing it) is removed with remove_hs_tempdir.
+    :param num_bytes: number of bytes about to be downloaded
+    :param staging_path: directory the bytes will be written to
+    :return: return_obj with the reservation id
+    """
+    return_obj = {
+        'success': False,
+        'message': None,
+        'reservation_id': None
+    }
+
+    if num_bytes > MAX_REQUEST_BYTES:
         return_obj['message'] = 'This resource is too large to open in HydroShare GIS.'
+        return return_obj
+
+    reservation_id = str(uuid4())
+    StagingReservation.add_reservation(reservation_id, staging_path, num_bytes)
+    is_job = getattr(job_context, 'job_id', None) is not None
+    deadline = time() + (STAGING_QUEUE_TIMEOUT if is_job else 0)
+    while not StagingReservation.try_to_admit(reservation_id, MAX_STAGED_BYTES, STAGING_RESERVATION_TTL):
+        if time() >= deadline:
+            StagingReservation.remove_reservation(reservation_id)
+            return_obj['message'] = 'HydroShare GIS is currently busy loading other large resources. ' \
+                                    'Please try again in a few minutes.'
+            return return_obj
+        logger.info('Staging of %s queued. Staging metrics: %s' % (sizeof_fmt(num_bytes), get_staging_metrics()))
+        if job_context.report_stage:
+            job_context.report_stage('Waiting for other large resources to finish loading')
+        sleep(STAGING_QUEUE_POLL_INTERVAL)
+
+    return_obj['reservation_id'] = reservation_id
+    return_obj['success'] = True
 
     return return_obj
 
 
+def reserve_res_file_bytes(hs, res_id, res_file_names, staging_path):
+    """
+    Reserves staging bytes for single files of a resource, sized from the resource file list
+    """
+    num_bytes = 0
+    for res_file_path, size in get_res_file_sizes(hs, res_id).items():
+        if res_file_path in res_file_names or os.path.basename(res_file_path) in res_file_names:
+            num_bytes += size
+
+    return reserve_staging_bytes(num_bytes, staging_path)
+
+
+def get_res_file_sizes(hs, res_id):
+    """
+    Returns the sizes of a resource's files by path (see get_res_file_path). The file list is fetched at most once per
+    RES_METADATA_TTL, so the jobs that load the files of a generic resource one by one share a single listing.
+    """
+    res_file_sizes = res_file_sizes_cache.get(res_id)
+    if res_file_sizes is None:
+        res_file_sizes = dict((get_res_file_path(res_file), res_file['size'])
+                              for res_file in hs.getResourceFileList(res_id))
+        res_file_sizes_cache.set(res_id, res_file_sizes)
+
+    return res_file_sizes
+
+
+def get_staging_metrics():
+    return StagingReservation.get_totals()
+
+
+def remove_hs_tempdir(hs_tempdir):
+    os.system('rm -rf %s' % hs_tempdir)
+    StagingReservation.remove_reservations_under_path(hs_tempdir)
+
+
+def get_res_file_path(res_file):
+    """
+    Returns the path of a resource file relative to the resource's content directory (e.g. "folder/file name.shp"),
+    decoded from the file's url
+    """
+    url_path = unquote(urlparse(res_file['url']).path)
+    if '/data/contents/' in url_path:
+        return url_path.split('/data/contents/', 1)[1]
+
+    return os.path.basename(url_path)
+
+
+def stream_res_file(hs, res_id, res_file_name, dst_path):
+    """
+    Streams a resource file from HydroShare to dst_path in chunks.
+    :return: the number of bytes written
+    """
+    num_bytes = 0
+    with hs_download_slots:
+        with open(dst_path, 'wb') as f:
+            for chunk in hs.getResourceFile(res_id, res_file_name):
+                f.write(chunk)
+                num_bytes += len(chunk)
+
+    return num_bytes
+
+
 def process_res_by_type(hs, res_id, res_type, hs_tempdir):
     return_obj = {
         'success': False,
@@ -539,7 +980,7 @@ def process_res_by_type(hs, res_id, res_type, hs_tempdir):
         results.append(result)
         return_obj['success'] = True
     else:
-        response = download_res_from_hs(hs, res_id, hs_tempdir)
+        response = download_res_from_hs(hs, res_id, hs_tempdir, res_type)
         if not response['success']:
             return_obj['message'] = response['message']
         else:
@@ -553,6 +994,9 @@ def process_res_by_type(hs, res_id, res_type, hs_tempdir):
                     res_type = r['res_type'] if 'res_type' in r else None
                     layer_name = r['layer_name'] if 'layer_name' in r else None
                     public_fname = r['public_fname'] if 'public_fname' in r else None
+                    raster_profile = r['raster_profile'] if 'raster_profile' in r else None
+                    is_image_pyramid = r['is_image_pyramid'] if 'is_image_pyramid' in r else None
+                    raster_conversion = r['raster_conversion'] if 'raster_conversion' in r else None
 
                     if res_type == 'GenericResource':
                         if res_filepath and res_filepath.endswith('mapProject.json'):
@@ -573,7 +1017,9 @@ def process_res_by_type(hs, res_id, res_type, hs_tempdir):
                             }
                             results.append(result)
                     elif res_type == 'GeographicFeatureResource' or res_type == 'RasterResource':
-                        check_res = upload_file_to_geoserver(res_id, res_type, res_filepath)
+                        with geoserver_upload_slots:
+                            check_res = upload_file_to_geoserver(res_id, res_type, res_filepath,
+                                                                 is_image_pyramid=is_image_pyramid)
                         if not check_res['success']:
                             error_occurred = True
                             return_obj['message'] = check_res['message']
@@ -591,6 +1037,8 @@ def process_res_by_type(hs, res_id, res_type, hs_tempdir):
                                 return_obj['message'] = response['message']
                                 break
                             else:
+                                if res_type == 'GeographicFeatureResource':
+                                    build_attribute_cache(layer_id, res_filepath)
                                 result = {
                                     'layer_name': layer_name,
                                     'res_type': res_type,
@@ -598,8 +1046,9 @@ def process_res_by_type(hs, res_id, res_type, hs_tempdir):
                                     'layer_attributes': response['attributes'],
                                     'layer_extents': response['extents'],
                                     'geom_type': response['geom_type'],
-                                    'band_info': get_band_info(hs, res_id, res_type),
-                                    'public_fname': public_fname
+                                    'band_info': get_band_info(hs, res_id, res_type, raster_profile),
+                                    'public_fname': public_fname,
+                                    'raster_conversion': raster_conversion
                                 }
                                 results.append(result)
                     else:
@@ -622,7 +1071,8 @@ def get_info_from_nongeneric_res_files(res_id, res_type, res_contents_path):
     {
             'res_filepath': None,
             'res_type': res_type,
-            'layer_name': None
+            'layer_name': None,
+            'raster_profile': None
     }
     '''
     results = return_obj['results']
@@ -631,18 +1081,13 @@ def get_info_from_nongeneric_res_files(res_id, res_type, res_contents_path):
         res_files_list = os.listdir(res_contents_path)
 
         if res_type == 'GeographicFeatureResource':
-            for f in res_files_list:
-                src = os.path.join(res_contents_path, f)
-                new_fname = '{name}{ext}'.format(name=get_geoserver_store_id(res_id),
-                                                 ext=os.path.splitext(f)[1])
-                dst = os.path.join(res_contents_path, new_fname)
-                os.rename(src, dst)
+            # download_res_from_hs has already named the files after the store
             res_fname = get_geoserver_store_id(res_id)
             res_fpath = os.path.join(res_contents_path, res_fname)
             prj_path = res_fpath + '.prj'
             r = check_crs(res_type, prj_path)
             return_obj['message'] = r['message'] % os.path.basename(prj_path) if r['message'] else None
-            if r['success'] and r['crsWasChanged']:
+            if r['success'] and r['new_wkt']:
                 with open(prj_path, 'w') as f:
                     f.seek(0)
                     f.write(r['new_wkt'])
@@ -656,40 +1101,56 @@ def get_info_from_nongeneric_res_files(res_id, res_type, res_contents_path):
             num_files = len(res_files_list)
             vrt_path = None
             res_fpath = None
+            raster_profile = None
+            raster_conversion = None
             for res_fname in res_files_list:
                 fpath = os.path.join(res_contents_path, res_fname)
                 if num_files == 2:
                     if res_fname.lower().endswith('.tif'):
-                        tif_name = '{name}.tif'.format(name=get_geoserver_store_id(res_id))
-                        tmp_fpath = os.path.join(res_contents_path, tif_name)
-                        os.rename(fpath, tmp_fpath)
-                        r = check_crs(res_type, tmp_fpath)
+                        # download_res_from_hs has already named the file after the store
+                        tmp_fpath = fpath
+                        raster_profile = RasterProfile(tmp_fpath)
+                        r = check_crs(res_type, tmp_fpath, raster_profile)
                         return_obj['message'] = r['message'] % res_fname if r['message'] else None
                         if not r['success']:
                             return return_obj
                         else:
                             if r['crsWasChanged']:
-                                code = r['code']
-                                os.system('gdal_edit.py -a_srs {0} {1}'.format(code, tmp_fpath))
-                            res_fpath = tmp_fpath.replace('tif', 'zip')
-                            zip_files(tmp_fpath, res_fpath)
+                                raster_profile.set_srs(r['code'])
+                            raster_profile, raster_conversion = normalize_raster(raster_profile)
+                            res_fpath = stage_raster_for_geoserver(tmp_fpath)
                             break
                 elif res_fname.lower().endswith('.vrt'):
                     vrt_path = fpath
                     break
 
+            is_image_pyramid = False
             if num_files > 2:
                 pyramid_dir_name = get_geoserver_store_id(res_id)
-                pyramid_dir_path = os.path.join(res_contents_path, pyramid_dir_name) + '/'
-                res_fpath = '%s.zip' % pyramid_dir_path[:-1]
-                os.mkdir(pyramid_dir_path)
-                gdal_retile = 'gdal_retile.py -levels 9 -ps 2048 2048 -co "TILED=YES" -targetDir %s %s'
-                os.system(gdal_retile % (pyramid_dir_path, vrt_path))
-                zip_folder(pyramid_dir_path, res_fpath)
+                if MULTI_FILE_RASTER_FORMAT == 'cog':
+                    cog_path = os.path.join(res_contents_path, '%s.tif' % pyramid_dir_name)
+                    build_cog(vrt_path, cog_path)
+                    raster_profile = RasterProfile(cog_path)
+                    raster_conversion = 'cog'
+
+                    res_fpath = stage_raster_for_geoserver(cog_path)
+                else:
+                    is_image_pyramid = True
+                    raster_conversion = 'imagepyramid'
+                    pyramid_dir_path = os.path.join(res_contents_path, pyramid_dir_name) + '/'
+                    if GEOSERVER_SHARED_DATA_DIR:
+                        build_image_pyramid(vrt_path, pyramid_dir_path)
+                        res_fpath = stage_raster_for_geoserver(pyramid_dir_path)
+                    else:
+                        res_fpath = '%s.zip' % pyramid_dir_path[:-1]
+                        build_image_pyramid(vrt_path, pyramid_dir_path, res_fpath)
 
             result = {
                 'res_filepath': res_fpath,
                 'res_type': res_type,
+                'raster_profile': raster_profile,
+                'is_image_pyramid': is_image_pyramid,
+                'raster_conversion': raster_conversion
             }
             results.append(result)
 
@@ -698,42 +1159,37 @@ def get_info_from_nongeneric_res_files(res_id, res_type, res_contents_path):
     return return_obj
 
 
-def get_hs_res_list(hs):
+def get_hs_res_list(hs, username=None, page=None, page_size=None, res_type=None, query=None):
+    """
+    Lists the resources the user can see, optionally filtered by resource type and by a search string matched against
+    titles and owners, and optionally paged.
+    :param page: page number, starting at 1. All resources are returned if None.
+    :param page_size: number of resources per page, at most RES_LIST_MAX_PAGE_SIZE
+    :return: return_obj with the resources and an etag that changes whenever they do
+    """
     global currently_testing
     return_obj = {
         'success': False,
         'message': None,
-        'res_list': None
+        'res_list': None,
+        'num_results': None,
+        'page': None,
+        'num_pages': None,
+        'etag': None
     }
-    res_list = []
 
     try:
-        valid_res_types = [
-            'GenericResource', 'GeographicFeatureResource', 'RasterResource', 'RefTimeSeriesResource', 'TimeSeriesResource', 
-            'ScriptResource', 'CompositeResource'
-        ]
-        for res in hs.getResourceList(types=valid_res_types):
-            res_id = res['resource_id']
-            # This code calculates the cummulative files size of each resource. Comment out to improve performance.
-            # res_size = 0
-            # try:
-            #     for res_file in hs.getResourceFileList(res_id):
-            #         res_size += res_file['size']
-            #
-            # except hs_r.HydroShareNotAuthorized:
-            #     continue
-            # except Exception as e:
-            #     logger.error(str(e))
-
-            res_list.append({
-                'title': res['resource_title'],
-                'type': res['resource_type'],
-                'id': res_id,
-                # 'size': sizeof_fmt(res_size) if res_size != 0 else "N/A",
-                'owner': res['creator']
-            })
+        res_list = list(filter_res_list(iter_hs_res_list(hs, username), res_type, query))
+        return_obj['num_results'] = len(res_list)
+
+        if page:
+            page_size = min(page_size or RES_LIST_PAGE_SIZE, RES_LIST_MAX_PAGE_SIZE)
+            return_obj['page'] = page
+            return_obj['num_pages'] = max(1, (len(res_list) + page_size - 1) // page_size)
+            res_list = res_list[(page - 1) * page_size:page * page_size]
 
         return_obj['res_list'] = res_list
+        return_obj['etag'] = sha1(dumps([res_list, return_obj['num_results'], return_obj['num_pages']])).hexdigest()
         return_obj['success'] = True
 
     except hs_r.HydroShareHTTPException:
@@ -747,6 +1203,73 @@ def get_hs_res_list(hs):
     return return_obj
 
 
+def iter_hs_res_list(hs, username=None):
+    """
+    Yields the resources the user can see. They come from the persistent store when both the public partition and
+    the user's partition are younger than RES_LIST_TTL. Otherwise they are yielded page by page as HydroShare returns
+    them (after any cached public resources, which are yielded right away), and both partitions are stored once the
+    listing is complete.
+    """
+    user_partition = 'user:%s' % username
+    public_cache = ResourceListCache.get_partition('public', RES_LIST_TTL)
+    user_cache = ResourceListCache.get_partition(user_partition, RES_LIST_TTL)
+
+    if public_cache and user_cache:
+        for res in loads(public_cache.res_list) + loads(user_cache.res_list):
+            yield res
+        return
+
+    yielded_res_ids = set()
+    if public_cache:
+        for res in loads(public_cache.res_list):
+            yielded_res_ids.add(res['id'])
+            yield res
+
+    public_res_list = []
+    user_res_list = []
+    for res in hs.getResourceList(types=VALID_RES_LIST_TYPES):
+        res_info = {
+            'title': res['resource_title'],
+            'type': res['resource_type'],
+            'id': res['resource_id'],
+            'owner': res['creator']
+        }
+        if res.get('public'):
+            public_res_list.append(res_info)
+        else:
+            user_res_list.append(res_info)
+        if res_info['id'] not in yielded_res_ids:
+            yield res_info
+
+    ResourceListCache.set_partition('public', dumps(public_res_list))
+    ResourceListCache.set_partition(user_partition, dumps(user_res_list))
+
+
+def filter_res_list(res_list, res_type=None, query=None):
+    query = query.lower() if query else None
+    for res in res_list:
+        if res_type and res['type'] != res_type:
+            continue
+        if query and query not in res['title'].lower() and query not in res['owner'].lower():
+            continue
+        yield res
+
+
+def stream_hs_res_list(hs, username=None, res_type=None, query=None):
+    """
+    Yields the resource list as newline-delimited JSON. An error part way through is reported as a final
+    {"error": ...} line.
+    """
+    try:
+        for res in filter_res_list(iter_hs_res_list(hs, username), res_type, query):
+            yield dumps(res) + '\n'
+    except hs_r.HydroShareHTTPException:
+        yield dumps({'error': 'The HydroShare server appears to be down.'}) + '\n'
+    except Exception as e:
+        logger.error(e)
+        yield dumps({'error': 'An unexpected error ocurred. App admin has been notified.'}) + '\n'
+
+
 def get_workspace():
     global workspace_id
     if workspace_id is None:
@@ -758,6 +1281,17 @@ def get_workspace():
     return workspace_id
 
 
+def make_staging_dir():
+    """
+    Creates a temp directory for a single ingest. Each ingest gets its own, so that removing it (and releasing its
+    staging reservations) never touches the files of other requests, including other tabs of the same user.
+    """
+    staging_dir = os.path.join(get_hs_tempdir(), '.staging', uuid4().hex)
+    os.makedirs(staging_dir)
+
+    return staging_dir
+
+
 def get_hs_tempdir(username=None, file_index=None):
     hs_tempdir = '/tmp/hs_gis_files'
 
@@ -807,7 +1341,7 @@ def email_admin(subject, traceback=None, custom_msg=None):
     )
 
 
-def check_crs(res_type, fpath):
+def check_crs(res_type, fpath, raster_profile=None):
     return_obj = {
         'success': False,
         'message': None,
@@ -821,112 +1355,289 @@ def check_crs(res_type, fpath):
                              'to be spatially incorrect.'
 
     if res_type == 'RasterResource':
-        gdal_info = check_output('gdalinfo %s' % fpath, shell=True)
-        start = 'Coordinate System is:'
-        length = len(start)
-        end = 'Origin ='
-        if gdal_info.find(start) == -1:
+        if raster_profile is None:
+            raster_profile = RasterProfile(fpath)
+        if not raster_profile.wkt:
             return_obj['message'] = message_erroneous_proj
             return_obj['crsWasChanged'] = True
             return_obj['code'] = 'EPSG:3857'
             return_obj['success'] = True
             return return_obj
-        start_index = gdal_info.find(start) + length
-        end_index = gdal_info.find(end)
-        crs_raw = gdal_info[start_index:end_index]
-        crs = ''.join(crs_raw.split())
+        crs = raster_profile.wkt
     else:
         with open(fpath) as f:
             crs = f.read()
 
-    endpoint = 'http://prj2epsg.org/search.json'
-    params = {
-        'mode': 'wkt',
-        'terms': crs
-    }
-    crs_is_unknown = True
-    flag_unhandled_error = False
+    crs_key = '%s:%s' % (res_type, ''.join(crs.split()).upper())
+    if isinstance(crs_key, unicode):
+        crs_key = crs_key.encode('utf-8')
+    crs_hash = sha1(crs_key).hexdigest()
+    cached_result = CrsCacheEntry.get_result_by_hash(crs_hash, CRS_CACHE_TTL)
+    with crs_cache_stats_lock:
+        crs_cache_stats['hits' if cached_result else 'misses'] += 1
+    if cached_result:
+        return loads(cached_result)
+
+    with gdal_slots:
+        code, canonical_wkt = resolve_crs(crs)
+
+    if code is False:
+        # The WKT could not be parsed, even after removing offending parameters. An attempt will still be made to
+        # add the layer to GeoServer in the default projection, leaving the .prj file as it is.
+        return_obj['message'] = message_erroneous_proj
+        return_obj['crsWasChanged'] = True
+        return_obj['code'] = 'EPSG:3857'
+    elif code is not None:
+        # If there is no code, a match wasn't found. In that case, an attempt will still be made to add the layer
+        # to GeoServer since this still works in some cases.
+        if res_type == 'RasterResource':
+            if code not in crs:
+                return_obj['crsWasChanged'] = True
+            return_obj['code'] = 'EPSG:' + code
+        else:
+            if code not in crs:
+                return_obj['crsWasChanged'] = True
+                return_obj['new_wkt'] = canonical_wkt
+
+    return_obj['success'] = True
+    CrsCacheEntry.add_result(crs_hash, dumps(return_obj))
+    if random() < CRS_CACHE_PRUNE_PROBABILITY:
+        CrsCacheEntry.prune(CRS_CACHE_MAX_ENTRIES, CRS_CACHE_TTL)
+        logger.info('CRS cache: %s' % get_crs_cache_stats())
+
+    return return_obj
+
+
+def get_crs_cache_stats():
+    """
+    Reports how well the CRS cache is doing: the hits and misses of this worker process, and the number of cached
+    entries and of their reuses across all worker processes
+    """
+    with crs_cache_stats_lock:
+        stats = dict(crs_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = float(stats['hits']) / lookups if lookups else None
+    stats['num_entries'], stats['total_hits'] = CrsCacheEntry.get_stats()
+
+    return stats
+
+
+def resolve_crs(wkt):
+    """
+    Resolves a WKT string to an EPSG code without leaving the process. The WKT is parsed with GDAL and matched against
+    the EPSG catalogue index (see get_crs_index). If the WKT cannot be parsed, its parameters are removed one after
+    another, from the last one backwards, until it can, which is the same repair that used to be done through
+    round-trips to prj2epsg.org.
+    :param wkt: the WKT string from a .prj file or raster dataset
+    :return: tuple of (code, canonical_wkt). The code is None if no match was found and False if the WKT could not be
+             parsed at all.
+    """
+    fingerprint = ''.join(wkt.split()).upper()
+    if fingerprint in crs_resolution_memo:
+        return crs_resolution_memo[fingerprint]
+
+    code = False
+    canonical_wkt = None
+    srs = parse_wkt(wkt)
+    if srs is None:
+        repaired_wkt = wkt
+        # Removing nodes from the end keeps the start indexes of the preceding ones valid
+        for param_start in reversed([i for i in range(len(wkt)) if wkt.startswith('PARAMETER[', i)]):
+            repaired_wkt = remove_wkt_node(repaired_wkt, param_start)
+            srs = parse_wkt(repaired_wkt)
+            if srs is not None:
+                break
+
+    if srs is not None:
+        code = identify_epsg_code(srs)
+        if code is not None:
+            canonical_wkt = get_canonical_wkt(code)
+
+    crs_resolution_memo[fingerprint] = (code, canonical_wkt)
+
+    return code, canonical_wkt
+
+
+def parse_wkt(wkt):
+    from osr import SpatialReference
+
+    srs = SpatialReference()
     try:
-        while crs_is_unknown:
-            r = requests.get(endpoint, params=params)
-            if '50' in str(r.status_code):
-                raise Exception
-            elif r.status_code == 200:
-                response = r.json()
-                if 'errors' in response:
-                    errs = response['errors']
-                    if 'Invalid WKT syntax' in errs:
-                        err = errs.split(':')[2]
-                        if err and 'Parameter' in err:
-                            crs_param = err.split('"')[1]
-                            rm_indx_start = crs.find(crs_param)
-                            rm_indx_end = None
-                            sub_str = crs[rm_indx_start:]
-                            counter = 0
-                            check = False
-                            for i, c in enumerate(sub_str):
-                                if c == '[':
-                                    counter += 1
-                                    check = True
-                                elif c == ']':
-                                    counter -= 1
-                                    check = True
-                                if check:
-                                    if counter == 0:
-                                        rm_indx_end = i + rm_indx_start + 1
-                                        break
-                            crs = crs[:rm_indx_start] + crs[rm_indx_end:]
-                            if ',' in crs[:-4]:
-                                i = crs.rfind(',')
-                                crs = crs[:i] + crs[i+1:]
-                            params['terms'] = crs
-                        else:
-                            flag_unhandled_error = True
-                    else:
-                        flag_unhandled_error = True
-                else:
-                    crs_is_unknown = False
-                    codes = response['codes']
-                    # If there are no codes in the result, a match wasn't found. In that case, an attempt will still be
-                    # made to add the layer to GeoServer since this still works in some cases.
-                    if len(codes) != 0:
-                        code = codes[0]['code']
-                        if res_type == 'RasterResource':
-                            if code not in crs:
-                                return_obj['crsWasChanged'] = True
-                            return_obj['code'] = 'EPSG:' + code
-                        else:
-                            r = requests.get(response['codes'][0]['url'])
-                            proj_json = r.json()
-                            raw_wkt = proj_json['wkt']
-                            tmp_list = []
-                            for seg in raw_wkt.split('\n'):
-                                tmp_list.append(seg.strip())
-                            if code not in crs:
-                                return_obj['crsWasChanged'] = True
-                                return_obj['new_wkt'] = ''.join(tmp_list)
+        if srs.ImportFromWkt(str(wkt)) != 0:
+            return None
+    except RuntimeError:
+        return None
 
-                    return_obj['success'] = True
+    if 'GCS_' in wkt or '"D_' in wkt:
+        # ESRI flavoured WKT, which is what most .prj files contain
+        srs.MorphFromESRI()
 
-                if flag_unhandled_error:
-                    return_obj['message'] = message_erroneous_proj
-                    return_obj['crsWasChanged'] = True
-                    return_obj['code'] = 'EPSG:3857'
-                    return_obj['success'] = True
-                    break
-            else:
-                params['mode'] = 'keywords'
+    return srs
+
+
+def remove_wkt_node(wkt, start_index):
+    rm_indx_end = None
+    sub_str = wkt[start_index:]
+    counter = 0
+    check = False
+    for i, c in enumerate(sub_str):
+        if c == '[':
+            counter += 1
+            check = True
+        elif c == ']':
+            counter -= 1
+            check = True
+        if check:
+            if counter == 0:
+                rm_indx_end = i + start_index + 1
+                break
+
+    if rm_indx_end is None:
+        return wkt[:start_index]
+
+    new_wkt = wkt[:start_index] + wkt[rm_indx_end:]
+    # Drop the comma that separated the removed node from its neighbour
+    new_wkt = new_wkt.replace(',,', ',').replace(',]', ']').replace('[,', '[')
+
+    return new_wkt
+
+
+def get_canonical_wkt(code):
+    from osr import SpatialReference
+
+    srs = SpatialReference()
+    srs.ImportFromEPSG(int(code))
+
+    return srs.ExportToWkt()
+
+
+def get_srs_fingerprint(srs):
+    """
+    Builds a key that identifies a coordinate reference system by its defining values (ellipsoid, projection method,
+    projection parameters and units) rather than by its names, which differ between ESRI and EPSG flavoured WKT.
+    """
+    from re import findall
+
+    def fmt(val):
+        return '%.9g' % float(val)
+
+    geog_cs = srs.CloneGeogCS()
+    parts = [
+        fmt(geog_cs.GetSemiMajor()),
+        fmt(geog_cs.GetInvFlattening()),
+        fmt(geog_cs.GetAngularUnits())
+    ]
+    if srs.IsProjected():
+        wkt = srs.ExportToWkt()
+        params = sorted('%s=%s' % (name.lower(), fmt(val))
+                        for name, val in findall(r'PARAMETER\["([^"]+)",([-+0-9.eE]+)\]', wkt))
+        parts += [
+            str(srs.GetAttrValue('PROJECTION')).lower(),
+            fmt(srs.GetLinearUnits())
+        ] + params
+    else:
+        parts.append('geographic')
+
+    return '|'.join(parts)
+
+
+def identify_epsg_code(srs):
+    if srs.AutoIdentifyEPSG() == 0:
+        authority_node = 'PROJCS' if srs.IsProjected() else 'GEOGCS'
+        code = srs.GetAuthorityCode(authority_node)
+        if code:
+            return str(code)
+
+    return get_crs_index().get(get_srs_fingerprint(srs))
+
+
+def get_crs_index_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspaces', 'app_workspace', 'crs_index.json')
+
+
+def get_crs_index():
+    """
+    Returns the index of the EPSG catalogue that is bundled with GDAL, keyed by srs fingerprint. The index is built
+    once (normally when the persistent store is initialized) and then loaded from the app workspace.
+    """
+    global crs_index
+    if crs_index is None:
+        index_path = get_crs_index_path()
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                crs_index = loads(f.read())
+        else:
+            crs_index = build_crs_index()
+
+    return crs_index
+
+
+def build_crs_index():
+    from osr import SpatialReference
+
+    index = {}
+    for code in list_epsg_codes():
+        srs = SpatialReference()
+        try:
+            if srs.ImportFromEPSG(int(code)) != 0:
                 continue
-    except Exception as e:
-        e.message = 'A service that HydroShare GIS depends on currently appears to be down. An app admin has been notified to further investigate.'
-        raise
+            fingerprint = get_srs_fingerprint(srs)
+        except Exception:
+            continue
+        # Codes are listed in ascending order, so the first (and most commonly used) code wins on a tie
+        if fingerprint not in index:
+            index[fingerprint] = str(code)
+
+    index_path = get_crs_index_path()
+    if not os.path.exists(os.path.dirname(index_path)):
+        os.makedirs(os.path.dirname(index_path))
+    # Written aside and renamed into place, so that get_crs_index never reads a partial file
+    tmp_path = '%s.%s.tmp' % (index_path, uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        f.write(dumps(index))
+    os.rename(tmp_path, index_path)
+
+    return index
+
+
+def list_epsg_codes():
+    """
+    Lists the non-deprecated EPSG codes of the coordinate reference systems known to the local GDAL installation.
+    GDAL 1.x/2.x ships them as pcs.csv and gcs.csv in GDAL_DATA; GDAL 3.x keeps them in PROJ's proj.db.
+    """
+    import csv
+    from gdal import FindFile
+
+    codes = []
+    for csv_name in ['gcs.csv', 'pcs.csv']:
+        csv_path = FindFile('gdal', csv_name)
+        if csv_path:
+            with open(csv_path) as f:
+                for row in csv.DictReader(f):
+                    if row.get('DEPRECATED', '0') == '0':
+                        codes.append(int(row['COORD_REF_SYS_CODE']))
+
+    if not codes:
+        try:
+            from osr import GetPROJSearchPaths
+            for proj_path in GetPROJSearchPaths():
+                proj_db = os.path.join(proj_path, 'proj.db')
+                if os.path.exists(proj_db):
+                    with sqlite3.connect(proj_db) as con:
+                        cur = con.cursor()
+                        for table in ['geodetic_crs', 'projected_crs']:
+                            cur.execute("SELECT code FROM %s WHERE auth_name='EPSG' AND deprecated=0" % table)
+                            codes += [int(row[0]) for row in cur.fetchall() if row[0].isdigit()]
+                    break
+        except ImportError:
+            pass
 
-    return return_obj
+    return sorted(set(codes))
 
 
 def delete_tempfiles(username):
     hs_tempdir = get_hs_tempdir(username)
-    os.system('rm -rf %s' % hs_tempdir)
+    remove_hs_tempdir(hs_tempdir)
 
 
 
@@ -937,7 +1648,7 @@ def save_new_project(hs, project_info, res_title, res_abstract, res_keywords, us
         'res_id': None
     }
     res_id = None
-    hs_tempdir = get_hs_tempdir(username)
+    hs_tempdir = make_staging_dir()
 
     try:
         res_type = 'GenericResource'
@@ -981,16 +1692,19 @@ def save_new_project(hs, project_info, res_title, res_abstract, res_keywords, us
         else:
             return_obj['success'] = 'Resource created successfully.'
             return_obj['res_id'] = res_id
+        ProjectIndex.remove_projects_by_username(username)
     except Exception as e:
         logger.error(str(e))
         if res_id:
             hs.deleteResource(pid=res_id)
         return_obj['error'] = 'An unknown/unexpected error was encountered. Project not saved.'
+    finally:
+        remove_hs_tempdir(hs_tempdir)
 
     return return_obj
 
 
-def zip_folder(folder_path, output_path):
+def zip_folder(folder_path, output_path, compression=zipfile.ZIP_DEFLATED):
     """Zip the contents of an entire folder (with that folder included
     in the archive). Empty subfolders will be included in the archive
     as well.
@@ -998,7 +1712,7 @@ def zip_folder(folder_path, output_path):
 
     parent_folder = os.path.dirname(folder_path)
     contents = os.walk(folder_path)
-    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    with gdal_slots, zipfile.ZipFile(output_path, 'w', compression) as zip_file:
         for root, folders, files in contents:
             for folder_name in folders:
                 absolute_path = os.path.join(root, folder_name)
@@ -1010,7 +1724,67 @@ def zip_folder(folder_path, output_path):
                 zip_file.write(absolute_path, relative_path)
 
 
-def save_project(hs, res_id, project_info):
+def get_resources_to_add(hs, res_ids):
+    """
+    Looks up the title and type of each resource, concurrently. Resources that cannot be read are left out.
+    """
+    def get_res_to_add(res_id):
+        try:
+            md = hs.getSystemMetadata(res_id)
+            return {
+                'title': md['resource_title'],
+                'id': md['resource_id'],
+                'type': md['resource_type']
+            }
+        except Exception as e:
+            logger.error(str(e))
+            return None
+
+    pool = ThreadPool(max(1, min(PROJECT_SCAN_CONCURRENCY, len(res_ids))))
+    try:
+        resources_to_add = pool.map(get_res_to_add, res_ids)
+    finally:
+        pool.close()
+
+    return [res for res in resources_to_add if res is not None]
+
+
+def get_user_projects(hs, username):
+    """
+    Returns the map projects the user has created, from the index kept in the persistent store when it is recent.
+    The index is rebuilt by scanning the user's generic resources concurrently; save_new_project and save_project
+    clear it.
+    """
+    projects = ProjectIndex.get_projects_by_username(username, PROJECT_INDEX_TTL)
+    if projects is not None:
+        return loads(projects)
+
+    def get_project(res):
+        try:
+            for res_file in hs.getResourceFileList(res['resource_id']):
+                if res_file['content_type'] == 'application/json':
+                    return {
+                        'title': res['resource_title'],
+                        'id': res['resource_id']
+                    }
+        except Exception as e:
+            logger.error(str(e))
+        return None
+
+    hs_username = hs.getUserInfo()['username']
+    generic_res_list = list(hs.getResourceList(creator=hs_username, types=['GenericResource']))
+    pool = ThreadPool(max(1, min(PROJECT_SCAN_CONCURRENCY, len(generic_res_list))))
+    try:
+        projects = [project for project in pool.map(get_project, generic_res_list) if project is not None]
+    finally:
+        pool.close()
+
+    ProjectIndex.set_projects(username, dumps(projects))
+
+    return projects
+
+
+def save_project(hs, res_id, project_info, username=None):
     return_obj = {
         'success': False,
         'message': None
@@ -1024,6 +1798,8 @@ def save_project(hs, res_id, project_info):
             f.write(project_info)
             f.seek(0)
             hs.addResourceFile(res_id, f, fname)
+        if username:
+            ProjectIndex.remove_projects_by_username(username)
         return_obj['success'] = True
 
     except Exception as e:
@@ -1032,31 +1808,58 @@ def save_project(hs, res_id, project_info):
 
     return return_obj
 
-def generate_attribute_table(layer_id, layer_attributes):
+def generate_attribute_table(layer_id, layer_attributes, start_index=None, count=None, sort_by=None, sort_order='asc',
+                             filters=None, search=None, property_names=None):
+    """
+    Reads the attributes of a layer's features through WFS. Paging, sorting and filtering are all done by GeoServer.
+    :param layer_attributes: comma-separated names of the layer's attributes
+    :param start_index: index of the first feature to return
+    :param count: number of features to return, at most ATTRIBUTE_TABLE_MAX_COUNT. All features are returned if None.
+    :param sort_by: attribute to sort by
+    :param sort_order: 'asc' or 'desc'
+    :param filters: list of {'attribute': ..., 'operator': ..., 'value': ...} conditions, all of which must hold
+    :param search: text that at least one attribute must contain (case-insensitive)
+    :param property_names: the attributes to return. All attributes are returned if None.
+    :return: return_obj with the features' properties, the number of features that match and the number in the layer
+    """
     return_obj = {
         'success': False,
         'message': None,
-        'feature_properties': None
+        'feature_properties': None,
+        'num_features': None,
+        'num_features_total': None
     }
     try:
-        params = {
-            'service': 'wfs',
-            'version': '2.0.0',
-            'request': 'GetFeature',
-            'typeNames': layer_id,
-            'propertyName': layer_attributes,
-            'outputFormat': 'application/json'
-        }
+        if os.path.exists(get_attribute_cache_path(layer_id)):
+            try:
+                return_obj.update(query_attribute_cache(layer_id, layer_attributes, start_index, count, sort_by,
+                                                        sort_order, filters, search, property_names))
+                return_obj['success'] = True
+                return return_obj
+            except sqlite3.Error as e:
+                logger.error('Attribute cache of %s could not be read, asking GeoServer: %s' % (layer_id, str(e)))
+
+        params = get_attribute_table_params(layer_id, layer_attributes, sort_by, sort_order, filters, search,
+                                            property_names)
+        cql_filter = params.get('CQL_FILTER')
+        if count is not None:
+            params['count'] = min(count, ATTRIBUTE_TABLE_MAX_COUNT)
+            params['startIndex'] = start_index or 0
 
         r = make_geoserver_request('wfs', params)
         json = r.json()
 
-        feature_properties = []
+        feature_properties = [feature['properties'] for feature in json['features']]
+        if count is None and not cql_filter:
+            num_features = len(feature_properties)
+        else:
+            num_features = json.get('numberMatched', json.get('totalFeatures'))
+            if not isinstance(num_features, int):
+                num_features = get_wfs_feature_count(layer_id, cql_filter)
 
-        features = json['features']
-        for feature in features:
-            feature_properties.append(feature['properties'])
-        return_obj['feature_properties'] = dumps(feature_properties)
+        return_obj['feature_properties'] = feature_properties
+        return_obj['num_features'] = num_features
+        return_obj['num_features_total'] = get_wfs_feature_count(layer_id) if cql_filter else num_features
         return_obj['success'] = True
     except Exception as e:
         return_obj['message'] = str(e)
@@ -1064,18 +1867,719 @@ def generate_attribute_table(layer_id, layer_attributes):
     return return_obj
 
 
-def set_currently_testing(val):
-    global currently_testing
-    currently_testing = val
+def get_attribute_table_params(layer_id, layer_attributes, sort_by=None, sort_order='asc', filters=None, search=None,
+                               property_names=None):
+    """
+    Builds the WFS GetFeature parameters of an attribute table query, rejecting attributes the layer does not have
+    """
+    attributes_list = layer_attributes.split(',')
+    for attribute in (property_names or []) + ([sort_by] if sort_by else []):
+        if attribute not in attributes_list:
+            raise ValueError('The layer has no attribute "%s".' % attribute)
 
+    params = {
+        'service': 'wfs',
+        'version': '2.0.0',
+        'request': 'GetFeature',
+        'typeNames': layer_id,
+        'propertyName': ','.join(property_names) if property_names else layer_attributes,
+        'outputFormat': 'application/json'
+    }
 
-def get_features_on_click(params_str):
-    params = loads(params_str)
-    r = make_geoserver_request('wms', params)
-    return r.json()
+    cql_filter = build_cql_filter(attributes_list, filters, search)
+    if cql_filter:
+        params['CQL_FILTER'] = cql_filter
+    if sort_by:
+        params['sortBy'] = '%s %s' % (sort_by, 'DESC' if sort_order == 'desc' else 'ASC')
 
+    return params
 
-def prepare_result_for_layer_db(result):
+
+def export_attribute_table(layer_id, layer_attributes, export_format='csv', filters=None, search=None,
+                           property_names=None):
+    """
+    Validates an export of a layer's attributes and returns a generator of CSV or NDJSON rows. Rows are read from the
+    layer's attribute cache when it has one, and otherwise from GeoServer ATTRIBUTE_EXPORT_PAGE_SIZE at a time, so
+    memory use does not grow with the size of the layer. If reading fails partway through, an NDJSON export ends with
+    an {"error": ...} row and a CSV export is aborted, so that a truncated file is never passed off as complete.
+    """
+    columns = property_names or layer_attributes.split(',')
+    csv_writer = csv.writer(EchoBuffer())
+    cache_path = get_attribute_cache_path(layer_id)
+    read_rows = None
+    if os.path.exists(cache_path):
+        try:
+            read_rows = get_attribute_cache_export_reader(cache_path, layer_attributes, columns, filters, search)
+        except sqlite3.Error as e:
+            logger.error('Attribute cache of %s could not be read, asking GeoServer: %s' % (layer_id, str(e)))
+    if read_rows is None:
+        read_rows = get_wfs_export_reader(layer_id, layer_attributes, filters, search, property_names)
+
+    def to_csv_value(value):
+        if value is None:
+            return ''
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+
+    def generate_rows():
+        start = time()
+        num_rows = 0
+        try:
+            if export_format == 'csv':
+                yield csv_writer.writerow([to_csv_value(column) for column in columns])
+            for properties in read_rows():
+                if export_format == 'csv':
+                    yield csv_writer.writerow([to_csv_value(properties.get(column)) for column in columns])
+                else:
+                    yield dumps(properties) + '\n'
+                num_rows += 1
+        except Exception as e:
+            logger.error('Export of %s failed after %d rows: %s' % (layer_id, num_rows, str(e)))
+            if export_format == 'csv':
+                raise
+            yield dumps({'error': 'The export failed after %d rows and is incomplete.' % num_rows}) + '\n'
+        finally:
+            elapsed = time() - start
+            logger.info('Exported %d rows of %s as %s in %.1f s (%.0f rows/sec)' %
+                        (num_rows, layer_id, export_format, elapsed, num_rows / elapsed if elapsed else 0))
+
+    return generate_rows()
+
+
+def get_attribute_cache_export_reader(cache_path, layer_attributes, columns, filters=None, search=None):
+    """
+    Validates an export query against a layer's attribute cache and returns a function that yields the matching
+    rows, in file order, as dicts of the exported columns
+    """
+    attributes_list = layer_attributes.split(',')
+    for column in columns:
+        if column not in attributes_list:
+            raise ValueError('The layer has no attribute "%s".' % column)
+
+    conn = sqlite3.connect(cache_path)
+    try:
+        where, args = build_attribute_cache_where(conn, attributes_list, filters, search)
+    finally:
+        conn.close()
+    sql = 'SELECT %s FROM attributes%s ORDER BY rowid' % (
+        ', '.join(quote_sql_identifier(column) for column in columns), where)
+
+    def read_rows():
+        # The cursor fetches rows from the file as they are consumed
+        row_conn = sqlite3.connect(cache_path)
+        try:
+            row_conn.execute('PRAGMA case_sensitive_like = ON')
+            for row in row_conn.execute(sql, args):
+                yield dict(zip(columns, row))
+        finally:
+            row_conn.close()
+
+    return read_rows
+
+
+def get_wfs_export_reader(layer_id, layer_attributes, filters=None, search=None, property_names=None):
+    """
+    Validates an export query against GeoServer and returns a function that yields the matching features'
+    properties, read a page at a time. WFS paging is only consistent under a total order, so features are sorted by
+    all of the layer's attributes: features that tie are identical in every exported column.
+    """
+    params = get_attribute_table_params(layer_id, layer_attributes, filters=filters, search=search,
+                                        property_names=property_names)
+    params['count'] = ATTRIBUTE_EXPORT_PAGE_SIZE
+    params['sortBy'] = ','.join('%s ASC' % attribute for attribute in layer_attributes.split(','))
+
+    def read_rows():
+        start_index = 0
+        while True:
+            params['startIndex'] = start_index
+            r = make_geoserver_request('wfs', params)
+            r.raise_for_status()
+            features = r.json()['features']
+            for feature in features:
+                yield feature['properties']
+            if len(features) < ATTRIBUTE_EXPORT_PAGE_SIZE:
+                break
+            start_index += len(features)
+
+    return read_rows
+
+
+class EchoBuffer(object):
+    """
+    File-like object that hands back what is written to it, so that csv.writer can produce rows to stream
+    """
+    def write(self, value):
+        return value
+
+
+def build_cql_filter(attributes_list, filters=None, search=None):
+    """
+    Builds a CQL filter from attribute conditions, rejecting unknown attributes and operators
+    :return: the filter, or None if there are no conditions
+    """
+    conditions = []
+    for f in filters or []:
+        attribute, operator = check_attribute_filter(attributes_list, f)
+        conditions.append('"%s" %s %s' % (attribute, operator, get_cql_literal(f.get('value'))))
+
+    if search:
+        search_literal = get_cql_literal('%%%s%%' % search, force_string=True)
+        conditions.append('(%s)' % ' OR '.join('"%s" ILIKE %s' % (attribute, search_literal)
+                                               for attribute in attributes_list))
+
+    return ' AND '.join(conditions) if conditions else None
+
+
+def check_attribute_filter(attributes_list, attribute_filter):
+    """
+    :return: the attribute and the (upper case) operator of a filter condition
+    """
+    attribute = attribute_filter.get('attribute')
+    operator = str(attribute_filter.get('operator', '=')).upper()
+    if attribute not in attributes_list:
+        raise ValueError('The layer has no attribute "%s".' % attribute)
+    if operator not in CQL_OPERATORS:
+        raise ValueError('The operator "%s" is not supported.' % operator)
+
+    return attribute, operator
+
+
+def get_attribute_cache_path(layer_id):
+    if not LAYER_ID_PATTERN.match(layer_id or ''):
+        raise ValueError('"%s" is not a valid layer id.' % layer_id)
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspaces', 'app_workspace', 'attribute_cache',
+                        '%s.sqlite3' % layer_id.replace(':', '__'))
+
+
+def quote_sql_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def build_attribute_cache(layer_id, shp_fpath):
+    """
+    Copies the attribute table of a shapefile into a SQLite file with an index on every column, so that attribute
+    tables can be paged, sorted and summarized without asking GeoServer. The feature geometries are stored in the same
+    file in EPSG:3857, under an R*Tree of their bounding boxes, so that map clicks can be identified without asking
+    GeoServer either (see query_spatial_index). The file is replaced whenever the layer is loaded again. A failure is
+    logged and leaves the layer to be served from GeoServer.
+    :param layer_id: the GeoServer layer id
+    :param shp_fpath: path of the shapefile (or of the zip holding it) without the need for the extension
+    """
+    import ogr
+    import osr
+
+    base_path = os.path.splitext(shp_fpath)[0]
+    cache_path = get_attribute_cache_path(layer_id)
+    tmp_path = '%s.%s.tmp' % (cache_path, uuid4().hex)
+    sqlite_types = {
+        ogr.OFTInteger: 'INTEGER',
+        getattr(ogr, 'OFTInteger64', ogr.OFTInteger): 'INTEGER',
+        ogr.OFTReal: 'REAL'
+    }
+
+    def to_sqlite_value(value):
+        return value.decode('utf-8', 'replace') if isinstance(value, str) else value
+
+    def get_transform(layer):
+        src_srs = layer.GetSpatialRef()
+        if src_srs is None:
+            return None
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromEPSG(3857)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return osr.CoordinateTransformation(src_srs, dst_srs)
+
+    def create_spatial_index(conn):
+        try:
+            conn.execute('CREATE VIRTUAL TABLE feature_index USING rtree(id, minx, maxx, miny, maxy)')
+            conn.execute('CREATE TABLE geometries (id INTEGER PRIMARY KEY, wkb BLOB)')
+            return True
+        except sqlite3.OperationalError as e:
+            logger.error('Could not build the spatial index of %s: %s' % (layer_id, str(e)))
+            return False
+
+    if os.path.exists('%s.shp' % base_path):
+        src_path = '%s.shp' % base_path
+    elif os.path.exists('%s.dbf' % base_path):
+        src_path = '%s.dbf' % base_path
+    else:
+        return
+    try:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+
+        with gdal_slots:
+            data_source = ogr.Open(src_path)
+            layer = data_source.GetLayer()
+            layer_defn = layer.GetLayerDefn()
+            columns = []
+            for i in range(layer_defn.GetFieldCount()):
+                field_defn = layer_defn.GetFieldDefn(i)
+                columns.append((field_defn.GetName(), sqlite_types.get(field_defn.GetType(), 'TEXT')))
+            transform = get_transform(layer) if src_path.endswith('.shp') else None
+            if not columns and transform is None:
+                return
+
+            conn = sqlite3.connect(tmp_path)
+            try:
+                if columns:
+                    conn.execute('CREATE TABLE attributes (%s)' % ', '.join(
+                        '%s %s' % (quote_sql_identifier(name), sql_type) for name, sql_type in columns))
+                has_spatial_index = transform is not None and create_spatial_index(conn)
+                insert_sql = 'INSERT INTO attributes (rowid, %s) VALUES (?, %s)' % (
+                    ', '.join(quote_sql_identifier(name) for name, _ in columns), ', '.join('?' * len(columns)))
+                rows = []
+                envelopes = []
+                geometries = []
+
+                def insert_batch():
+                    if columns:
+                        conn.executemany(insert_sql, rows)
+                    if has_spatial_index:
+                        conn.executemany('INSERT INTO feature_index VALUES (?, ?, ?, ?, ?)', envelopes)
+                        conn.executemany('INSERT INTO geometries VALUES (?, ?)', geometries)
+                    del rows[:], envelopes[:], geometries[:]
+
+                # Row ids count features from 1 in file order, and are shared by the attributes and the geometries
+                for row_id, feature in enumerate(layer, 1):
+                    rows.append([row_id] + [to_sqlite_value(feature.GetField(i)) for i in range(len(columns))])
+                    geometry = feature.GetGeometryRef() if has_spatial_index else None
+                    if geometry is not None and not geometry.IsEmpty() and geometry.Transform(transform) == 0:
+                        envelopes.append((row_id,) + geometry.GetEnvelope())
+                        geometries.append((row_id, buffer(geometry.ExportToWkb())))
+                    if len(rows) >= ATTRIBUTE_CACHE_BATCH_SIZE:
+                        insert_batch()
+                insert_batch()
+                for i, (name, _) in enumerate(columns):
+                    conn.execute('CREATE INDEX ix_attributes_%d ON attributes (%s)' % (i, quote_sql_identifier(name)))
+                conn.commit()
+            finally:
+                conn.close()
+            data_source = None
+
+        os.rename(tmp_path, cache_path)
+    except Exception as e:
+        logger.error('Could not build the attribute cache of %s: %s' % (layer_id, str(e)))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def query_spatial_index(layer_id, bbox, point=None, tolerance=0, max_features=None):
+    """
+    Finds the features of a vector layer within a bounding box, or within a distance of a point, from the spatial index
+    built by build_attribute_cache
+    :param layer_id: the GeoServer layer id
+    :param bbox: (minx, miny, maxx, maxy) in EPSG:3857
+    :param point: (x, y) in EPSG:3857. Features are then tested against the point and sorted by their distance to it.
+    :param tolerance: greatest distance, in EPSG:3857 units, of a feature from the point
+    :param max_features: maximum number of features returned
+    :return: list of GeoJSON features (geometries in EPSG:3857), or None if the layer has no spatial index
+    """
+    import ogr
+
+    cache_path = get_attribute_cache_path(layer_id)
+    if not os.path.exists(cache_path):
+        return None
+
+    if point:
+        test_geometry = ogr.Geometry(ogr.wkbPoint)
+        test_geometry.AddPoint_2D(float(point[0]), float(point[1]))
+    else:
+        test_geometry = ogr.CreateGeometryFromWkt('POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(*bbox))
+
+    conn = sqlite3.connect(cache_path)
+    try:
+        table_names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        if 'geometries' not in table_names:
+            return None
+
+        hits = []
+        candidates = conn.execute('SELECT g.id, g.wkb FROM feature_index i JOIN geometries g ON g.id = i.id '
+                                  'WHERE i.maxx >= ? AND i.minx <= ? AND i.maxy >= ? AND i.miny <= ?',
+                                  (bbox[0], bbox[2], bbox[1], bbox[3]))
+        for row_id, wkb in candidates:
+            geometry = ogr.CreateGeometryFromWkb(str(wkb))
+            if point:
+                distance = geometry.Distance(test_geometry)
+                if distance <= tolerance:
+                    hits.append((distance, row_id, geometry))
+            elif geometry.Intersects(test_geometry):
+                hits.append((0, row_id, geometry))
+                if max_features and len(hits) >= max_features:
+                    break
+        hits.sort(key=lambda hit: hit[:2])
+        hits = hits[:max_features] if max_features else hits
+
+        properties = {}
+        if hits and 'attributes' in table_names:
+            cursor = conn.execute('SELECT rowid, * FROM attributes WHERE rowid IN (%s)' % ', '.join('?' * len(hits)),
+                                  [row_id for _, row_id, _ in hits])
+            column_names = [description[0] for description in cursor.description][1:]
+            for row in cursor:
+                properties[row[0]] = dict(zip(column_names, row[1:]))
+    finally:
+        conn.close()
+
+    layer_name = layer_id.split(':')[-1]
+    return [{
+        'type': 'Feature',
+        'id': '%s.%s' % (layer_name, row_id),
+        'geometry': loads(geometry.ExportToJson()),
+        'properties': properties.get(row_id, {})
+    } for _, row_id, geometry in hits]
+
+
+def remove_attribute_cache(layer_id):
+    cache_path = get_attribute_cache_path(layer_id)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+
+def query_attribute_cache(layer_id, layer_attributes, start_index=None, count=None, sort_by=None, sort_order='asc',
+                          filters=None, search=None, property_names=None):
+    """
+    Answers an attribute table query (see generate_attribute_table) from the layer's attribute cache
+    """
+    attributes_list = layer_attributes.split(',')
+    for attribute in (property_names or []) + ([sort_by] if sort_by else []):
+        if attribute not in attributes_list:
+            raise ValueError('The layer has no attribute "%s".' % attribute)
+
+    conn = sqlite3.connect(get_attribute_cache_path(layer_id))
+    try:
+        where, args = build_attribute_cache_where(conn, attributes_list, filters, search)
+
+        columns = property_names or attributes_list
+        sql = 'SELECT %s FROM attributes%s' % (', '.join(quote_sql_identifier(column) for column in columns), where)
+        if sort_by:
+            sql += ' ORDER BY %s %s' % (quote_sql_identifier(sort_by), 'DESC' if sort_order == 'desc' else 'ASC')
+        else:
+            sql += ' ORDER BY rowid'
+        page_args = []
+        if count is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            page_args = [min(count, ATTRIBUTE_TABLE_MAX_COUNT), start_index or 0]
+
+        # LIKE is case-sensitive in CQL
+        conn.execute('PRAGMA case_sensitive_like = ON')
+        rows = conn.execute(sql, args + page_args).fetchall()
+        num_features_total = conn.execute('SELECT COUNT(*) FROM attributes').fetchone()[0]
+        if where:
+            num_features = conn.execute('SELECT COUNT(*) FROM attributes%s' % where, args).fetchone()[0]
+        else:
+            num_features = num_features_total
+    finally:
+        conn.close()
+
+    return {
+        'feature_properties': [dict(zip(columns, row)) for row in rows],
+        'num_features': num_features,
+        'num_features_total': num_features_total
+    }
+
+
+def build_attribute_cache_where(conn, attributes_list, filters=None, search=None):
+    """
+    Builds the WHERE clause of an attribute cache query and its arguments, from attribute conditions (see
+    generate_attribute_table) and a search text. Values are converted to the declared types of their columns.
+    """
+    column_types = dict((name, sql_type) for _, name, sql_type, _, _, _ in
+                        conn.execute('PRAGMA table_info(attributes)').fetchall())
+
+    conditions = []
+    args = []
+    for f in filters or []:
+        attribute, operator = check_attribute_filter(attributes_list, f)
+        value = f.get('value')
+        if value is None:
+            conditions.append('%s IS %sNULL' % (quote_sql_identifier(attribute), 'NOT ' if operator == '<>' else ''))
+            continue
+        if operator == 'ILIKE':
+            conditions.append('lower(%s) LIKE lower(?)' % quote_sql_identifier(attribute))
+        else:
+            conditions.append('%s %s ?' % (quote_sql_identifier(attribute), operator))
+        args.append(value if operator in ['LIKE', 'ILIKE'] else get_sql_value(value, column_types.get(attribute)))
+    if search:
+        conditions.append('(%s)' % ' OR '.join('lower(CAST(%s AS TEXT)) LIKE ?' % quote_sql_identifier(attribute)
+                                               for attribute in attributes_list))
+        args += ['%%%s%%' % search.lower()] * len(attributes_list)
+
+    return ' WHERE %s' % ' AND '.join(conditions) if conditions else '', args
+
+
+def get_sql_value(value, sql_type):
+    """
+    Converts a filter value to the declared type of the attribute cache column it is compared with, so that text
+    attributes such as zero-padded codes are compared as text. Values that do not convert are left as they are.
+    """
+    convert = {'INTEGER': int, 'REAL': float}.get(sql_type)
+    if convert is None:
+        return value if isinstance(value, basestring) else unicode(value)
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        if convert is int:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                pass
+
+    return value
+
+
+def get_attribute_summary(layer_id):
+    """
+    Summarizes each attribute of a vector layer from its attribute cache: the number of values, the minimum and
+    maximum, and the mean of numeric attributes or the number of distinct values of the others.
+    """
+    return_obj = {
+        'success': False,
+        'message': None,
+        'summary': None
+    }
+    try:
+        cache_path = get_attribute_cache_path(layer_id)
+    except ValueError as e:
+        return_obj['message'] = str(e)
+        return return_obj
+    if not os.path.exists(cache_path):
+        return_obj['message'] = 'There is no attribute summary for this layer.'
+        return return_obj
+
+    summary = []
+    conn = sqlite3.connect(cache_path)
+    try:
+        for _, name, sql_type, _, _, _ in conn.execute('PRAGMA table_info(attributes)').fetchall():
+            column = quote_sql_identifier(name)
+            if sql_type in ['INTEGER', 'REAL']:
+                num_values, min_value, max_value, mean = conn.execute(
+                    'SELECT COUNT({0}), MIN({0}), MAX({0}), AVG({0}) FROM attributes'.format(column)).fetchone()
+                num_distinct = None
+            else:
+                num_values, min_value, max_value, num_distinct = conn.execute(
+                    'SELECT COUNT({0}), MIN({0}), MAX({0}), COUNT(DISTINCT {0}) FROM attributes'.format(column))\
+                    .fetchone()
+                mean = None
+            summary.append({
+                'attribute': name,
+                'type': sql_type,
+                'num_values': num_values,
+                'min': min_value,
+                'max': max_value,
+                'mean': mean,
+                'num_distinct': num_distinct
+            })
+    except sqlite3.Error as e:
+        return_obj['message'] = str(e)
+        return return_obj
+    finally:
+        conn.close()
+
+    return_obj['summary'] = summary
+    return_obj['success'] = True
+
+    return return_obj
+
+
+def get_cql_literal(value, force_string=False):
+    if value is None:
+        return 'NULL'
+    value = unicode(value)
+    if not force_string:
+        try:
+            float(value)
+            return value
+        except ValueError:
+            pass
+
+    return "'%s'" % value.replace("'", "''")
+
+
+def get_wfs_feature_count(layer_id, cql_filter=None):
+    params = {
+        'service': 'wfs',
+        'version': '2.0.0',
+        'request': 'GetFeature',
+        'typeNames': layer_id,
+        'resultType': 'hits'
+    }
+    if cql_filter:
+        params['CQL_FILTER'] = cql_filter
+
+    r = make_geoserver_request('wfs', params)
+    match = re.search(r'numberMatched="(\d+)"', r.text)
+
+    return int(match.group(1)) if match else None
+
+
+def set_currently_testing(val):
+    global currently_testing
+    currently_testing = val
+
+
+def get_features_on_click(params_str):
+    params = loads(params_str)
+    r = make_geoserver_request('wms', params)
+    return r.json()
+
+
+def get_feature_info_pool():
+    """
+    Returns the thread pool that identify requests share, so that a process sends at most FEATURE_INFO_CONCURRENCY
+    of them to GeoServer at a time
+    """
+    global feature_info_pool
+    with feature_info_pool_lock:
+        if feature_info_pool is None:
+            feature_info_pool = ThreadPool(FEATURE_INFO_CONCURRENCY)
+
+    return feature_info_pool
+
+
+def identify_features(layer_ids, x, y, resolution):
+    """
+    Finds the features of each layer under a map click. Vector layers with a spatial index are answered locally (see
+    query_spatial_index). Layers whose features at this pixel and zoom level were found within FEATURE_INFO_TTL are
+    answered from the cache; the others are asked of GeoServer with GetFeatureInfo requests sent in parallel over the
+    shared GeoServer session.
+    :param layer_ids: list of GeoServer layer ids
+    :param x: x coordinate of the click, in EPSG:3857
+    :param y: y coordinate of the click, in EPSG:3857
+    :param resolution: map units per pixel of the map view
+    :return: return_obj whose "results" maps each layer id to its list of GeoJSON features, or None if the layer could
+    not be queried
+    """
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {}
+    }
+    if resolution <= 0:
+        return_obj['message'] = 'The map resolution must be positive.'
+        return return_obj
+
+    # Snap the click to the pixel grid of the closest standard zoom level, so that nearby clicks share cache entries
+    zoom = max(0, int(round(log(WEB_MERCATOR_ZOOM_0_RESOLUTION / resolution, 2))))
+    snapped_resolution = WEB_MERCATOR_ZOOM_0_RESOLUTION / 2 ** zoom
+    pixel = (int(floor(x / snapped_resolution)), int(floor(y / snapped_resolution)))
+
+    results = return_obj['results']
+    layers_to_query = []
+    remote_layer_ids = []
+    tolerance = (FEATURE_INFO_PIXEL_TOLERANCE + 0.5) * resolution
+    for layer_id in layer_ids:
+        features = None
+        try:
+            features = query_spatial_index(layer_id, (x - tolerance, y - tolerance, x + tolerance, y + tolerance),
+                                           point=(x, y), tolerance=tolerance, max_features=FEATURE_INFO_MAX_FEATURES)
+        except (sqlite3.Error, ValueError) as e:
+            logger.error('Spatial index of %s could not be read, asking GeoServer: %s' % (layer_id, str(e)))
+        if features is None:
+            remote_layer_ids.append(layer_id)
+        else:
+            results[layer_id] = features
+
+    for layer_id in remote_layer_ids:
+        features = feature_info_cache.get((layer_id, zoom, pixel))
+        if features is not None:
+            results[layer_id] = features
+        else:
+            layers_to_query.append(layer_id)
+
+    def get_layer_features(layer_id):
+        half_width = (FEATURE_INFO_PIXEL_TOLERANCE + 0.5) * snapped_resolution
+        center_x = (pixel[0] + 0.5) * snapped_resolution
+        center_y = (pixel[1] + 0.5) * snapped_resolution
+        params = {
+            'service': 'WMS',
+            'version': '1.1.1',
+            'request': 'GetFeatureInfo',
+            'layers': layer_id,
+            'query_layers': layer_id,
+            'styles': '',
+            'srs': 'EPSG:3857',
+            'bbox': '%s,%s,%s,%s' % (center_x - half_width, center_y - half_width,
+                                     center_x + half_width, center_y + half_width),
+            'width': 2 * FEATURE_INFO_PIXEL_TOLERANCE + 1,
+            'height': 2 * FEATURE_INFO_PIXEL_TOLERANCE + 1,
+            'x': FEATURE_INFO_PIXEL_TOLERANCE,
+            'y': FEATURE_INFO_PIXEL_TOLERANCE,
+            'info_format': 'application/json',
+            'feature_count': FEATURE_INFO_MAX_FEATURES
+        }
+        try:
+            r = make_geoserver_request('wms', params)
+            r.raise_for_status()
+            return r.json().get('features', [])
+        except Exception as e:
+            logger.error('GetFeatureInfo failed for %s: %s' % (layer_id, str(e)))
+            return None
+
+    if layers_to_query:
+        layers_features = get_feature_info_pool().map(get_layer_features, layers_to_query)
+
+        for layer_id, features in zip(layers_to_query, layers_features):
+            results[layer_id] = features
+            if features is not None:
+                feature_info_cache.set((layer_id, zoom, pixel), features)
+
+    return_obj['success'] = True
+
+    return return_obj
+
+
+def identify_features_in_bbox(layer_ids, bbox):
+    """
+    Finds the features of each vector layer within a bounding box, from the layer's spatial index or else with a WFS
+    GetFeature request
+    :param layer_ids: list of GeoServer layer ids
+    :param bbox: (minx, miny, maxx, maxy) in EPSG:3857
+    :return: return_obj whose "results" maps each layer id to its list of GeoJSON features, or None if the layer could
+    not be queried
+    """
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {}
+    }
+
+    def get_layer_features(layer_id):
+        try:
+            features = query_spatial_index(layer_id, bbox, max_features=FEATURE_INFO_MAX_FEATURES)
+            if features is not None:
+                return features
+        except (sqlite3.Error, ValueError) as e:
+            logger.error('Spatial index of %s could not be read, asking GeoServer: %s' % (layer_id, str(e)))
+
+        params = {
+            'service': 'WFS',
+            'version': '1.1.0',
+            'request': 'GetFeature',
+            'typeName': layer_id,
+            'srsName': 'EPSG:3857',
+            'bbox': '%s,%s,%s,%s,EPSG:3857' % tuple(bbox),
+            'maxFeatures': FEATURE_INFO_MAX_FEATURES,
+            'outputFormat': 'application/json'
+        }
+        try:
+            r = make_geoserver_request('wfs', params)
+            r.raise_for_status()
+            return r.json().get('features', [])
+        except Exception as e:
+            logger.error('GetFeature failed for %s: %s' % (layer_id, str(e)))
+            return None
+
+    if layer_ids:
+        return_obj['results'] = dict(zip(layer_ids, get_feature_info_pool().map(get_layer_features, layer_ids)))
+    return_obj['success'] = True
+
+    return return_obj
+
+
+def prepare_result_for_layer_db(result):
 
     result.pop('project_info', None)  # parameter "project_info" not expected in following call
 
@@ -1088,32 +2592,163 @@ def prepare_result_for_layer_db(result):
 
 
 def get_res_mod_date(hs, res_id):
+    """
+    Returns when a resource was last modified. The date comes from the resource's system metadata, which is much
+    lighter than its science metadata, and is shared by all worker processes through the persistent store. HydroShare
+    is asked again only once the stored date is older than RES_FRESHNESS_WINDOW.
+    :param hs: hs_restclient.HydroShare object
+    :param res_id: the resource id
+    :return: naive UTC datetime, or None if it could not be determined
+    """
+    freshness = ResourceFreshness.get_freshness_by_res_id(res_id)
+    if freshness and datetime.utcnow() - freshness.checked < RES_FRESHNESS_WINDOW:
+        return freshness.res_mod_date
+
     date_modified = None
     try:
+        md = hs.getSystemMetadata(res_id)
+        date_modified = parse_hs_datetime(md['date_last_updated'])
+        ResourceFreshness.set_res_mod_date(res_id, date_modified)
+    except Exception as e:
+        logger.error(str(e))
+
+    return date_modified
+
+
+def parse_hs_datetime(date_string):
+    """
+    Parses a HydroShare timestamp (e.g. "2017-06-05T16:53:57.520947Z" or "2017-06-05T16:53:57+00:00") into a naive
+    UTC datetime. Timestamps with an offset (e.g. "-06:00") are converted to UTC.
+    """
+    from dateutil.parser import parse
+    from dateutil.tz import tzutc
+
+    try:
+        date = parse(date_string)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError('Unrecognized date format: %s' % date_string)
+    if date.tzinfo is not None:
+        date = date.astimezone(tzutc()).replace(tzinfo=None)
+
+    return date
+
+
+def get_res_metadata(hs, res_id, refresh=False):
+    """
+    Returns the parsed science metadata of a resource. The RDF is fetched from HydroShare and parsed at most once per
+    RES_METADATA_TTL, so the several steps of processing a resource all share a single fetch.
+    :param hs: hs_restclient.HydroShare object
+    :param res_id: the resource id
+    :param refresh: if True, the metadata is fetched even if it is cached. Use this where the fetch doubles as a check
+                    that the user can access the resource.
+    :return: ResourceMetadata object
+    """
+    res_metadata = None if refresh else res_metadata_cache.get(res_id)
+    if res_metadata is None:
+        rdf = hs.getScienceMetadataRDF(res_id)
+        rdf_hash = sha1(rdf.encode('utf-8') if isinstance(rdf, unicode) else rdf).hexdigest()
+        # An expired entry is reused as it is if the RDF has not changed since it was parsed
+        res_metadata = res_metadata_cache.get(res_id, allow_expired=True)
+        if res_metadata is None or res_metadata.rdf_hash != rdf_hash:
+            res_metadata = ResourceMetadata(res_id, rdf, rdf_hash)
+        res_metadata_cache.set(res_id, res_metadata)
 
-        md_dict = xmltodict.parse(hs.getScienceMetadataRDF(res_id))
+    return res_metadata
 
-        for date_obj in md_dict['rdf:RDF']['rdf:Description'][0]['dc:date']:
+
+class ResourceMetadata(object):
+    """
+    Science metadata of a HydroShare resource, parsed from its RDF
+    """
+    def __init__(self, res_id, rdf, rdf_hash):
+        self.res_id = res_id
+        self.rdf_hash = rdf_hash
+        descriptions = xmltodict.parse(rdf)['rdf:RDF']['rdf:Description']
+        self.description = descriptions[0] if isinstance(descriptions, list) else descriptions
+
+    def _get_list(self, key):
+        value = self.description.get(key)
+        if value is None:
+            return []
+
+        return value if isinstance(value, list) else [value]
+
+    @property
+    def mod_date(self):
+        for date_obj in self._get_list('dc:date'):
             if 'dcterms:modified' in date_obj:
-                date_modified = date_obj['dcterms:modified']['rdf:value']
+                return date_obj['dcterms:modified']['rdf:value']
+
+        return None
+
+    @property
+    def coverage(self):
+        """
+        List of the coverages of the resource. Each is a dictionary with a "type" ("point", "box" or "period") and
+        the "values" of the coverage, with numbers converted to floats.
+        """
+        coverage = []
+        for coverage_obj in self._get_list('dc:coverage'):
+            for key, value in coverage_obj.items():
+                coverage_type = key.split(':')[-1]
+                values = {}
+                for item in value['rdf:value'].split(';'):
+                    if '=' in item:
+                        name, val = item.split('=', 1)
+                        try:
+                            values[name.strip()] = float(val)
+                        except ValueError:
+                            values[name.strip()] = val.strip()
+                coverage.append({
+                    'type': coverage_type,
+                    'values': values
+                })
+
+        return coverage
+
+    @property
+    def site_info(self):
+        for coverage_obj in self.coverage:
+            if coverage_obj['type'] == 'point':
+                values = coverage_obj['values']
+                return {
+                    'lon': values.get('east'),
+                    'lat': values.get('north'),
+                    'projection': values.get('projection')
+                }
 
-    except Exception as e:
-        logger.error(str(e))
+        return None
 
-    return date_modified
+    @property
+    def band_info(self):
+        try:
+            band_info_raw = self.description['hsterms:BandInformation']['rdf:Description']
+        except (KeyError, TypeError):
+            return None
+
+        band_info = {}
+        if 'hsterms:minimumValue' in band_info_raw:
+            band_info['min'] = float(band_info_raw['hsterms:minimumValue'])
+        if 'hsterms:maximumValue' in band_info_raw:
+            band_info['max'] = float(band_info_raw['hsterms:maximumValue'])
+        if 'hsterms:noDataValue' in band_info_raw:
+            band_info['nd'] = float(band_info_raw['hsterms:noDataValue'])
+        if 'hsterms:variableName' in band_info_raw:
+            band_info['variable'] = str(band_info_raw['hsterms:variableName'])
+        if 'hsterms:variableUnit' in band_info_raw:
+            band_info['units'] = str(band_info_raw['hsterms:variableUnit'])
+
+        return band_info
 
 
 def res_was_updated(db_date, res_date):
-    try:
-        db_date_obj = datetime.strptime(db_date.split('+')[0], '%Y-%m-%dT%H:%M:%S.%f')
-        res_date_obj = datetime.strptime(res_date.split('+')[0], '%Y-%m-%dT%H:%M:%S.%f')
-        if db_date_obj < res_date_obj:
-            return True
-    except Exception as e:
-        email_admin('Minor Error Report', exc_info(), str(e))
+    if db_date is None:
         return True
+    if res_date is None:
+        # HydroShare could not be asked, so the cached layers are served as they are
+        return False
 
-    return False
+    return db_date < res_date
 
 
 def get_res_files_list(hs, res_id):
@@ -1210,8 +2845,9 @@ def get_res_layers_from_db(hs, res_id, res_type, res_title, username):
     db_res_layers = Layer.get_layers_by_associated_res_id(res_id)
 
     if db_res_layers:
+        res_mod_date = get_res_mod_date(hs, res_id)
         for res_layer in db_res_layers:
-            flag_reload_layer = res_was_updated(res_layer.res_mod_date, get_res_mod_date(hs, res_id))
+            flag_reload_layer = res_was_updated(res_layer.res_mod_date, res_mod_date)
 
             if flag_reload_layer:
                 Layer.remove_layers_by_res_id(res_id)
@@ -1221,19 +2857,7 @@ def get_res_layers_from_db(hs, res_id, res_type, res_title, username):
                     res_layers = response['results']
                 break
             else:
-                res_layer = {
-                    'res_id': res_id,
-                    'res_type': res_layer.associated_res_type,
-                    'layer_name': res_layer.name,
-                    'layer_id': res_layer.layer_id,
-                    'layer_extents': loads(res_layer.extents) if res_layer.extents else None,
-                    'layer_attributes': res_layer.attributes,
-                    'geom_type': res_layer.geom_type,
-                    'band_info': loads(res_layer.band_info) if res_layer.band_info else None,
-                    'site_info': loads(res_layer.site_info) if res_layer.site_info else None,
-                    'public_fname': res_layer.associated_file_name
-                }
-                res_layers.append(res_layer)
+                res_layers.append(get_layer_obj_from_db_layer(res_layer))
 
     return res_layers
 
@@ -1252,22 +2876,105 @@ def get_generic_file_layer_from_db(hs, res_id, res_fname, file_index, username):
             if response['success']:
                 generic_file_layer = response['results']
         else:
-            generic_file_layer = {
-                'res_id': res_id,
-                'res_type': db_generic_file_layer.associated_res_type,
-                'layer_name': db_generic_file_layer.name,
-                'layer_id': db_generic_file_layer.layer_id,
-                'layer_extents': loads(db_generic_file_layer.extents) if db_generic_file_layer.extents else None,
-                'layer_attributes': db_generic_file_layer.attributes,
-                'geom_type': db_generic_file_layer.geom_type,
-                'band_info': loads(db_generic_file_layer.band_info) if db_generic_file_layer.band_info else None,
-                'site_info': loads(db_generic_file_layer.site_info) if db_generic_file_layer.site_info else None,
-                'public_fname': db_generic_file_layer.associated_file_name
-            }
+            generic_file_layer = get_layer_obj_from_db_layer(db_generic_file_layer)
 
     return generic_file_layer
 
 
+def get_layer_obj_from_db_layer(db_layer):
+    return {
+        'res_id': db_layer.associated_res_id,
+        'res_type': db_layer.associated_res_type,
+        'layer_name': db_layer.name,
+        'layer_id': db_layer.layer_id,
+        'layer_extents': loads(db_layer.extents) if db_layer.extents else None,
+        'layer_attributes': db_layer.attributes,
+        'geom_type': db_layer.geom_type,
+        'band_info': loads(db_layer.band_info) if db_layer.band_info else None,
+        'site_info': loads(db_layer.site_info) if db_layer.site_info else None,
+        'public_fname': db_layer.associated_file_name,
+        'raster_conversion': db_layer.raster_conversion
+    }
+
+
+def get_layers_for_res_ids_from_db(hs, res_ids, res_files=None):
+    """
+    Looks up the cached layers of several resources, and of several files of generic resources, with a single query.
+    Access to each resource is still checked (concurrently). Resources and files that have no layer cached, or whose
+    cached layers are out of date, are returned in "missing" and "missing_files" so that the caller can load them one
+    by one through add_hs_res and add_generic_res_file.
+    :param hs: hs_restclient.HydroShare object
+    :param res_ids: list of resource ids
+    :param res_files: list of (res_id, res_fname) tuples of generic resource files
+    :return: return_obj whose "results" maps each found resource id to its list of layers, and whose "file_results"
+    maps the resource id of each found file to a dictionary of its layers by file name
+    """
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {},
+        'file_results': {},
+        'missing': [],
+        'missing_files': [],
+        'denied': {}
+    }
+    res_files = res_files or []
+    all_res_ids = list(set(res_ids) | set(res_id for res_id, _ in res_files))
+
+    if not all_res_ids:
+        return_obj['success'] = True
+        return return_obj
+
+    db_layers_by_res_id = {}
+    for db_layer in Layer.get_layers_for_res_ids(all_res_ids):
+        db_layers_by_res_id.setdefault(db_layer.associated_res_id, []).append(db_layer)
+
+    def check_res(res_id):
+        r = validate_res_request(hs, res_id)
+        res_mod_date = get_res_mod_date(hs, res_id) if r['can_access'] and res_id in db_layers_by_res_id else None
+        return res_id, r, res_mod_date
+
+    pool = ThreadPool(min(HS_DOWNLOAD_CONCURRENCY, len(all_res_ids)))
+    try:
+        checked_res_list = pool.map(check_res, all_res_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+    checked_res = {}
+    for res_id, r, res_mod_date in checked_res_list:
+        if not r['can_access']:
+            return_obj['denied'][res_id] = r['message']
+        else:
+            checked_res[res_id] = res_mod_date
+
+    for res_id in res_ids:
+        if res_id not in checked_res:
+            continue
+        db_layers = db_layers_by_res_id.get(res_id)
+        if not db_layers or any(res_was_updated(db_layer.res_mod_date, checked_res[res_id]) for db_layer in db_layers):
+            return_obj['missing'].append(res_id)
+        else:
+            return_obj['results'][res_id] = [get_layer_obj_from_db_layer(db_layer) for db_layer in db_layers]
+
+    for res_id, res_fname in res_files:
+        if res_id not in checked_res:
+            continue
+        db_layer = None
+        for layer in db_layers_by_res_id.get(res_id, []):
+            if layer.associated_file_name == res_fname:
+                db_layer = layer
+                break
+        if db_layer is None or res_was_updated(db_layer.res_mod_date, checked_res[res_id]):
+            return_obj['missing_files'].append({'res_id': res_id, 'res_fname': res_fname})
+        else:
+            return_obj['file_results'].setdefault(res_id, {})[res_fname] = get_layer_obj_from_db_layer(db_layer)
+
+    return_obj['success'] = True
+
+    return return_obj
+
+
 def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
     return_obj = {
         'success': False,
@@ -1290,7 +2997,7 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
     }
     '''
 
-    hs_tempdir = get_hs_tempdir(username, file_index)
+    hs_tempdir = make_staging_dir()
     layer_id = None
     layer_attributes = None
     layer_extents = None
@@ -1299,6 +3006,7 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
     site_info = None
     project_info = None
     res_type = None
+    raster_conversion = None
 
     try:
 
@@ -1310,6 +3018,9 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
             res_type = results['res_type'] if 'res_type' in results else None
             layer_name = results['layer_name'] if 'layer_name' in results else None
             public_fname = results['public_fname'] if 'public_fname' in results else None
+            raster_profile = results['raster_profile'] if 'raster_profile' in results else None
+            is_image_pyramid = results['is_image_pyramid'] if 'is_image_pyramid' in results else None
+            raster_conversion = results['raster_conversion'] if 'raster_conversion' in results else None
 
             if res_type == 'GenericResource':
 
@@ -1321,7 +3032,8 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
 
             elif res_type == 'GeographicFeatureResource' or res_type == 'RasterResource':
 
-                check_res = upload_file_to_geoserver(res_id, res_type, res_filepath, file_index)
+                with geoserver_upload_slots:
+                    check_res = upload_file_to_geoserver(res_id, res_type, res_filepath, file_index, is_image_pyramid)
 
                 if not check_res['success']:
                     return_obj['message'] = check_res['message']
@@ -1339,9 +3051,9 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
                         layer_attributes = response['attributes']
                         layer_extents = response['extents']
                         geom_type = response['geom_type']
-                        tif_file = '{store_id}.tif'.format(store_id=get_geoserver_store_id(res_id, file_index))
-                        band_info_tif_path = os.path.join(hs_tempdir, tif_file)
-                        band_info = get_band_info(hs, res_id, res_type, band_info_tif_path)
+                        band_info = get_band_info(hs, res_id, res_type, raster_profile)
+                        if res_type == 'GeographicFeatureResource':
+                            build_attribute_cache(layer_id, res_filepath)
 
             results = {
                 'res_id': res_id.replace('_mapProject', ''),
@@ -1355,7 +3067,8 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
                 'site_info': site_info,
                 'project_info': project_info,
                 'public_fname': public_fname,
-                'res_mod_date': get_res_mod_date(hs, res_id)
+                'res_mod_date': get_res_mod_date(hs, res_id),
+                'raster_conversion': raster_conversion
             }
 
             if not project_info:
@@ -1386,11 +3099,16 @@ def process_generic_res_file(hs, res_id, res_file_name, username, file_index=0):
                     host=gethostname(), id=res_id, type=res_type, name=user_info['username'], email=user_info['email'])
                 email_admin('Error Report', traceback=exc_info(), custom_msg=msg)
     finally:
-        os.system('rm -rf %s' % hs_tempdir)
+        remove_hs_tempdir(hs_tempdir)
 
     return return_obj
 
 
+def download_res_file(hs, res_id, res_file_name, destination):
+    with hs_download_slots:
+        hs.getResourceFile(res_id, res_file_name, destination=destination)
+
+
 def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_index):
     return_obj = {
         'success': False,
@@ -1402,7 +3120,8 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
     {
             'res_filepath': None,
             'res_type': res_type,
-            'layer_name': None
+            'layer_name': None,
+            'raster_profile': None
     }
     '''
 
@@ -1410,7 +3129,7 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
     res_type = 'GenericResource'
 
     if res_file_name == 'mapProject.json':
-        hs.getResourceFile(res_id, res_file_name, destination=hs_tempdir)
+        download_res_file(hs, res_id, res_file_name, hs_tempdir)
         results = {
             'res_filepath': res_fpath,
             'res_type': res_type,
@@ -1425,10 +3144,25 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
         fname_and_ext = os.path.splitext(res_file_name)
         fname = fname_and_ext[0]
         fext = fname_and_ext[1]
+        raster_profile = None
+        is_image_pyramid = None
+        raster_conversion = None
+
+        if fext == '.shp':
+            download_fnames = ['{name}{ext}'.format(name=fname, ext=ext) for ext in req_shp_file_exts]
+        elif fext in kml_exts or fext in tif_exts:
+            download_fnames = [res_file_name]
+        else:
+            download_fnames = []
+        if download_fnames:
+            r = reserve_res_file_bytes(hs, res_id, download_fnames, hs_tempdir)
+            if not r['success']:
+                return_obj['message'] = r['message']
+                return return_obj
 
         if fext in kml_exts:
             if not os.path.exists(res_fpath):
-                hs.getResourceFile(res_id, res_file_name, destination=hs_tempdir)
+                download_res_file(hs, res_id, res_file_name, hs_tempdir)
             # Openlayers KML Implementation
             if fext == '.kmz':
                 os.system('unzip -q -d %s %s' % (hs_tempdir, fpath))
@@ -1439,7 +3173,8 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
             shp_fname = '{name}.shp'.format(name=get_geoserver_store_id(res_id, file_index))
             shp_output_path = os.path.join(hs_tempdir, shp_fname)
 
-            os.system('ogr2ogr -f "ESRI Shapefile" {0} {1}'.format(shp_output_path, kml_path))
+            with gdal_slots:
+                os.system('ogr2ogr -f "ESRI Shapefile" {0} {1}'.format(shp_output_path, kml_path))
 
             if os.path.exists(shp_output_path):
                 res_fpath = os.path.splitext(shp_output_path)[0]
@@ -1454,7 +3189,7 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
                 for ext in req_shp_file_exts:
                     f_name = '{name}{ext}'.format(name=fname, ext=ext)
                     if not os.path.exists(os.path.join(hs_tempdir, fname)):
-                        hs.getResourceFile(res_id, f_name, destination=hs_tempdir)
+                        download_res_file(hs, res_id, f_name, hs_tempdir)
             except hs_r.HydroShareNotFound:
                 is_shapefile = False
 
@@ -1478,7 +3213,7 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
 
                 r = check_crs(res_type, prj_path)
                 return_obj['message'] = r['message'] % os.path.basename(prj_path) if r['message'] else None
-                if r['success'] and r['crsWasChanged']:
+                if r['success'] and r['new_wkt']:
                     with open(prj_path, 'w') as f:
                         f.seek(0)
                         f.write(r['new_wkt'])
@@ -1495,21 +3230,22 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
 
         elif fext in tif_exts:
             if not os.path.exists(res_fpath):
-                hs.getResourceFile(res_id, res_file_name, destination=hs_tempdir)
+                download_res_file(hs, res_id, res_file_name, hs_tempdir)
             res_type = 'RasterResource'
             tif_name = '{name}.tif'.format(name=get_geoserver_store_id(res_id, file_index))
             new_fpath = os.path.join(hs_tempdir, tif_name)
             os.rename(fpath, new_fpath)
-            r = check_crs(res_type, new_fpath)
+            raster_profile = RasterProfile(new_fpath)
+            r = check_crs(res_type, new_fpath, raster_profile)
             return_obj['message'] = r['message'] % res_file_name if r['message'] else None
             if not r['success']:
                 return return_obj
             else:
                 if r['crsWasChanged']:
-                    code = r['code']
-                    os.system('gdal_edit.py -a_srs {0} {1}'.format(code, new_fpath))
-                res_fpath = new_fpath.replace('tif', 'zip')
-                zip_files(new_fpath, res_fpath)
+                    raster_profile.set_srs(r['code'])
+                raster_profile, raster_conversion = normalize_raster(raster_profile)
+                res_fpath = stage_raster_for_geoserver(new_fpath)
+                is_image_pyramid = False
         else:
             is_full_generic = True
 
@@ -1521,6 +3257,9 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
             'res_filepath': res_fpath,
             'res_type': res_type,
             'layer_name': res_file_name,
+            'raster_profile': raster_profile,
+            'is_image_pyramid': is_image_pyramid,
+            'raster_conversion': raster_conversion
         }
 
     return_obj['results'] = results
@@ -1529,46 +3268,372 @@ def get_info_from_generic_res_file(hs, res_id, res_file_name, hs_tempdir, file_i
     return return_obj
 
 
-def extract_band_info_from_file(raster_fpath):
-    from gdal import Open
-    from gdalconst import GA_ReadOnly
-    from numpy import allclose as numpy_allclose
-
-    raster_dataset = Open(raster_fpath, GA_ReadOnly)
-
-    # get raster band count
-    if raster_dataset:
-        band_info = {}
-        band_count = raster_dataset.RasterCount
+class RasterProfile(object):
+    """
+    Everything the app needs to know about a raster file, read from a single open of the file. Band statistics are
+    only computed the first time they are asked for. Exact statistics are accumulated over strips of
+    STATS_STRIP_PIXELS, so only one strip is held in memory at a time; rasters larger than APPROX_STATS_MIN_PIXELS
+    get approximate statistics computed from their overviews instead.
+    """
+    APPROX_STATS_MIN_PIXELS = 2048 * 2048
+    STATS_STRIP_PIXELS = 1024 * 1024
+    HISTOGRAM_BUCKETS = 256
+
+    def __init__(self, raster_fpath):
+        from gdal import Open
+        from gdalconst import GA_ReadOnly
+
+        self.raster_fpath = raster_fpath
+        self.wkt = None
+        self.geotransform = None
+        self.size = None
+        self.extents = None
+        self.band_count = 0
+        self.nd = None
+        self.units = None
+        self.overview_count = 0
+        self.block_size = None
+        self.layout = None
+        self._stats = None
+
+        raster_dataset = Open(raster_fpath, GA_ReadOnly)
+        if raster_dataset is None:
+            return
+
+        self.wkt = raster_dataset.GetProjection()
+        self.geotransform = raster_dataset.GetGeoTransform()
+        self.size = (raster_dataset.RasterXSize, raster_dataset.RasterYSize)
+        self.band_count = raster_dataset.RasterCount
+
+        x_min, pixel_width, _, y_max, _, pixel_height = self.geotransform
+        self.extents = {
+            'minx': x_min,
+            'maxx': x_min + pixel_width * self.size[0],
+            'miny': y_max + pixel_height * self.size[1],
+            'maxy': y_max
+        }
 
-        if band_count == 1:
+        if self.band_count >= 1:
             band = raster_dataset.GetRasterBand(1)
-            minimum, maximum, _, _ = band.ComputeStatistics(False)
-            no_data = band.GetNoDataValue()
-            new_no_data = None
+            self.nd = band.GetNoDataValue()
+            self.units = band.GetUnitType()
+            self.overview_count = band.GetOverviewCount()
+            self.block_size = tuple(band.GetBlockSize())
+        self.layout = raster_dataset.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE')
+
+    @property
+    def is_readable(self):
+        return self.size is not None
+
+    @property
+    def is_cloud_optimized(self):
+        """
+        True if the raster is a COG, or is at least tiled and has overviews, so that GeoServer never has to read full
+        resolution data to render a zoomed-out view
+        """
+        if self.layout == 'COG':
+            return True
+        if not self.is_readable or self.block_size is None:
+            return False
+        is_tiled = self.block_size[0] < self.size[0]
+        is_small = max(self.size) <= 512
+
+        return is_small or (is_tiled and self.overview_count > 0)
+
+    @property
+    def use_approx_stats(self):
+        return self.size[0] * self.size[1] > self.APPROX_STATS_MIN_PIXELS
+
+    @property
+    def stats(self):
+        """
+        Statistics of the first band as a dictionary with the keys min, max, mean, std, nd and histogram
+        """
+        if self._stats is None and self.is_readable and self.band_count >= 1:
+            with gdal_slots:
+                if self.use_approx_stats:
+                    self._stats = self._compute_approx_stats()
+                else:
+                    self._stats = self._compute_exact_stats()
+
+        return self._stats
+
+    def _compute_exact_stats(self):
+        from gdal import Open
+        from gdalconst import GA_ReadOnly
+        from numpy import histogram, sqrt, zeros
+
+        raster_dataset = Open(self.raster_fpath, GA_ReadOnly)
+        band = raster_dataset.GetRasterBand(1)
+        nd = None
+        num_values = 0
+        mean = 0.0
+        sum_sq_dev = 0.0
+        minimum = None
+        maximum = None
+        # First pass: extremes, and mean and variance merged strip by strip
+        for values, nd_value in self._read_valid_values(band):
+            if nd is None:
+                nd = nd_value
+            if values.size == 0:
+                continue
+            strip_min = float(values.min())
+            strip_max = float(values.max())
+            minimum = strip_min if minimum is None else min(minimum, strip_min)
+            maximum = strip_max if maximum is None else max(maximum, strip_max)
+            strip_values = values.astype('float64', copy=False)
+            strip_mean = float(strip_values.mean())
+            strip_sum_sq_dev = float(((strip_values - strip_mean) ** 2).sum())
+            delta = strip_mean - mean
+            total = num_values + values.size
+            mean += delta * values.size / total
+            sum_sq_dev += strip_sum_sq_dev + delta ** 2 * num_values * values.size / total
+            num_values = total
+
+        if num_values == 0:
+            return None
+        if nd is None:
+            nd = self.nd
+
+        # Second pass: the histogram, now that its range is known
+        counts = zeros(self.HISTOGRAM_BUCKETS, dtype='int64')
+        for values, _ in self._read_valid_values(band):
+            counts += histogram(values, bins=self.HISTOGRAM_BUCKETS, range=(minimum, maximum))[0]
+
+        return {
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'std': float(sqrt(sum_sq_dev / num_values)),
+            'nd': nd,
+            'histogram': counts.tolist()
+        }
 
-            if no_data and numpy_allclose(minimum, no_data):
-                new_no_data = minimum
-            elif no_data and numpy_allclose(maximum, no_data):
-                new_no_data = maximum
+    def _read_valid_values(self, band):
+        """
+        Reads the band in strips of about STATS_STRIP_PIXELS, so that memory use does not grow with the raster, and
+        yields each strip's values without nodata and NaN, along with the first value taken as nodata, if any
+        """
+        from numpy import isclose, isnan
+
+        x_size, y_size = self.size
+        rows_per_strip = max(self.block_size[1] if self.block_size else 1, self.STATS_STRIP_PIXELS // x_size, 1)
+        for y_off in range(0, y_size, rows_per_strip):
+            values = band.ReadAsArray(0, y_off, x_size, min(rows_per_strip, y_size - y_off)).ravel()
+            nd_value = None
+            if self.nd is not None:
+                # Values that only differ from the nodata value by float precision are treated as nodata, too
+                nodata_mask = isclose(values, self.nd)
+                if nodata_mask.any():
+                    nd_value = float(values[nodata_mask][0])
+                values = values[~nodata_mask]
+            values = values[~isnan(values)] if values.dtype.kind == 'f' else values
+
+            yield values, nd_value
+
+    def _compute_approx_stats(self):
+        from gdal import Open
+        from gdalconst import GA_ReadOnly
+
+        raster_dataset = Open(self.raster_fpath, GA_ReadOnly)
+        band = raster_dataset.GetRasterBand(1)
+        minimum, maximum, mean, std = band.ComputeStatistics(True)
+        histogram = band.GetHistogram(minimum, maximum, self.HISTOGRAM_BUCKETS, 0, 1)
+
+        return {
+            'min': minimum,
+            'max': maximum,
+            'mean': mean,
+            'std': std,
+            'nd': self.nd,
+            'histogram': histogram
+        }
 
-            if new_no_data is not None:
-                band.SetNoDataValue(new_no_data)
-                minimum, maximum, _, _ = band.ComputeStatistics(False)
+    def get_band_info(self):
+        if not self.is_readable:
+            return None
 
-            units = band.GetUnitType()
-            nd = band.GetNoDataValue()
+        band_info = {}
+        if self.band_count == 1:
+            stats = self.stats or {}
+            minimum = stats.get('min')
+            maximum = stats.get('max')
+            nd = stats.get('nd', self.nd)
             band_info = {
                 'variable': 'Unknown',
-                'units': units if units else 'Unknown',
+                'units': self.units if self.units else 'Unknown',
                 'nd': nd if nd else 'Unknown',
                 'max': maximum if maximum else 'Unknown',
                 'min': minimum if minimum else 'Unknown',
             }
-    else:
-        band_info = None
 
-    return band_info
+        return band_info
+
+    def set_srs(self, code):
+        set_raster_srs(self.raster_fpath, code)
+        self.wkt = get_canonical_wkt(code.split(':')[-1])
+
+
+def set_raster_srs(raster_fpath, code):
+    """
+    Assigns a new coordinate reference system to a raster in place.
+    :param raster_fpath: path to the raster file
+    :param code: the new CRS in the form "EPSG:<code>"
+    """
+    from gdal import Open
+    from gdalconst import GA_Update
+    from osr import SpatialReference
+
+    srs = SpatialReference()
+    srs.ImportFromEPSG(int(code.split(':')[-1]))
+    with gdal_slots:
+        raster_dataset = Open(raster_fpath, GA_Update)
+        if raster_dataset is not None:
+            raster_dataset.SetProjection(srs.ExportToWkt())
+            raster_dataset.FlushCache()
+
+
+def build_image_pyramid(vrt_path, pyramid_dir_path, zip_path=None):
+    """
+    Tiles a raster into the directory layout of gdal_retile.py (level 0 tiles in pyramid_dir_path, reduced levels in
+    numbered subdirectories), building only as many levels as it takes for a level to fit in one tile. Like
+    gdal_retile.py, each reduced level is first resampled as a whole and then cut into tiles, so every tile of a level
+    has the same pixel size. Tiles are built in a thread pool, since GDAL releases the GIL while it works; each tile
+    takes its own gdal_slots permit, so a pyramid only uses the cores other stages leave free. If zip_path is given,
+    each tile is moved into a zip without compression as soon as it is built.
+    :param vrt_path: the raster to tile
+    :param pyramid_dir_path: directory the tiles are written to
+    :param zip_path: optional zip to collect the tiles in
+    :return: the number of reduced levels built
+    """
+    from gdal import Open, Translate
+    from gdalconst import GA_ReadOnly
+
+    dataset = Open(vrt_path, GA_ReadOnly)
+    x_size = dataset.RasterXSize
+    y_size = dataset.RasterYSize
+    dataset = None
+
+    num_levels = 1
+    while num_levels < PYRAMID_MAX_LEVELS and max(x_size, y_size) > PYRAMID_TILE_SIZE * 2 ** num_levels:
+        num_levels += 1
+
+    tile_base_name = os.path.splitext(os.path.basename(vrt_path))[0]
+    level_vrt_paths = []
+    tile_args = []
+    try:
+        for level in range(num_levels + 1):
+            if level == 0:
+                level_dir_path = pyramid_dir_path
+                level_vrt_path = vrt_path
+                level_x_size = x_size
+                level_y_size = y_size
+            else:
+                level_dir_path = os.path.join(pyramid_dir_path, str(level))
+                level_vrt_path = '%s_level%s.vrt' % (os.path.splitext(vrt_path)[0], level)
+                level_x_size = max(1, (x_size + 2 ** level - 1) // 2 ** level)
+                level_y_size = max(1, (y_size + 2 ** level - 1) // 2 ** level)
+                with gdal_slots:
+                    Translate(level_vrt_path, vrt_path, format='VRT', width=level_x_size, height=level_y_size,
+                              resampleAlg='average')
+                level_vrt_paths.append(level_vrt_path)
+            if not os.path.exists(level_dir_path):
+                os.makedirs(level_dir_path)
+            num_rows = (level_y_size + PYRAMID_TILE_SIZE - 1) // PYRAMID_TILE_SIZE
+            num_cols = (level_x_size + PYRAMID_TILE_SIZE - 1) // PYRAMID_TILE_SIZE
+            for row in range(num_rows):
+                for col in range(num_cols):
+                    x_off = col * PYRAMID_TILE_SIZE
+                    y_off = row * PYRAMID_TILE_SIZE
+                    tile_fname = '{0}_{1}_{2}.tif'.format(tile_base_name,
+                                                          str(row + 1).zfill(len(str(num_rows))),
+                                                          str(col + 1).zfill(len(str(num_cols))))
+                    tile_args.append((level_vrt_path,
+                                      os.path.join(level_dir_path, tile_fname),
+                                      [x_off, y_off,
+                                       min(PYRAMID_TILE_SIZE, level_x_size - x_off),
+                                       min(PYRAMID_TILE_SIZE, level_y_size - y_off)]))
+
+        pool = ThreadPool(min(GDAL_CONCURRENCY, len(tile_args)))
+        try:
+            if zip_path:
+                with zipfile.ZipFile(zip_path, 'w', GEOSERVER_STAGING_COMPRESSION, True) as zip_object:
+                    for level in range(1, num_levels + 1):
+                        level_dir_info = zipfile.ZipInfo('%s/' % level)
+                        level_dir_info.external_attr = (0o40755 << 16) | 0x10
+                        zip_object.writestr(level_dir_info, '')
+                    for tile_path in pool.imap_unordered(build_pyramid_tile, tile_args):
+                        zip_object.write(tile_path, os.path.relpath(tile_path, pyramid_dir_path))
+                        os.remove(tile_path)
+            else:
+                pool.map(build_pyramid_tile, tile_args)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for level_vrt_path in level_vrt_paths:
+            if os.path.exists(level_vrt_path):
+                os.remove(level_vrt_path)
+
+    return num_levels
+
+
+def build_pyramid_tile(args):
+    """
+    Writes one tile of build_image_pyramid. Runs in a worker thread.
+    """
+    from gdal import Translate
+
+    level_vrt_path, tile_path, src_window = args
+    with gdal_slots:
+        Translate(tile_path, level_vrt_path, srcWin=src_window, creationOptions=['TILED=YES'])
+
+    return tile_path
+
+
+def normalize_raster(raster_profile):
+    """
+    Rewrites a raster in place as a Cloud-Optimized GeoTIFF unless it is already laid out for fast rendering.
+    :return: the RasterProfile of the file now at that path, and the conversion to record with the layer
+    """
+    if not NORMALIZE_RASTERS_TO_COG or raster_profile.is_cloud_optimized:
+        return raster_profile, 'none'
+
+    fpath = raster_profile.raster_fpath
+    cog_path = '%s_cog.tif' % os.path.splitext(fpath)[0]
+    build_cog(fpath, cog_path)
+    os.rename(cog_path, fpath)
+
+    return RasterProfile(fpath), 'cog'
+
+
+def build_cog(src_path, cog_path):
+    """
+    Writes a raster as a Cloud-Optimized GeoTIFF: tiled, compressed, with internal overviews.
+    """
+    from gdal import Open, Translate, GetDriverByName
+    from gdalconst import GA_Update
+
+    creation_options = ['COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+    with gdal_slots:
+        if GetDriverByName('COG') is not None:
+            Translate(cog_path, src_path, format='COG', creationOptions=creation_options)
+        else:
+            # GDAL < 3.1: build the overviews on a tiled copy, then copy them in front of the full resolution data
+            tmp_path = '%s_tmp.tif' % os.path.splitext(cog_path)[0]
+            Translate(tmp_path, src_path, creationOptions=creation_options + ['TILED=YES'])
+            dataset = Open(tmp_path, GA_Update)
+            overview_levels = []
+            factor = 2
+            while max(dataset.RasterXSize, dataset.RasterYSize) / factor >= 256:
+                overview_levels.append(factor)
+                factor *= 2
+            if overview_levels:
+                dataset.BuildOverviews('AVERAGE', overview_levels)
+            dataset = None
+            Translate(cog_path, tmp_path, creationOptions=creation_options + ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES'])
+            os.remove(tmp_path)
+
 
 def check_if_image_pyramid(fpath):
     is_image_pyramid = False
@@ -1595,7 +3660,7 @@ def validate_res_request(hs, res_id):
         'message': None
     }
     try:
-        hs.getScienceMetadataRDF(res_id)
+        get_res_metadata(hs, res_id, refresh=True)
         return_obj['can_access'] = True
     except hs_r.HydroShareNotAuthorized:
         return_obj['message'] = 'You are not authorized to access this resource.'
@@ -1606,7 +3671,17 @@ def validate_res_request(hs, res_id):
 
 
 def process_tempdir_file_list(tempdir_file_list, hs_tempdir, hs, res_id, res_type, username):
+    res_file_names = list_tempdir_files_to_process(tempdir_file_list, hs_tempdir, res_type)
     results = []
+    for r in process_generic_res_files(hs, res_id, res_file_names, username):
+        if r['success']:
+            results.append(r['results'])
+
+    return results
+
+
+def list_tempdir_files_to_process(tempdir_file_list, hs_tempdir, res_type):
+    res_file_names = []
     for f in tempdir_file_list:
         should_process_file = False
         is_zip = False
@@ -1631,15 +3706,36 @@ def process_tempdir_file_list(tempdir_file_list, hs_tempdir, hs, res_id, res_typ
             os.mkdir(tmpdir_path)
             os.system('unzip %s -d %s' % (f_path, tmpdir_path))
             tmpdir_file_list = os.listdir(tmpdir_path)
-            results += process_tempdir_file_list(tmpdir_file_list, hs_tempdir, hs, res_id, res_type, username)
+            res_file_names += list_tempdir_files_to_process(tmpdir_file_list, hs_tempdir, res_type)
 
         if should_process_file:
-            r = process_generic_res_file(hs, res_id, f, username)
-            if r['success']:
-                result = r['results']
-                results.append(result)
+            res_file_names.append(f)
 
-    return results
+    return res_file_names
+
+
+def process_generic_res_files(hs, res_id, res_file_names, username):
+    """
+    Processes several files of the same resource at once. Each file is processed by process_generic_res_file in its
+    own thread and temp directory (the file's index in res_file_names), while the stage semaphores (hs_download_slots,
+    geoserver_upload_slots and gdal_slots) bound how many threads download, upload or crunch data at the same time.
+    :return: list of the responses of process_generic_res_file, in the same order as res_file_names
+    """
+    if not res_file_names:
+        return []
+
+    def process_file(args):
+        file_index, res_file_name = args
+        return process_generic_res_file(hs, res_id, res_file_name, username, file_index)
+
+    pool = ThreadPool(min(INGEST_POOL_SIZE, len(res_file_names)))
+    try:
+        responses = pool.map(process_file, list(enumerate(res_file_names)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return responses
 
 
 def add_file_to_res(hs, res_id, fpath):
@@ -1674,6 +3770,9 @@ def remove_layer_from_geoserver(res_id, file_index=None):
 
     engine = return_spatial_dataset_engine()
     engine.delete_store(store_id, purge=True, recurse=True, debug=get_debug_val())
+    remove_staged_raster(get_geoserver_store_id(res_id, file_index))
+    # Shapefile layers are named after their store
+    remove_attribute_cache(store_id)
 
 def lonlat_point_to_geojson(lon, lat):
     return {
@@ -1704,15 +3803,19 @@ def get_hs_auth_obj(request):
     if '127.0.0.1' in request.get_host():
         hs = hs_r.HydroShare(auth=hs_r.HydroShareAuthBasic(username='test', password='test'))
     else:
-        try:
-            hs = get_oauth_hs(request)
-        except Exception as e:
-            if "Not logged in through OAuth" in str(e):
-                return_obj['message'] = message_need_to_login
-                return return_obj
-            else:
-                return_obj['message'] = message_multiple_logins
-                return return_obj
+        token_dict = get_hs_token_dict(request)
+        hs = get_cached_hs_client(request.user.username, token_dict)
+        if hs is None:
+            try:
+                hs = get_oauth_hs(request)
+            except Exception as e:
+                if "Not logged in through OAuth" in str(e):
+                    return_obj['message'] = message_need_to_login
+                    return return_obj
+                else:
+                    return_obj['message'] = message_multiple_logins
+                    return return_obj
+            cache_hs_client(request.user.username, token_dict, hs)
 
     return_obj['hs_obj'] = hs
     return_obj['success'] = True
@@ -1720,6 +3823,320 @@ def get_hs_auth_obj(request):
     return return_obj
 
 
+def get_hs_token_dict(request):
+    try:
+        return request.user.social_auth.get(provider='hydroshare').extra_data['token_dict']
+    except Exception:
+        return None
+
+
+def get_cached_hs_client(username, token_dict):
+    """
+    Returns the HydroShare client cached for this user and access token, if it has not expired
+    """
+    if not token_dict or 'access_token' not in token_dict:
+        return None
+
+    entry = hs_client_cache.get(username)
+    if entry is None or entry[1] != token_dict['access_token']:
+        return None
+
+    return entry[0]
+
+
+def cache_hs_client(username, token_dict, hs):
+    """
+    Caches a HydroShare client, along with its requests session and connection pool, until HS_CLIENT_TTL has passed
+    or the access token is about to expire, whichever comes first
+    """
+    if not token_dict or 'access_token' not in token_dict:
+        return
+
+    expires = time() + HS_CLIENT_TTL.total_seconds()
+    if token_dict.get('expires_at'):
+        expires = min(expires, float(token_dict['expires_at']) - 60)
+
+    hs_client_cache.set(username, (hs, token_dict['access_token']), expires)
+
+
 def get_geoserver_store_id(res_id, file_index=None):
     return 'gis_{res_id}{flag}'.format(res_id=res_id,
                                        flag='_{0}'.format(file_index) if file_index else '')
+
+
+def add_hs_res(hs, res_id, res_type, res_title, username, report_stage=None):
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {}
+    }
+
+    if report_stage:
+        report_stage('Checking access to the resource')
+    r = validate_res_request(hs, res_id)
+    if not r['can_access']:
+        return_obj['message'] = r['message']
+    else:
+        def load_res():
+            if report_stage:
+                report_stage('Looking for existing layers')
+            res_layers_obj_list = get_res_layers_from_db(hs, res_id, res_type, res_title, username)
+            if res_layers_obj_list:
+                return {
+                    'success': True,
+                    'message': None,
+                    'results': res_layers_obj_list
+                }
+            else:
+                if report_stage:
+                    report_stage('Loading the resource into the map server')
+                return process_nongeneric_res(hs, res_id, res_type, res_title, username)
+
+        flight_key = get_ingest_flight_key(res_id, None, get_res_mod_date(hs, res_id))
+        return_obj = run_single_flight(flight_key, load_res, report_stage)
+
+    return return_obj
+
+
+def add_generic_res_file(hs, res_id, res_fname, file_index, username, report_stage=None):
+    return_obj = {
+        'success': False,
+        'message': None,
+        'results': {}
+    }
+
+    if report_stage:
+        report_stage('Checking access to the resource')
+    r = validate_res_request(hs, res_id)
+    if not r['can_access']:
+        return_obj['message'] = r['message']
+    else:
+        def load_res_file():
+            if report_stage:
+                report_stage('Looking for an existing layer')
+            generic_file_layer_obj = get_generic_file_layer_from_db(hs, res_id, res_fname, file_index, username)
+            if generic_file_layer_obj:
+                return {
+                    'success': True,
+                    'message': None,
+                    'results': generic_file_layer_obj
+                }
+            else:
+                if report_stage:
+                    report_stage('Loading the file into the map server')
+                return process_generic_res_file(hs, res_id, res_fname, username, file_index)
+
+        flight_key = get_ingest_flight_key(res_id, file_index, get_res_mod_date(hs, res_id))
+        return_obj = run_single_flight(flight_key, load_res_file, report_stage)
+
+    return return_obj
+
+
+def get_ingest_flight_key(res_id, file_index, res_mod_date):
+    return '{res_id}:{file_index}:{res_mod_date}'.format(res_id=res_id, file_index=file_index,
+                                                         res_mod_date=res_mod_date)
+
+
+def run_single_flight(flight_key, func, report_stage=None):
+    """
+    Runs func unless another request (in any worker process) is already running it for the same flight_key, in which
+    case that request's result is waited for and returned instead. This keeps simultaneous opens of the same resource
+    from downloading it and overwriting the same GeoServer store several times over.
+    :param flight_key: identifies the work, see get_ingest_flight_key
+    :param func: function that does the work and returns a JSON serializable return_obj
+    :param report_stage: optional function that is given progress messages
+    :return: the return_obj of func
+    """
+    while True:
+        if IngestFlight.try_to_lead(flight_key, INGEST_FLIGHT_STALE_AFTER, INGEST_FLIGHT_RESULT_TTL):
+            with heartbeat_lock:
+                active_flight_keys.add(flight_key)
+            start_heartbeat()
+            try:
+                return_obj = func()
+            except Exception:
+                IngestFlight.remove_flight(flight_key)
+                raise
+            finally:
+                with heartbeat_lock:
+                    active_flight_keys.discard(flight_key)
+            if return_obj.get('success'):
+                IngestFlight.finish_flight(flight_key, dumps(return_obj, cls=DjangoJSONEncoder))
+            else:
+                # Failures are not shared, so that waiting requests try again themselves
+                IngestFlight.remove_flight(flight_key)
+
+            return return_obj
+
+        if report_stage:
+            report_stage('Waiting for another request that is loading the same resource')
+        poll_interval = INGEST_FLIGHT_POLL_INTERVAL
+        while True:
+            sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, INGEST_FLIGHT_MAX_POLL_INTERVAL)
+            flight = IngestFlight.get_flight_by_key(flight_key)
+            if flight is None or (flight.status == 'running' and
+                                  datetime.utcnow() - flight.heartbeat > INGEST_FLIGHT_STALE_AFTER):
+                # The leader failed or went away. Try again, possibly as the new leader.
+                break
+            elif flight.status == 'done':
+                return loads(flight.result)
+
+
+def get_job_pool():
+    global job_pool
+    with job_pool_lock:
+        if job_pool is None:
+            job_pool = ThreadPool(JOB_WORKERS)
+
+    return job_pool
+
+
+def stop_jobs():
+    """
+    Runs when the worker process exits. Jobs queued afterwards run in the requesting thread (see enqueue_job), and
+    the jobs this process still had queued or running are marked failed, since they end with it.
+    """
+    global jobs_are_stopping
+    with heartbeat_lock:
+        jobs_are_stopping = True
+        job_ids = list(active_job_ids)
+    result = dumps({
+        'success': False,
+        'message': 'The server restarted before this resource could be loaded. Please add it again.',
+        'results': {}
+    })
+    for job_id in job_ids:
+        try:
+            Job.update_job(job_id, status='failed', stage='Failed', result=result)
+        except Exception as e:
+            logger.error('Could not mark job %s as failed: %s' % (job_id, str(e)))
+
+
+atexit.register(stop_jobs)
+
+
+def start_heartbeat():
+    """
+    Starts this process's heartbeat thread, unless it is already running
+    """
+    global heartbeat_thread
+    with heartbeat_lock:
+        if heartbeat_thread is None or not heartbeat_thread.is_alive():
+            heartbeat_thread = Thread(target=send_heartbeats, name='hydroshare_gis_heartbeat')
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+
+
+def send_heartbeats():
+    """
+    Refreshes the jobs that this process has queued or is running, and the ingest flights it leads, so that they can
+    be told from those whose process went away. Old jobs are removed every JOB_CLEANUP_INTERVAL.
+    """
+    last_cleanup = None
+    while True:
+        sleep(HEARTBEAT_INTERVAL)
+        try:
+            with heartbeat_lock:
+                job_ids = list(active_job_ids)
+                flight_keys = list(active_flight_keys)
+            if job_ids:
+                Job.touch_jobs(job_ids)
+            if flight_keys:
+                IngestFlight.touch_flights(flight_keys)
+            if last_cleanup is None or datetime.utcnow() - last_cleanup > JOB_CLEANUP_INTERVAL:
+                Job.remove_jobs_older_than(JOB_MAX_AGE)
+                last_cleanup = datetime.utcnow()
+        except Exception as e:
+            logger.error('Heartbeat failed: %s' % str(e))
+
+
+def enqueue_job(job_type, hs, username, params):
+    """
+    Queues the processing of a resource or resource file and returns right away, unless this process is exiting, in
+    which case the job is run before returning. The state of the job is kept in the persistent store, so any worker
+    process can answer get_job_status for it.
+    :param job_type: "add_hs_res" or "add_generic_res_file"
+    :param hs: hs_restclient.HydroShare object of the requesting user
+    :param username: the requesting user
+    :param params: keyword arguments for add_hs_res or add_generic_res_file
+    :return: the job id
+    """
+    job_id = str(uuid4())
+    Job.add_job_to_database(job_id, job_type, username, dumps(params))
+    with heartbeat_lock:
+        if jobs_are_stopping:
+            # The job pool would not outlive this process, so the job is run before the request returns
+            run_in_request = True
+        else:
+            run_in_request = False
+            active_job_ids.add(job_id)
+    if run_in_request:
+        run_job(job_id, job_type, hs, username, params)
+    else:
+        start_heartbeat()
+        get_job_pool().apply_async(run_job, (job_id, job_type, hs, username, params))
+
+    return job_id
+
+
+def run_job(job_id, job_type, hs, username, params):
+    def report_stage(stage):
+        Job.update_job(job_id, stage=stage)
+
+    job_context.job_id = job_id
+    job_context.report_stage = report_stage
+    Job.update_job(job_id, status='running', stage='Starting')
+    try:
+        if job_type == 'add_hs_res':
+            result = add_hs_res(hs, username=username, report_stage=report_stage, **params)
+        elif job_type == 'add_generic_res_file':
+            result = add_generic_res_file(hs, username=username, report_stage=report_stage, **params)
+        else:
+            raise Exception('Unknown job type: %s' % job_type)
+
+        Job.update_job(job_id, status='complete', stage='Done', result=dumps(result, cls=DjangoJSONEncoder))
+    except Exception as e:
+        logger.error(''.join(format_exception(*exc_info())))
+        result = {
+            'success': False,
+            'message': 'An unexpected error ocurred: %s' % str(e),
+            'results': {}
+        }
+        Job.update_job(job_id, status='failed', stage='Failed', result=dumps(result))
+    finally:
+        job_context.job_id = None
+        job_context.report_stage = None
+        with heartbeat_lock:
+            active_job_ids.discard(job_id)
+
+
+def get_job_status(job_id, username):
+    return_obj = {
+        'success': False,
+        'message': None,
+        'job_id': job_id,
+        'status': None,
+        'stage': None,
+        'result': None
+    }
+
+    job = Job.get_job_by_job_id(job_id)
+    if job is None or job.username != username:
+        return_obj['message'] = 'This job could not be found. It may have expired.'
+    else:
+        return_obj['status'] = job.status
+        return_obj['stage'] = job.stage
+        return_obj['result'] = loads(job.result) if job.result else None
+        if job.status in ['queued', 'running'] and datetime.utcnow() - job.updated > JOB_STALE_AFTER:
+            # The worker process that owned the job went away without finishing it
+            return_obj['status'] = 'failed'
+            return_obj['stage'] = 'Failed'
+            return_obj['result'] = {
+                'success': False,
+                'message': 'The server stopped processing this resource before it was done. Please try again.',
+                'results': {}
+            }
+        return_obj['success'] = True
+
+    return return_obj